@@ -1,12 +1,13 @@
 import numpy as np
-from numba import njit
+from numba import njit, prange
 import cv2
 import edt
 from scipy.ndimage import binary_dilation, binary_opening, binary_closing, label # I need to test against skimage labelling
 from sklearn.utils.extmath import cartesian
 import fastremap
-import os, tifffile
-import time
+import os, tifffile, collections
+import time, hashlib, inspect
+from concurrent.futures import ThreadPoolExecutor
 import mgen #ND rotation matrix
 from . import utils
 
@@ -56,10 +57,10 @@ omnipose_logger = logging.getLogger(__name__)
 # Several '#'s denote locations where code needs to be changed if a remerger ever happens 
 OMNI_INSTALLED = True
 
-from tqdm import trange 
+from tqdm import tqdm, trange 
 import ncolor, scipy
 from scipy.ndimage.filters import maximum_filter1d
-from scipy.ndimage import find_objects, gaussian_filter, generate_binary_structure, label, maximum_filter1d, binary_fill_holes, zoom
+from scipy.ndimage import find_objects, gaussian_filter, generate_binary_structure, label, maximum_filter1d, maximum_filter, binary_fill_holes, zoom
 
     
 # try:
@@ -83,6 +84,11 @@ from skimage import filters
 import skimage.io #for debugging only
 SKIMAGE_ENABLED = True
 
+# skimage 0.26 renamed the hole size of remove_small_holes to max_size (the old keyword warns), 
+# and whether holes of exactly that size get filled depends on the version, so probe it once
+_HOLES_KW = 'max_size' if 'max_size' in inspect.signature(remove_small_holes).parameters else 'area_threshold'
+_HOLES_INCLUSIVE = bool(remove_small_holes(np.pad([[False]],1,constant_values=True),**{_HOLES_KW:1})[1,1])
+
 from scipy.ndimage import convolve, mean
 
 
@@ -172,7 +178,8 @@ def diameters(masks, dt=None, dist_threshold=0):
 # It is possible that flows can be eliminated in place of the distance field. The current distance field may not be smooth 
 # enough, or maybe the network really does require the flow field prediction to work well. But in 3D, it will be a huge
 # advantage if the network could predict just the distance (and boudnary) classes and not 3 extra flow components. 
-def labels_to_flows(labels, files=None, use_gpu=False, device=None, omni=True, redo_flows=False, dim=2):
+def labels_to_flows(labels, files=None, use_gpu=False, device=None, omni=True, redo_flows=False, dim=2, 
+                    solver='jacobi', per_object=False):
     """ Convert labels (list of masks or flows) to flows for training model.
 
     if files is not None, flows are saved to files to be reused
@@ -198,6 +205,10 @@ def labels_to_flows(labels, files=None, use_gpu=False, device=None, omni=True, r
         integer representing the intrinsic dimensionality of the data. This allows users to generate 3D flows
         for volumes. Some dependencies will need to be to be extended to allow for 4D, but the image and label
         loading is generalized to ND. 
+    solver: str
+        eikonal solver for the Omnipose smooth distance, see masks_to_flows()
+    per_object: bool
+        solve each object on its own crop, see masks_to_flows_torch()
 
     Returns
     --------------
@@ -217,7 +228,8 @@ def labels_to_flows(labels, files=None, use_gpu=False, device=None, omni=True, r
         
         # compute flows; labels are fixed in masks_to_flows, so they need to be passed back
         labels, dist, heat, veci = map(list,zip(*[masks_to_flows(labels[n],use_gpu=use_gpu, 
-                                                                 device=device, omni=omni, dim=dim) 
+                                                                 device=device, omni=omni, dim=dim, 
+                                                                 solver=solver, per_object=per_object) 
                                                   for n in trange(nimg)])) 
         
         # concatenate labels, distance transform, vector flows, heat (boundary and mask are computed in augmentations)
@@ -243,7 +255,8 @@ def labels_to_flows(labels, files=None, use_gpu=False, device=None, omni=True, r
 
     return flows
 
-def masks_to_flows(masks, dists=None, use_gpu=False, device=None, omni=True, dim=2):
+def masks_to_flows(masks, dists=None, use_gpu=False, device=None, omni=True, dim=2, solver='jacobi', 
+                   per_object=False):
     """Convert masks to flows. 
     
     First, we find the scalar field. In Omnipose, this is the distance field. In Cellpose, 
@@ -269,6 +282,16 @@ def masks_to_flows(masks, dists=None, use_gpu=False, device=None, omni=True, dim
         flag to generate Omnipose flows instead of Cellpose flows
     dim: int
         dimensionality of image data
+    solver: str
+        eikonal solver for the Omnipose smooth distance: 'jacobi' for the iterative torch update, 
+        or 'sweep' for Gauss-Seidel sweeps on the CPU, which run until no pixel changes by more 
+        than 1e-5. Jacobi runs for get_niter() of the unpadded distance field, which is not enough 
+        for objects that are reflection-padded at the image border (they are larger in the padded 
+        frame), so Jacobi stops short of the fixed point on those objects while the sweep reaches 
+        it; both agree within 1e-4 once Jacobi is run to convergence
+    per_object: bool
+        solve each object on its own crop with its own iteration count, see masks_to_flows_torch(). 
+        This is not bit-identical to the whole-image solve, see the note there
 
     Returns
     -------------
@@ -299,15 +322,24 @@ def masks_to_flows(masks, dists=None, use_gpu=False, device=None, omni=True, dim
         # this branch preserves original 3D apprach 
         Lz, Ly, Lx = masks.shape
         mu = np.zeros((3, Lz, Ly, Lx), np.float32)
-        for z in range(Lz):
-            mu0 = masks_to_flows_device(masks[z], dists[z], device=device, omni=omni)[0]
-            mu[[1,2], z] += mu0
-        for y in range(Ly):
-            mu0 = masks_to_flows_device(masks[:,y], dists[:,y], device=device, omni=omni)[0]
-            mu[[0,2], :, y] += mu0
-        for x in range(Lx):
-            mu0 = masks_to_flows_device(masks[:,:,x], dists[:,:,x], device=device, omni=omni)[0]
-            mu[[0,1], :, :, x] += mu0
+        if per_object:
+            for z in range(Lz):
+                mu0 = masks_to_flows_device(masks[z], dists[z], device=device, omni=omni, solver=solver, per_object=per_object)[0]
+                mu[[1,2], z] += mu0
+            for y in range(Ly):
+                mu0 = masks_to_flows_device(masks[:,y], dists[:,y], device=device, omni=omni, solver=solver, per_object=per_object)[0]
+                mu[[0,2], :, y] += mu0
+            for x in range(Lx):
+                mu0 = masks_to_flows_device(masks[:,:,x], dists[:,:,x], device=device, omni=omni, solver=solver, per_object=per_object)[0]
+                mu[[0,1], :, :, x] += mu0
+        else:
+            # all slices of each orientation solved together, accumulated as (d, slice, ...) views
+            for axis, comps in zip(range(3), [[1,2],[0,2],[0,1]]):
+                mu0 = _masks_to_flows_slices(np.moveaxis(masks,axis,0), np.moveaxis(dists,axis,0), 
+                                             device=device, omni=omni, solver=solver)
+                for c, comp in enumerate(comps):
+                    view = np.moveaxis(mu[comp], axis, 0)
+                    view += mu0[c]
         return masks, dists, None, mu #consistency with below
     
     else:
@@ -322,17 +354,17 @@ def masks_to_flows(masks, dists=None, use_gpu=False, device=None, omni=True, dim
             # step 1: remove any masks we do not want to reflect, then perform reflection padding
             masks_pad = np.pad(utils.get_edge_masks(masks,dists=dists),pad,mode='reflect') 
             masks_pad[unpad] = masks # step 2: restore the masks in the original area
-            mu, T = masks_to_flows_device(masks_pad, dists, device=device, omni=omni)
+            mu, T = masks_to_flows_device(masks_pad, dists, device=device, omni=omni, solver=solver, per_object=per_object)
             
             return masks, dists, T[unpad], mu[(Ellipsis,)+unpad]
 
         else: # reflection not a good idea for centroid model 
-            mu, T = masks_to_flows_device(masks, dists=dists, device=device, omni=omni)
+            mu, T = masks_to_flows_device(masks, dists=dists, device=device, omni=omni, solver=solver, per_object=per_object)
             return masks, dists, T, mu
 
 
 #Now fully converted to work for ND.
-def masks_to_flows_torch(masks, dists, device=None, omni=True):
+def masks_to_flows_torch(masks, dists, device=None, omni=True, solver='jacobi', per_object=False):
     """Convert ND masks to flows. 
     
     Omnipose find distance field, Cellpose uses diffusion from center of mass.
@@ -348,6 +380,15 @@ def masks_to_flows_torch(masks, dists, device=None, omni=True):
         what compute hardware to use to run the code (GPU VS CPU)
     omni: bool
         flag to generate Omnipose flows instead of Cellpose flows
+    solver: str
+        eikonal solver for the Omnipose smooth distance ('jacobi' or 'sweep')
+    per_object: bool
+        crop each object (with any reflected copies) to its bounding box and solve objects 
+        with the same iteration count together, instead of running every object for as many 
+        iterations as the largest one needs (Omnipose only). The count of each object is capped 
+        at the whole-image count, but an object that gets fewer iterations than in the whole 
+        image is not always fully converged, so the smooth distance can differ by a few tenths 
+        of a pixel and the flow direction can flip at the few pixels where its gradient vanishes
 
     Returns
     -------------
@@ -362,52 +403,140 @@ def masks_to_flows_torch(masks, dists, device=None, omni=True):
     
     if device is None:
         device = torch.device('cuda')
-    if np.any(masks):
+    if np.any(masks) and per_object and omni and OMNI_INSTALLED:
+        return _masks_to_flows_per_object(masks, dists, device=device, solver=solver)
+    elif np.any(masks):
         # the padding here is different than the padding added in masks_to_flows(); 
         # for omni, we reflect masks to extend skeletons to the boundary. Here we pad 
         # with 0 to ensure that edge pixels are not handled differently. 
         pad = 1
         masks_padded = np.pad(masks,pad)
 
-        centers = np.array([])
-        if not omni: #do original centroid projection algrorithm
-            # get mask centers
-            centers = np.array(scipy.ndimage.center_of_mass(masks_padded, labels=masks_padded, 
-                                                            index=np.arange(1, masks_padded.max()+1))).astype(int).T
-            # (check mask center inside mask)
-            valid = masks_padded[tuple(centers)] == np.arange(1, masks_padded.max()+1)
-            for i in np.nonzero(~valid)[0]:
-                coords = np.array(np.nonzero(masks_padded==(i+1)))
-                meds = np.median(coords,axis=0)
-                imin = np.argmin(np.sum((coords-meds)**2,axis=0))
-                centers[:,i]=coords[:,imin]
-
-        # set number of iterations
-        if omni and OMNI_INSTALLED:
-            # omni version requires fewer iterations 
-            n_iter = get_niter(dists) ##### omnipose.core.get_niter
-        else:
-            slices = scipy.ndimage.find_objects(masks)
-            ext = np.array([[s.stop - s.start + 1 for s in slc] for slc in slices])
-            n_iter = 2 * (ext.sum(axis=1)).max()
-
+        centers, n_iter = _diffusion_setup(masks_padded, dists, omni=omni)
 
         # run diffusion 
-        mu, T = _extend_centers_torch(masks_padded, centers, n_iter=n_iter, device=device, omni=omni)
+        mu, T = _extend_centers_torch(masks_padded, centers, n_iter=n_iter, device=device, omni=omni, solver=solver)
         # normalize
         mu = utils.normalize_field(mu) ##### transforms.normalize_field(mu,omni)
 
         # put into original image
         mu0 = np.zeros((mu.shape[0],)+masks.shape)
-        mu0[(Ellipsis,)+np.nonzero(masks)] = mu
+        mu0[(Ellipsis,)+np.nonzero(masks)] = mu.reshape(mu.shape[0],-1) # single-pixel masks come back squeezed
         unpad =  tuple([slice(pad,-pad)]*masks.ndim)
         dist = T[unpad] # mu_c now heat/distance
         return mu0, dist
     else:
         return np.zeros((masks.ndim,)+masks.shape),np.zeros(masks.shape)
 
+def _diffusion_setup(masks_padded, dists, omni=True):
+    """ Centers (Cellpose only) and iteration count for _extend_centers_torch(), see masks_to_flows_torch(). """
+    centers = np.array([])
+    if not omni: #do original centroid projection algrorithm
+        # get mask centers, skipping labels that are not present (e.g. in a slice of a volume)
+        index = fastremap.unique(masks_padded)
+        index = index[index>0]
+        centers = np.array(scipy.ndimage.center_of_mass(masks_padded, labels=masks_padded, 
+                                                        index=index)).astype(int).reshape(-1,masks_padded.ndim).T
+        # (check mask center inside mask)
+        valid = masks_padded[tuple(centers)] == index
+        for i in np.nonzero(~valid)[0]:
+            coords = np.array(np.nonzero(masks_padded==index[i]))
+            meds = np.median(coords,axis=0)
+            imin = np.argmin(np.sum((coords-meds)**2,axis=0))
+            centers[:,i]=coords[:,imin]
+
+    # set number of iterations
+    if omni and OMNI_INSTALLED:
+        # omni version requires fewer iterations
+        n_iter = get_niter(dists) ##### omnipose.core.get_niter
+    else:
+        slices = scipy.ndimage.find_objects(masks_padded)
+        ext = np.array([[s.stop - s.start + 1 for s in slc] for slc in slices if slc is not None])
+        n_iter = 2 * (ext.sum(axis=1)).max()
+    return centers, n_iter
+
+def _masks_to_flows_slices(masks, dists, device=None, omni=True, solver='jacobi'):
+    """ 2D flows of every slice of a stack of label images, see masks_to_flows_torch(). 
+    
+    Slices that need the same number of iterations are stacked along the first axis, 
+    separated by empty rows, and solved together in one call, which gives the same 
+    flows as solving them one at a time. 
+    
+    Parameters
+    -------------
+    masks: int, 3D array
+        stack of 2D label images [N x Ly x Lx]
+    dists: float, 3D array
+        distance field of the stack
+        
+    Returns
+    -------------
+    mu: float, 4D array
+        flows [2 x N x Ly x Lx]
+        
+    """
+    N, Ly, Lx = masks.shape
+    mu = np.zeros((2,)+masks.shape)
+    setup = {z: _diffusion_setup(np.pad(masks[z],1), dists[z], omni=omni) for z in range(N) if np.any(masks[z])}
+    for n_iter in fastremap.unique(np.array([n for _,n in setup.values()], int)):
+        group = [z for z in setup if setup[z][1]==n_iter]
+        canvas = np.zeros((len(group)*(Ly+1)+1, Lx+2), masks.dtype)
+        centers = []
+        for k,z in enumerate(group):
+            canvas[1+k*(Ly+1):1+k*(Ly+1)+Ly, 1:1+Lx] = masks[z]
+            if not omni:
+                centers.append(setup[z][0] + np.array([[k*(Ly+1)],[0]]))
+        centers = np.concatenate(centers,axis=1) if centers else np.array([])
+        
+        m, T = _extend_centers_torch(canvas, centers, n_iter=n_iter, device=device, omni=omni, solver=solver)
+        coords = np.nonzero(canvas)
+        k, y = np.divmod(coords[0]-1, Ly+1)
+        mu[:, np.array(group)[k], y, coords[1]-1] = utils.normalize_field(m.reshape(2,-1))
+    return mu
+
+def _masks_to_flows_per_object(masks, dists, device=None, solver='jacobi'):
+    """ Omnipose flows solved per object, see masks_to_flows_torch(). 
+    
+    The iteration count of each object comes from its own maximum distance, capped at the count 
+    the whole-image solve takes from dists, so that objects which do not converge in the whole 
+    image (e.g. reflected copies in the padding of masks_to_flows()) get the same field. Objects 
+    sharing a count are stacked along the first axis, separated by empty rows, and solved in one call. 
+    
+    """
+    d = masks.ndim
+    slices = find_objects(masks)
+    index = np.array([i+1 for i,slc in enumerate(slices) if slc is not None])
+    dt = edt.edt(masks)
+    niters = np.array([get_niter(m) for m in scipy.ndimage.maximum(dt, masks, index).reshape(-1)])
+    niters = np.minimum(niters, get_niter(dists))
+    
+    mu0 = np.zeros((d,)+masks.shape)
+    T0 = np.zeros(masks.shape)
+    for n_iter in fastremap.unique(niters):
+        group = index[niters==n_iter]
+        crops = [masks[slices[i-1]]==i for i in group]
+        starts = np.cumsum([1]+[c.shape[0]+1 for c in crops[:-1]])
+        shape = [starts[-1]+crops[-1].shape[0]+1]+[max(c.shape[k] for c in crops)+2 for k in range(1,d)]
+        canvas = np.zeros(shape, np.int32)
+        for k,(c,start) in enumerate(zip(crops,starts)):
+            canvas[(slice(start,start+c.shape[0]),)+tuple([slice(1,1+L) for L in c.shape[1:]])] = c*(k+1)
+        
+        mu, T = _extend_centers_torch(canvas, np.array([]), n_iter=n_iter, device=device, omni=True, solver=solver)
+        mu = utils.normalize_field(mu.reshape(d,-1)) ##### transforms.normalize_field(mu,omni)
+        T = np.asarray(T).reshape(canvas.shape)
+        
+        # scatter back through the offset of each crop 
+        coords = np.array(np.nonzero(canvas))
+        k = canvas[tuple(coords)]-1
+        offset = np.array([[slices[i-1][0].start-start]+[slices[i-1][a].start-1 for a in range(1,d)] 
+                           for i,start in zip(group,starts)]).T
+        dest = tuple(coords+offset[:,k])
+        mu0[(Ellipsis,)+dest] = mu
+        T0[dest] = T[tuple(coords)]
+    return mu0, torch.from_numpy(T0)
+
 # edited slightly to fix a 'bleeding' issue with the gradient; now identical to CPU version
-def _extend_centers_torch(masks, centers, n_iter=200, device=torch.device('cuda'), omni=True):
+def _extend_centers_torch(masks, centers, n_iter=200, device=torch.device('cuda'), omni=True, solver='jacobi'):
     """ runs diffusion on GPU to generate flows for training images or quality control
     PyTorch implementation is faster than jitted CPU implementation, therefore only the 
     GPU optimized code is being used moving forward. 
@@ -426,6 +555,11 @@ def _extend_centers_torch(masks, centers, n_iter=200, device=torch.device('cuda'
     omni: bool
         whether to generate Omnipose field (solve Eikonal equation) 
         or the Cellpose field (solve heat equation from "center") 
+    solver: str
+        'jacobi' runs n_iter parallel updates of eikonal_update_torch, 'sweep' solves 
+        the same update with Gauss-Seidel sweeps (_eikonal_sweep), stopping at a tolerance 
+        (about n_iter sweeps in practice; 2*n_iter+2**d at most, since reflected edge objects 
+        can be up to twice as deep as get_niter() assumes)
         
     Returns
     -------------
@@ -439,76 +573,205 @@ def _extend_centers_torch(masks, centers, n_iter=200, device=torch.device('cuda'
     """
         
     d = masks.ndim
-    coords = np.nonzero(masks)
-    idx = (3**d)//2 # center pixel index
-
-    neigh = [[-1,0,1] for i in range(d)]
-    steps = cartesian(neigh) # all the possible step sequences in ND
-    neighbors = np.array([np.add.outer(coords[i],steps[:,i]) for i in range(d)]).swapaxes(-1,-2)
-    
-    # get indices of the hupercubes sharing m-faces on the central n-cube
-    sign = np.sum(np.abs(steps),axis=1) # signature distinguishing each kind of m-face via the number of steps 
-    uniq = fastremap.unique(sign)
-    inds = [np.where(sign==i)[0] for i in uniq] # 2D: [4], [1,3,5,7], [0,2,6,8]. 1-7 are y axis, 3-5 are x, etc. 
-    fact = np.sqrt(uniq) # weighting factor for each hypercube group 
-    
-    # get neighbor validator (not all neighbors are in same mask)
-    neighbor_masks = masks[tuple(neighbors)] #extract list of label values, 
-    isneighbor = neighbor_masks == neighbor_masks[idx] 
+    idx, offsets, valid, inds, fact = _flat_stencil(masks)
+    if omni and OMNI_INSTALLED and solver=='sweep':
+        T = eikonal_sweep(masks, idx, offsets, valid, d, inds, fact, 2*n_iter+2**d).reshape(-1)
+        T = torch.from_numpy(T).to(device)
+        n_iter = 0 
+    else:
+        T = torch.zeros(masks.size, dtype=torch.float32, device=device)
     
-    nimg = neighbors.shape[1] // (3**d)
-    pt = torch.from_numpy(neighbors).to(device)
-    T = torch.zeros((nimg,)+masks.shape, dtype=torch.double, device=device)
-    isneigh = torch.from_numpy(isneighbor).to(device) # isneigh is <3**d> x <number of points in mask>
+    # flat indices of the mask pixels, constant offsets of their neighbors, and the packed
+    # bitmask of which neighbors are in the same mask 
+    pix = torch.from_numpy(idx).to(device)
+    offsets = torch.from_numpy(offsets).to(device)
+    isneigh = torch.from_numpy(valid).to(device)
+    if not omni:
+        meds = torch.from_numpy(np.ravel_multi_index(tuple(centers.astype(int)), masks.shape)).to(device)
     
-    meds = torch.from_numpy(centers.astype(int)).to(device)
-
-    mask_pix = (Ellipsis,)+tuple(pt[:,idx]) #indexing for the central coordinates 
-    center_pix = (Ellipsis,)+tuple(meds)
-    neigh_pix = (Ellipsis,)+tuple(pt)    
     for t in range(n_iter):
         if omni and OMNI_INSTALLED:
-             T[mask_pix] = eikonal_update_torch(T,pt,isneigh,d,inds,fact) ##### omnipose.core.eikonal_update_torch
+             T[pix] = eikonal_update_torch(T,pix,offsets,isneigh,d,inds,fact) ##### omnipose.core.eikonal_update_torch
         else:
-            T[center_pix] += 1
-            Tneigh = T[neigh_pix] # T is square, but Tneigh is nimg x <3**d> x <number of points in mask>
-            Tneigh *= isneigh  #zeros out any elements that do not belong in convolution
-            T[mask_pix] = Tneigh.mean(axis=1) # mean along the <3**d>-element column does the box convolution 
+            T[meds] += 1
+            # mean over the 3**d neighbors does the box convolution, non-neighbors count as 0
+            Tneigh = _neighbor_torch(T,pix,offsets,isneigh,0)
+            for k in range(1,3**d):
+                Tneigh += _neighbor_torch(T,pix,offsets,isneigh,k)
+            T[pix] = Tneigh / 3**d 
 
     # There is still a fade out effect on long cells, not enough iterations to diffuse far enough I think 
     # The log operation does not help much to alleviate it, would need a smaller constant inside. 
     if not omni:
         T = torch.log(1.+ T)
     
-    Tcpy = T.clone()
-    idx = inds[1]
-    mask = isneigh[idx]
-    cardinal_points = (Ellipsis,)+tuple(pt[:,idx]) 
-    grads = T[cardinal_points]*mask # prevent bleedover, big problem in stock Cellpose that got reverted! 
-    mu_torch = np.stack([(grads[:,-(i+1)]-grads[:,i]).cpu().squeeze() for i in range(0,grads.shape[1]//2)])/2
+    # masking the neighbors prevents bleedover, big problem in stock Cellpose that got reverted! 
+    card = inds[1]
+    mu_torch = np.stack([(_neighbor_torch(T,pix,offsets,isneigh,card[-(i+1)]) - 
+                          _neighbor_torch(T,pix,offsets,isneigh,card[i])).cpu() for i in range(len(card)//2)])/2
 
-    return mu_torch, Tcpy.cpu().squeeze()
+    return mu_torch, T.reshape(masks.shape).cpu()
 
-def eikonal_update_torch(T,pt,isneigh,d=None,index_list=None,factors=None):
-    """Update for iterative solution of the eikonal equation on GPU."""
-    # Flatten the zero out the non-neighbor elements so that they do not participate in min
-    # Tneigh = T[:, pt[:,:,0], pt[:,:,1]] 
-    # Flatten and zero out the non-neighbor elements so that they do not participate in min
+def _flat_stencil(masks):
+    """ Flat-index 3**d neighborhood of the mask pixels of a zero-padded label array.
+    
+    Parameters
+    -------------
+    masks: int, ND array
+        labelled masks, with at least one pixel of background on every edge
+        
+    Returns
+    -------------
+    idx: int32, 1D array
+        flat index of each mask pixel (int64 for arrays over 2**31 pixels)
+    offsets: int32, 1D array
+        flat offset of each of the 3**d neighbors, the center one is offsets[(3**d)//2]=0
+    valid: int32, 2D array
+        packed bitmask [ceil(3**d/32) x npix], bit k is set when neighbor k is in the same mask
+    index_list: list of int arrays
+        neighbor indices of each hypercube group, 2D: [4], [1,3,5,7], [0,2,6,8]. 1-7 are y axis, 3-5 are x, etc. 
+    factors: float array
+        weighting factor of each hypercube group 
     
-    Tneigh = T[(Ellipsis,)+tuple(pt)]
-    Tneigh *= isneigh
+    """
+    d = masks.ndim
+    steps = cartesian([[-1,0,1]]*d) # all the possible step sequences in ND
+    strides = np.cumprod((masks.shape[1:]+(1,))[::-1])[::-1]
+    dtype = np.int32 if masks.size < 2**31 else np.int64
+    offsets = (steps @ strides).astype(dtype)
+    flat = masks.reshape(-1)
+    idx = np.flatnonzero(flat).astype(dtype)
+    label = flat[idx]
+    valid = np.zeros(((3**d+31)//32, len(idx)), np.int32)
+    for k,o in enumerate(offsets):
+        valid[k//32] |= (flat[idx+o]==label).astype(np.int32) << (k%32)
+    
+    # get indices of the hupercubes sharing m-faces on the central n-cube
+    sign = np.sum(np.abs(steps),axis=1) # signature distinguishing each kind of m-face via the number of steps 
+    uniq = fastremap.unique(sign)
+    index_list = [np.where(sign==i)[0] for i in uniq]
+    factors = np.sqrt(uniq) # weighting factor for each hypercube group 
+    return idx, offsets, valid, index_list, factors
+
+def _neighbor_torch(T,pix,offsets,isneigh,k):
+    """ Values of neighbor k of the mask pixels in the flat field T, 0 where it is not in the same mask. """
+    return T[pix+offsets[k]]*((isneigh[k//32] >> (k%32)) & 1)
+
+def eikonal_update_torch(T,pix,offsets,isneigh,d=None,index_list=None,factors=None):
+    """Update for iterative solution of the eikonal equation on GPU.
+    
+    T is the flat distance field and pix, offsets, isneigh the flat stencil of _flat_stencil(). 
+    Non-neighbor elements are zeroed out so that they do not participate in min.
+    """
     # preallocate array to multiply into to do the geometric mean
-    phi_total = torch.ones_like(Tneigh[0,0,:])
+    phi_total = torch.ones(pix.shape, dtype=T.dtype, device=T.device)
     # loop over each index list + weight factor 
     for inds,fact in zip(index_list[1:],factors[1:]):
         # find the minimum of each hypercube pair along each axis
-        mins = [torch.minimum(Tneigh[:,inds[i],:],Tneigh[:,inds[-(i+1)],:]) for i in range(len(inds)//2)] 
+        mins = [torch.minimum(_neighbor_torch(T,pix,offsets,isneigh,inds[i]),
+                              _neighbor_torch(T,pix,offsets,isneigh,inds[-(i+1)])) for i in range(len(inds)//2)] 
         #apply update rule using the array of mins
-        phi = update_torch(torch.cat(mins),fact)
+        phi = update_torch(torch.stack(mins),fact)
         # multipy into storage array
         phi_total *= phi    
     return phi_total**(1/d) #geometric mean of update along each connectivity set 
 
+def eikonal_sweep(masks, idx, offsets, valid, d, index_list, factors, max_sweeps, tol=1e-5):
+    """Solve the smooth distance with Gauss-Seidel sweeps of the eikonal_update_torch() rule. 
+    
+    Each sweep updates the pixels in place, alternating over the 2**d axis orderings like 
+    fast sweeping methods, so the distance propagates across a whole cell in one pass instead 
+    of one pixel per Jacobi iteration. This reaches the fixed point of the Jacobi update in a 
+    handful of sweeps; Jacobi only gets there when it is given enough iterations, which is not 
+    the case for reflected edge objects in masks_to_flows() (see its solver parameter). 
+    
+    Parameters
+    -------------
+    masks: int, ND array
+        padded label matrix
+    idx, offsets, valid: 
+        flat stencil of the mask pixels, see _flat_stencil()
+    d: int
+        dimension
+    index_list: list of int arrays
+        neighbor indices of each hypercube group (see _flat_stencil)
+    factors: float array
+        weighting factor of each hypercube group 
+    max_sweeps: int
+        sweep limit 
+    tol: float
+        stop once a sweep changes no pixel by more than this
+        
+    Returns
+    -------------
+    T: float32, ND array
+        smooth distance field
+        
+    """
+    # pairs of opposite neighbors in the same order as eikonal_update_torch, tagged by group
+    pairs, group = [], []
+    for g,inds in enumerate(index_list[1:]):
+        for i in range(len(inds)//2):
+            pairs.append([inds[i],inds[-(i+1)]])
+            group.append(g)
+    pairs = np.array(pairs, np.int64).reshape(-1,2)
+    
+    # raster orders along half of the combinations of axis directions, the others are these reversed
+    coords = np.unravel_index(idx, masks.shape)
+    orders = np.array([np.lexsort([c*s for c,s in zip(coords,signs)][::-1]) 
+                       for signs in cartesian([[1]]+[[1,-1]]*(d-1))], np.int32)
+    
+    T = _eikonal_sweep(idx.astype(np.int64), offsets.astype(np.int64), valid, orders, pairs, 
+                       np.array(group, np.int64), np.asarray(factors[1:], np.float64), d, masks.size, 
+                       tol, int(max_sweeps))
+    return T.reshape(masks.shape)
+
+@njit('float32[:](int64[:], int64[:], int32[:,:], int32[:,:], int64[:,:], int64[:], float64[:], int64, int64, float64, int64)', nogil=True)
+def _eikonal_sweep(idx, offsets, valid, orders, pairs, group, fact, d, size, tol, max_sweeps):
+    """ In-place sweeps of the eikonal update over flat indices, see eikonal_sweep(). """
+    T = np.zeros(size, np.float32)
+    npair = pairs.shape[0]
+    npix = idx.shape[0]
+    sum_a = np.zeros(npair)
+    radicand = np.zeros(npair)
+    norder = 2*orders.shape[0]
+    for s in range(max_sweeps):
+        change = 0.
+        order = orders[(s % norder)//2]
+        for m in range(npix):
+            j = order[m] if s%2==0 else order[npix-1-m]
+            c = idx[j]
+            phi_total = 1.
+            k = 0
+            while k < npair:
+                # update_torch() on the pair minima of this group, non-neighbors count as 0
+                g = group[k]
+                f2 = fact[g]**2
+                n = 0
+                count = 0
+                s1 = 0.
+                s2 = 0.
+                while k < npair and group[k] == g:
+                    k0, k1 = pairs[k,0], pairs[k,1]
+                    a0 = T[c+offsets[k0]] if (valid[k0//32,j] >> (k0%32)) & 1 else 0.
+                    a1 = T[c+offsets[k1]] if (valid[k1//32,j] >> (k1%32)) & 1 else 0.
+                    a = min(a0,a1)
+                    s1 += a
+                    s2 += a**2
+                    sum_a[n] = s1
+                    radicand[n] = s1**2-(n+1)*(s2-f2)
+                    if radicand[n] >= 0:
+                        count += 1
+                    n += 1
+                    k += 1
+                phi_total *= (1/count)*(sum_a[count-1]+np.sqrt(radicand[count-1]))
+            new = np.float32(phi_total**(1/d))
+            change = max(change, abs(new-T[c]))
+            T[c] = new
+        if change < tol:
+            break
+    return T
+
 def update_torch(a,f):
     # Turns out we can just avoid a ton of individual if/else by evaluating the update function
     # for every upper limit on the sorted pairs. I do this by pieces using cumsum. The radicand
@@ -539,7 +802,8 @@ def compute_masks(dP, dist, bd=None, p=None, inds=None, niter=200, rescale=1.0,
                   mask_threshold=0.0, diam_threshold=12.,flow_threshold=0.4, 
                   interp=True, cluster=False, do_3D=False, min_size=None, omni=True, 
                   calc_trace=False, verbose=False, use_gpu=False, device=None, nclasses=3, 
-                  dim=2, eps=None, hdbscan=False, flow_factor=6, debug=False):
+                  dim=2, eps=None, hdbscan=False, flow_factor=6, approx_percentile=False, debug=False, 
+                  mask=None, flow_per_object=False, flow_jobs=None, div_range=None):
     """
     Compute masks using dynamics from dP, dist, and boundary outputs.
     
@@ -566,6 +830,11 @@ def compute_masks(dP, dist, bd=None, p=None, inds=None, niter=200, rescale=1.0,
         all pixels with value above threshold kept for masks, decrease to find more and larger masks 
     flow_threshold: float 
         flow error threshold (all cells with errors below threshold are kept) (not used for Cellpose3D)
+    flow_per_object: bool
+        compute the flows of the masks for the flow error object by object (faster, but the 
+        reference flows are not identical to the whole-image ones), see flow_error()
+    flow_jobs: int
+        number of threads for the per-object flow error (ThreadPoolExecutor default if None)
     interp: bool 
         interpolate during dynamics
     cluster: bool
@@ -594,8 +863,14 @@ def compute_masks(dP, dist, bd=None, p=None, inds=None, niter=200, rescale=1.0,
         use better, but much SLOWER, hdbscan clustering algorithm (experimental)
     flow_factor:
         multiple to increase flow magnitdue (used in 3D only, experimental)
+    approx_percentile: bool
+        estimate the divergence percentiles in div_rescale from a subsample (faster on large images)
+    div_range: tuple
+        fixed (low, high) divergence normalization for div_rescale instead of the percentiles
     debug:
         option to return list of unique mask labels as a fourth output (for debugging only)
+    mask: bool, ND array
+        foreground mask that goes with inds, skips the thresholding of dist when both are given 
 
     Returns
     -------------
@@ -620,20 +895,8 @@ def compute_masks(dP, dist, bd=None, p=None, inds=None, niter=200, rescale=1.0,
         if omni and (not SKIMAGE_ENABLED):
              omnipose_logger.warning('Omni enabled but skimage not enabled')
     
-    # inds very useful for debugging and figures; allows us to easily specify specific indices for Euler integration
-    if inds is not None:
-        mask = np.zeros_like(dist,dtype=np.int32)
-        # print('info', mask.shape, inds.shape)
-        mask[tuple(inds)] = 1
-    else:
-        if omni and SKIMAGE_ENABLED:
-            if verbose:
-                omnipose_logger.info('Using hysteresis threshold.')
-            mask = filters.apply_hysteresis_threshold(dist, mask_threshold-1, mask_threshold) # good for thin features
-            inds = np.array(np.nonzero(mask)).astype(np.int32)
-        else:
-            mask = dist > mask_threshold # analog to original iscell=(cellprob>cellprob_threshold)
-            inds = np.array(np.nonzero(np.abs(dP[0])>1e-3)).astype(np.int32) ### that dP[0] is a big bug... only first component!!!
+    if mask is None or inds is None:
+        mask, inds = _dynamics_mask(dP, dist, inds, mask_threshold, omni=omni, verbose=verbose)
     if np.any(mask): #mask at this point is a cell cluster binary map, not labels 
         # the clustering algorithm requires far fewer iterations because it 
         # can handle subpixel separation to define blobs, wheras the thresholding method
@@ -642,31 +905,12 @@ def compute_masks(dP, dist, bd=None, p=None, inds=None, niter=200, rescale=1.0,
             # niter = get_niter(dist)
             # niter = int(dist_to_diam(dist[dist>0],n=mask.ndim))
             niter = int(diameters(mask,dist))
-        #preprocess flows
-        if omni and OMNI_INSTALLED:
-            if bd is None:
-                bd = np.ones_like(mask).astype(np.float)
-            
-            # the interpolated version of div_rescale is detrimental in 3D
-            # the problem is thin sections where the
-            if 1:#dim==2:
-                dP_ = div_rescale(dP,mask) / rescale ##### omnipose.core.div_rescale
-            else:
-                dP_ = utils.normalize_field(dP)
-            # print('rescaling with boundary output')
-            # dP_ = bd_rescale(dP,mask, 4*bd) / rescale ##### omnipose.core.div_rescale
-
-            # dP_ = dP.copy()
-            if dim>2:
-                dP_ *= flow_factor
-                print('dP_ times {} for >2d, still experimenting'.format(flow_factor))
-
-        else:
-            dP_ = dP * mask / 5.
-        
         
         # follow flows
         if p is None:
+            dP_ = _dynamics_flow(dP, mask, rescale=rescale, omni=omni, dim=dim, 
+                                 flow_factor=flow_factor, approx_percentile=approx_percentile, 
+                                 div_range=div_range)
             p, inds, tr = follow_flows(dP_, inds, niter=niter, interp=interp,
                                        use_gpu=use_gpu, device=device, omni=omni,
                                        calc_trace=calc_trace)
@@ -676,30 +920,12 @@ def compute_masks(dP, dist, bd=None, p=None, inds=None, niter=200, rescale=1.0,
             if verbose:
                 omnipose_logger.info('p given')
                 
-        #calculate masks
-        if omni and OMNI_INSTALLED:
-            mask, labels = get_masks(p,bd,dist,mask,inds,nclasses,cluster=cluster,
-                             diam_threshold=diam_threshold,verbose=verbose, 
-                             eps=eps, hdbscan=hdbscan) ##### omnipose.core.get_masks
-        else:
-            mask = get_masks_cp(p, iscell=mask, flows=dP, use_gpu=use_gpu) ### just get_masks
-        # flow thresholding factored out of get_masks
-        if not do_3D: 
-            shape0 = p.shape[1:]
-            flows = dP
-            if mask.max()>0 and flow_threshold is not None and flow_threshold > 0 and flows is not None:
-                mask = remove_bad_flow_masks(mask, flows, threshold=flow_threshold, use_gpu=use_gpu, device=device, omni=omni)
-                _,mask = np.unique(mask, return_inverse=True)
-                mask = np.reshape(mask, shape0).astype(np.int32)
-        
-        if resize is not None:
-            if verbose:
-                omnipose_logger.info(f'resizing output with resize = {resize}')
-            # mask = resize_image(mask, resize[0], resize[1], interpolation=cv2.INTER_NEAREST).astype(np.int32) 
-            mask = zoom(mask, resize/np.array(mask.shape), order=0).astype(np.int32) 
-        mask = fill_holes_and_remove_small_masks(mask, min_size=min_size, dim=dim) ##### utils.fill_holes_and_remove_small_masks
-        # print('warning, temp disable remove small masks')
-        fastremap.renumber(mask,in_place=True) #convenient to guarantee non-skipped labels
+        mask, labels = _finish_masks(p, dP, bd, dist, mask, inds, nclasses=nclasses, resize=resize,
+                                     diam_threshold=diam_threshold, flow_threshold=flow_threshold,
+                                     cluster=cluster, do_3D=do_3D, min_size=min_size, omni=omni,
+                                     verbose=verbose, use_gpu=use_gpu, device=device, dim=dim, 
+                                     eps=eps, hdbscan=hdbscan, flow_per_object=flow_per_object, 
+                                     flow_jobs=flow_jobs)
     else: # nothing to compute, just make it compatible
         omnipose_logger.info('No cell pixels found.')
         p = np.zeros([2,1,1])
@@ -716,6 +942,430 @@ def compute_masks(dP, dist, bd=None, p=None, inds=None, niter=200, rescale=1.0,
         return mask, p, tr
 
 
+def compute_masks_batch(dP, dist, bd=None, niter=200, rescale=1.0, resize=None, 
+                        mask_threshold=0.0, interp=True, cluster=False, omni=True, 
+                        calc_trace=False, use_gpu=False, device=None, dim=2, flow_factor=6, 
+                        approx_percentile=False, batch_size=None, n_jobs=None, tqdm_out=None, verbose=False, 
+                        **kwargs):
+    """
+    Run compute_masks() on a stack of same-size images with batched Euler integration. 
+    
+    The flows of each batch of images are integrated together, using the batch dimension of 
+    grid_sample so that every step is a single call for the whole batch (images with a different 
+    number of foreground pixels are padded with dummy points). Mask reconstruction and cleanup then 
+    run per image in a thread pool. The output is the same as calling compute_masks() on each image. 
+    
+    Parameters
+    -------------
+    dP: float, ND array
+        flow field components of each image (N x 2 x Ly x Lx or N x 3 x Lz x Ly x Lx)
+    dist: float, ND array
+        distance field of each image (N x Ly x Lx)
+    bd: float, ND array
+        boundary field of each image (N x Ly x Lx), optional
+    niter: int32
+        number of iterations of dynamics to run
+    batch_size: int
+        number of images to prepare, integrate and reconstruct at a time (all of them if None); 
+        the preprocessed flows and pixel locations of one batch are held in memory at once
+    n_jobs: int
+        number of threads for the per-image mask reconstruction (default is one per CPU)
+    tqdm_out: file-like
+        where to write a progress bar over the images (e.g. utils.TqdmToLogger), none if None
+    kwargs: 
+        any other compute_masks() parameters, e.g. flow_threshold, min_size, nclasses
+    
+    Returns
+    -------------
+    masks: list of int ND arrays
+        label matrix of each image
+    p: list of float32 ND arrays
+        final locations of each pixel after dynamics
+    tr: list
+        intermediate locations of each pixel during dynamics (only with calc_trace)
+        
+    """
+    common = dict(rescale=rescale, resize=resize, mask_threshold=mask_threshold, interp=interp, 
+                  cluster=cluster, omni=omni, use_gpu=use_gpu, device=device, dim=dim, 
+                  flow_factor=flow_factor, approx_percentile=approx_percentile, verbose=verbose, **kwargs)
+    nimg = len(dP)
+    bds = [None]*nimg if bd is None else bd
+    n_jobs = os.cpu_count() if n_jobs is None else n_jobs
+    
+    # traces and the non-interpolated steps are per-image only 
+    if calc_trace or not interp:
+        outputs = [compute_masks(dP[i], dist[i], bds[i], niter=niter, calc_trace=calc_trace, **common) 
+                   for i in range(nimg)]
+        return tuple([list(o) for o in zip(*outputs)]) if nimg else ([], [], [])
+    
+    def prep(i):
+        mask, inds = _dynamics_mask(dP[i], dist[i], None, mask_threshold, omni=omni, verbose=verbose)
+        if not np.any(mask):
+            return mask, inds, None, niter
+        n = int(diameters(mask,dist[i])) if cluster else int(niter)
+        dP_ = _dynamics_flow(dP[i], mask, rescale=rescale, omni=omni, dim=dim, 
+                             flow_factor=flow_factor, approx_percentile=approx_percentile)
+        return mask, inds, dP_, n
+    
+    def finish(i, prepped, p):
+        mask, inds, dP_, n = prepped
+        if p is None:
+            # nothing to integrate, let compute_masks handle the empty cases 
+            return compute_masks(dP[i], dist[i], bds[i], niter=niter, **common)
+        return compute_masks(dP[i], dist[i], bds[i], p=p, inds=inds, mask=mask, niter=n, **common)[:2]+([],)
+    
+    # the workers already run in parallel, so the per-object flow error of each one gets a single thread
+    common.setdefault('flow_jobs', 1)
+    batch_size = nimg if batch_size is None else max(1,int(batch_size))
+    outputs = []
+    bar = tqdm(total=nimg, file=tqdm_out) if tqdm_out is not None else None
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        # only one batch of flows and pixel locations is held at a time 
+        for start in range(0, nimg, batch_size):
+            idx = list(range(start, min(start+batch_size, nimg)))
+            prepped = list(executor.map(prep, idx))
+            
+            # integrate images that share the same number of steps together 
+            p = [None]*len(idx)
+            groups = {}
+            for k,(mask, inds, dP_, n) in enumerate(prepped):
+                if dP_ is not None and inds.ndim == 2 and inds.shape[0] == dP_.shape[0] and inds.shape[1]:
+                    groups.setdefault(n, []).append(k)
+            for n, group in groups.items():
+                flows = np.stack([prepped[k][2] for k in group])
+                pts = [np.array(prepped[k][1], np.float32) for k in group] # starting points are the pixel indices
+                ends = steps_interp_batch(pts, flows, n, use_gpu=use_gpu, device=device, omni=omni)
+                del flows
+                for k, pk in zip(group, ends):
+                    inds = prepped[k][1]
+                    p[k] = np.indices(prepped[k][2].shape[1:], dtype=np.float32)
+                    p[k][(Ellipsis,)+tuple(inds)] = pk
+            
+            for out in executor.map(finish, idx, prepped, p):
+                outputs.append(out)
+                if bar is not None:
+                    bar.update()
+            del prepped, p
+    if bar is not None:
+        bar.close()
+    masks, p, tr = [list(o) for o in zip(*outputs)] if nimg else ([], [], [])
+    return masks, p, tr
+
+def compute_masks_series(dP, dist, bd=None, niter=200, rescale=1.0, resize=None, 
+                         mask_threshold=0.0, interp=True, cluster=False, omni=True, 
+                         calc_trace=False, use_gpu=False, device=None, dim=2, flow_factor=6, 
+                         approx_percentile=False, warm_tol=0.1, warm_niter=10, warm_fraction=0.5,
+                         tqdm_out=None, verbose=False, **kwargs):
+    """
+    Run compute_masks() on the frames of a time series, warm-starting the dynamics from the previous frame. 
+    
+    Consecutive frames of a time-lapse are usually nearly identical, so most pixels end up where they 
+    did in the last frame. Pixels that were foreground in the previous frame and whose (rescaled) flow 
+    changed by less than warm_tol, both at the pixel and at its previous final location, start from 
+    that location and only get warm_niter refinement steps, continuing the step_factor() schedule 
+    from niter so that they are not kicked away from the fixed point by a full-size first step. The other pixels are integrated from scratch with niter steps. If less than 
+    warm_fraction of the foreground pixels can be warm-started, the frame is considered to have 
+    changed and is integrated from scratch entirely. 
+    
+    Parameters
+    -------------
+    dP: float, ND array
+        flow field components of each frame (T x 2 x Ly x Lx or T x 3 x Lz x Ly x Lx)
+    dist: float, ND array
+        distance field of each frame (T x Ly x Lx)
+    bd: float, ND array
+        boundary field of each frame (T x Ly x Lx), optional
+    niter: int32
+        number of iterations of dynamics to run for pixels that are not warm-started
+    warm_tol: float
+        maximum change of the flow (in pixels per step) for a pixel to be warm-started
+    warm_niter: int
+        number of refinement steps for warm-started pixels
+    warm_fraction: float
+        minimum fraction of warm-started pixels, below which the whole frame is integrated from scratch
+    tqdm_out: file-like
+        where to write a progress bar over the frames (e.g. utils.TqdmToLogger), none if None
+    kwargs: 
+        any other compute_masks() parameters, e.g. flow_threshold, min_size, nclasses
+    
+    Returns
+    -------------
+    masks: list of int ND arrays
+        label matrix of each frame
+    p: list of float32 ND arrays
+        final locations of each pixel after dynamics
+    tr: list
+        intermediate locations of each pixel during dynamics (only with calc_trace)
+        
+    """
+    common = dict(rescale=rescale, resize=resize, mask_threshold=mask_threshold, interp=interp, 
+                  cluster=cluster, omni=omni, use_gpu=use_gpu, device=device, dim=dim, 
+                  flow_factor=flow_factor, approx_percentile=approx_percentile, verbose=verbose, **kwargs)
+    nimg = len(dP)
+    bds = [None]*nimg if bd is None else bd
+    
+    # traces, the non-interpolated steps and clustering (adaptive niter) are per-frame only 
+    if calc_trace or not interp or cluster:
+        outputs = [compute_masks(dP[i], dist[i], bds[i], niter=niter, calc_trace=calc_trace, **common) 
+                   for i in range(nimg)]
+        return tuple([list(o) for o in zip(*outputs)]) if nimg else ([], [], [])
+    
+    masks, p, tr = [], [], []
+    prev = None # mask, flow and final pixel locations of the last frame
+    nwarm = 0
+    for i in (range(nimg) if tqdm_out is None else trange(nimg, file=tqdm_out)):
+        mask, inds = _dynamics_mask(dP[i], dist[i], None, mask_threshold, omni=omni, verbose=verbose)
+        if not np.any(mask) or inds.ndim < 2 or inds.shape[0] != dP[i].shape[0]:
+            # nothing to integrate, let compute_masks handle the empty cases 
+            outputs = compute_masks(dP[i], dist[i], bds[i], niter=niter, **common)
+            prev = None
+        else:
+            dP_ = _dynamics_flow(dP[i], mask, rescale=rescale, omni=omni, dim=dim, 
+                                 flow_factor=flow_factor, approx_percentile=approx_percentile)
+            pi = np.indices(dP_.shape[1:], dtype=np.float32)
+            cold = np.ones(inds.shape[1], bool)
+            if prev is not None and prev[1].shape == dP_.shape:
+                mask0, dP0, p0 = prev
+                # the flow has to be unchanged both where the pixel starts and where it ended up
+                cell_px = (Ellipsis,)+tuple(inds)
+                end = np.rint(p0[cell_px]).astype(np.int64)
+                for k in range(len(end)):
+                    np.clip(end[k], 0, dP_.shape[k+1]-1, out=end[k])
+                end_px = (Ellipsis,)+tuple(end)
+                change = np.maximum(np.sqrt(np.sum((dP_[cell_px]-dP0[cell_px])**2, axis=0)),
+                                    np.sqrt(np.sum((dP_[end_px]-dP0[end_px])**2, axis=0)))
+                warm = np.logical_and(mask0[tuple(inds)]>0, change<=warm_tol)
+                if np.mean(warm) >= warm_fraction:
+                    # continue the step schedule where the last frame left off, not with a full first step
+                    warm_px = (Ellipsis,)+tuple(inds[:,warm])
+                    pi[warm_px] = steps_interp(p0[warm_px], dP_, warm_niter, use_gpu=use_gpu, device=device, 
+                                               omni=omni, t0=int(niter))[0].reshape(len(dP_),-1)
+                    cold = ~warm
+                    nwarm += 1
+            if np.any(cold):
+                cold_px = (Ellipsis,)+tuple(inds[:,cold])
+                pi[cold_px] = steps_interp(pi[cold_px], dP_, int(niter), use_gpu=use_gpu, 
+                                           device=device, omni=omni)[0].reshape(len(dP_),-1)
+            outputs = compute_masks(dP[i], dist[i], bds[i], p=pi, niter=niter, **common)[:2]+([],)
+            prev = (mask, dP_, pi)
+        masks.append(outputs[0])
+        p.append(outputs[1])
+        tr.append(outputs[2])
+    if verbose:
+        omnipose_logger.info(f'warm-started dynamics in {nwarm} of {nimg} frames')
+    return masks, p, tr
+
+def _dynamics_mask(dP, dist, inds=None, mask_threshold=0.0, omni=True, verbose=False):
+    """ Foreground mask and the pixel indices to run dynamics on, see compute_masks(). """
+    # inds very useful for debugging and figures; allows us to easily specify specific indices for Euler integration
+    if inds is not None:
+        mask = np.zeros_like(dist,dtype=np.int32)
+        # print('info', mask.shape, inds.shape)
+        mask[tuple(inds)] = 1
+    else:
+        if omni and SKIMAGE_ENABLED:
+            if verbose:
+                omnipose_logger.info('Using hysteresis threshold.')
+            mask = filters.apply_hysteresis_threshold(dist, mask_threshold-1, mask_threshold) # good for thin features
+            inds = np.array(np.nonzero(mask)).astype(np.int32)
+        else:
+            mask = dist > mask_threshold # analog to original iscell=(cellprob>cellprob_threshold)
+            inds = np.array(np.nonzero(np.abs(dP[0])>1e-3)).astype(np.int32) ### that dP[0] is a big bug... only first component!!!
+    return mask, inds
+
+def _dynamics_flow(dP, mask, rescale=1.0, omni=True, dim=2, flow_factor=6, approx_percentile=False, 
+                   div_range=None):
+    """ Preprocess the network flow for Euler integration, see compute_masks(). """
+    if omni and OMNI_INSTALLED:
+        # the interpolated version of div_rescale is detrimental in 3D
+        # the problem is thin sections where the
+        if 1:#dim==2:
+            dP_ = div_rescale(dP,mask,approx_percentile,div_range) / rescale ##### omnipose.core.div_rescale
+        else:
+            dP_ = utils.normalize_field(dP)
+        # print('rescaling with boundary output')
+        # dP_ = bd_rescale(dP,mask, 4*bd) / rescale ##### omnipose.core.div_rescale
+
+        # dP_ = dP.copy()
+        if dim>2:
+            dP_ *= flow_factor
+            print('dP_ times {} for >2d, still experimenting'.format(flow_factor))
+    else:
+        dP_ = dP * mask / 5.
+    return dP_
+
+def _finish_masks(p, dP, bd, dist, mask, inds, nclasses=3, resize=None, diam_threshold=12., 
+                  flow_threshold=0.4, cluster=False, do_3D=False, min_size=15, omni=True, 
+                  verbose=False, use_gpu=False, device=None, dim=2, eps=None, hdbscan=False, 
+                  flow_per_object=False, flow_jobs=None):
+    """ Labels from the final pixel locations p, flow QC and cleanup, see compute_masks(). """
+    labels = None
+    #calculate masks
+    if omni and OMNI_INSTALLED:
+        if bd is None:
+            bd = np.ones_like(mask).astype(np.float)
+        mask, labels = get_masks(p,bd,dist,mask,inds,nclasses,cluster=cluster,
+                         diam_threshold=diam_threshold,verbose=verbose, 
+                         eps=eps, hdbscan=hdbscan) ##### omnipose.core.get_masks
+    else:
+        mask = get_masks_cp(p, iscell=mask, flows=dP, use_gpu=use_gpu) ### just get_masks
+    # flow thresholding factored out of get_masks
+    if not do_3D: 
+        shape0 = p.shape[1:]
+        flows = dP
+        if mask.max()>0 and flow_threshold is not None and flow_threshold > 0 and flows is not None:
+            mask = remove_bad_flow_masks(mask, flows, threshold=flow_threshold, use_gpu=use_gpu, device=device, omni=omni,
+                                         per_object=flow_per_object, n_jobs=flow_jobs)
+            _,mask = np.unique(mask, return_inverse=True)
+            mask = np.reshape(mask, shape0).astype(np.int32)
+    
+    if resize is not None:
+        if verbose:
+            omnipose_logger.info(f'resizing output with resize = {resize}')
+        # mask = resize_image(mask, resize[0], resize[1], interpolation=cv2.INTER_NEAREST).astype(np.int32) 
+        mask = zoom(mask, resize/np.array(mask.shape), order=0).astype(np.int32) 
+    mask = fill_holes_and_remove_small_masks(mask, min_size=min_size, dim=dim) ##### utils.fill_holes_and_remove_small_masks
+    # print('warning, temp disable remove small masks')
+    fastremap.renumber(mask,in_place=True) #convenient to guarantee non-skipped labels
+    return mask, labels
+
+
+def compute_masks_chunked(dP, dist, bd=None, chunk_size=2048, halo=None, n_jobs=1, 
+                          resize=None, return_p=True, verbose=False, **kwargs):
+    """
+    Run compute_masks() on overlapping blocks of a large 2D image and stitch the labels. 
+    
+    The image is split into a grid of core tiles of size chunk_size, and each tile is extended 
+    by a halo (twice the cell diameter estimated from dist by default) so that every cell whose 
+    centroid falls in a core is complete in its block. Each block keeps the cells centered in its 
+    core; a cell that overlaps a cell already placed by a neighbouring block by more than half 
+    of the smaller one is treated as the same cell and dropped, otherwise it only claims free 
+    pixels. Peak memory is set by the block size instead of the image size. 
+    
+    The divergence normalization of div_rescale() is taken once over the whole image (from the 
+    cores of all blocks, strided down to ~1M pixels on large images) so that every block scales 
+    its flows the same way. Blocks are processed in order with at most 2*n_jobs of them in flight. 
+    
+    Parameters
+    -------------
+    dP: float, 3D array
+        flow field components (2 x Ly x Lx)
+    dist: float, 2D array
+        distance field (Ly x Lx)
+    bd: float, 2D array
+        boundary field
+    chunk_size: int
+        size of the core tiles (at least four halos)
+    halo: int
+        overlap added around each core; estimated from dist if None
+    n_jobs: int
+        number of blocks to reconstruct in parallel threads
+    resize: int, tuple
+        shape of the output mask (alternative to rescaling), applied after stitching
+    return_p: bool
+        assemble the full-size final pixel locations; without it no image-size float array is allocated
+    verbose: bool 
+        turn on additional output to logs for debugging 
+    kwargs: 
+        any other compute_masks() parameters, e.g. niter, mask_threshold, flow_threshold, omni
+    
+    Returns
+    -------------
+    mask: int32, 2D array
+        label matrix
+    p: float32, 3D array
+        final locations of each pixel after dynamics [2 x Ly x Lx] (None without return_p)
+    tr: list
+        empty, traces are not supported in chunked mode
+        
+    """
+    if dist.ndim != 2:
+        raise ValueError('compute_masks_chunked only supports 2D images, got shape {}'.format(dist.shape))
+    shape = dist.shape
+    n_jobs = os.cpu_count() if n_jobs is None else max(1,int(n_jobs))
+    if halo is None:
+        fg = dist[dist>kwargs.get('mask_threshold',0.)]
+        diam = dist_to_diam(fg[::max(1,fg.size>>20)],n=dist.ndim) if fg.size else 30.
+        halo = int(np.ceil(2*diam))
+    chunk_size = max(int(chunk_size), 4*halo)
+    if verbose:
+        omnipose_logger.info('Computing masks in blocks of {} with a halo of {}'.format(chunk_size, halo))
+    
+    blocks = []
+    for y0 in range(0, shape[0], chunk_size):
+        for x0 in range(0, shape[1], chunk_size):
+            core = (slice(y0, min(y0+chunk_size,shape[0])), slice(x0, min(x0+chunk_size,shape[1])))
+            block = tuple([slice(max(c.start-halo,0), min(c.stop+halo,L)) for c,L in zip(core,shape)])
+            blocks.append((core, block))
+    
+    def in_order(fn):
+        # like executor.map over the blocks, but only a bounded window of them is submitted
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            pending = collections.deque()
+            for b in blocks:
+                pending.append(executor.submit(fn, *b))
+                if len(pending) >= 2*n_jobs:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    
+    stride = max(1, dist.size>>20)
+    def block_divergence(core, block):
+        sub = dP[(Ellipsis,)+block]
+        fg, _ = _dynamics_mask(sub, dist[block], None, kwargs.get('mask_threshold',0.), 
+                               omni=kwargs.get('omni',True))
+        div = _unit_divergence(sub, fg)[1].reshape(fg.shape)
+        inner = tuple([slice(c.start-b.start, c.stop-b.start) for c,b in zip(core,block)])
+        return div[inner].ravel()[::stride]
+    
+    if kwargs.get('omni',True) and OMNI_INSTALLED and kwargs.get('div_range') is None:
+        sample = np.concatenate(list(in_order(block_divergence)))
+        kwargs['div_range'] = np.percentile(sample, (0.01, 99.99)).astype(np.float32) # as in div_rescale
+    
+    def run_block(core, block):
+        return compute_masks(dP[(Ellipsis,)+block], dist[block], 
+                             bd=None if bd is None else bd[block], verbose=verbose, **kwargs)[:2]
+    
+    mask = np.zeros(shape, np.int32)
+    p = np.indices(shape, dtype=np.float32) if return_p else None
+    areas = [0] # pixel count of each stitched label
+    for (core, block), (labels, pb) in zip(blocks, in_order(run_block)):
+        offset = np.array([s.start for s in block])
+        inner = tuple([slice(c.start-o, c.stop-o) for c,o in zip(core,offset)])
+        if return_p and pb.shape[1:] == labels.shape:
+            p[(Ellipsis,)+core] = pb[(Ellipsis,)+inner] + offset.reshape(-1,1,1)
+        n = labels.max()
+        if n == 0:
+            continue
+        
+        # keep the cells centered in the core
+        index = np.arange(1,n+1)
+        centers = np.array(scipy.ndimage.center_of_mass(labels, labels, index)).reshape(-1,2)
+        keep = np.all([(centers[:,k]>=inner[k].start-0.5) & (centers[:,k]<inner[k].stop-0.5) 
+                       for k in range(2)], axis=0)
+        
+        # drop those already placed by a neighbouring block 
+        out = mask[block]
+        both = (labels>0) & (out>0)
+        if np.any(both):
+            area_new = np.bincount(labels.ravel(), minlength=n+1)
+            pairs, counts = np.unique(labels[both].astype(np.int64)*len(areas)+out[both], return_counts=True)
+            new, old = np.divmod(pairs, len(areas))
+            same = counts > 0.5*np.minimum(area_new[new], np.array(areas)[old])
+            keep[new[same]-1] = False
+        
+        lut = np.zeros(n+1, np.int32)
+        lut[1:][keep] = np.arange(len(areas), len(areas)+keep.sum())
+        new_labels = lut[labels]
+        free = (new_labels>0) & (out==0)
+        out[free] = new_labels[free]
+        areas.extend(np.bincount(new_labels[free], minlength=len(areas)+keep.sum())[len(areas):])
+    
+    fastremap.renumber(mask,in_place=True)
+    if resize is not None:
+        mask = zoom(mask, resize/np.array(mask.shape), order=0).astype(np.int32) 
+    return mask, p, []
+
 # Omnipose requires (a) a special suppressed Euler step and (b) a special mask reconstruction algorithm. 
 
 # no reason to use njit here except for compatibility with jitted fuctions that call it 
@@ -733,30 +1383,101 @@ def step_factor(t):
     """
     return (1+t)
 
-def div_rescale(dP,mask):
+def div_rescale(dP,mask,approx_percentile=False,div_range=None):
     """
     Normalize the flow magnitude to rescaled 0-1 divergence. 
     
+    Equivalent to masking dP, normalizing it with utils.normalize_field, and scaling it by 
+    utils.normalize99 of its divergence, but done in a few float32 passes over flat indices 
+    without the intermediate full-size copies. 
+    
     Parameters
     -------------
     dP: float, ND array
         flow field 
     mask: int, ND array
         label matrix
+    approx_percentile: bool
+        estimate the normalization percentiles from a strided subsample (~1M pixels) 
+        instead of the whole divergence map
+    div_range: tuple
+        (low, high) divergence mapped to 0 and 1, instead of the percentiles of this field 
+        (e.g. from the whole image when dP is one block of it, see compute_masks_chunked())
         
     Returns
     -------------
-    dP: float, ND array
+    dP: float32, ND array
         rescaled flow field
     
     """
-    dP = dP.copy()
-    dP *= mask 
-    dP = utils.normalize_field(dP)
-    # div = utils.normalize99(likewise(dP))
-    div = utils.normalize99(divergence(dP))
-    dP *= div
-    return dP
+    u, div = _unit_divergence(dP, mask)
+    if div_range is None:
+        sample = div[::max(1,div.size>>20)] if approx_percentile else div
+        div_range = np.percentile(sample, (0.01, 99.99)).astype(np.float32) # same defaults as utils.normalize99
+    lo, hi = div_range
+    _scale_field(u, div, float(lo), float(hi))
+    return u.reshape(dP.shape)
+
+def _unit_divergence(dP, mask):
+    """ Masked unit flow field [d x npix] and its flat divergence, see div_rescale(). """
+    d = dP.shape[0]
+    shape = dP.shape[1:]
+    u = _masked_unit_field(np.ascontiguousarray(dP, np.float32).reshape(d,-1),
+                           np.ascontiguousarray(mask).reshape(-1)!=0)
+    # divergence, accumulated one axis at a time through (before, axis, after) views
+    div = np.zeros(u.shape[1], np.float32)
+    for i in range(d):
+        view = (int(np.prod(shape[:i])), shape[i], int(np.prod(shape[i+1:])))
+        _add_gradient(u[i].reshape(view), div.reshape(view))
+    return u, div
+
+@njit('float32[:,:](float32[:,:], boolean[:])', parallel=True, nogil=True)
+def _masked_unit_field(dP, mask):
+    """ Masked flow field normalized to unit magnitude, see div_rescale(). """
+    d, n = dP.shape
+    u = np.zeros((d,n), np.float32)
+    for j in prange(n):
+        if mask[j]:
+            mag = np.float32(0)
+            for i in range(d):
+                if not np.isnan(dP[i,j]):
+                    mag += dP[i,j]**2
+            mag = np.sqrt(mag)
+            if mag > 0:
+                for i in range(d):
+                    u[i,j] = dP[i,j]/mag
+    return u
+
+@njit('void(float32[:,:,:], float32[:,:,:])', parallel=True, nogil=True)
+def _add_gradient(f, out):
+    """ Add the derivative of f along its middle axis to out, with the same differences as np.gradient. """
+    a, L, b = f.shape
+    for k in prange(a):
+        for c in range(L):
+            lo = max(c-1,0)
+            hi = min(c+1,L-1)
+            if hi > lo:
+                for j in range(b):
+                    out[k,c,j] += (f[k,hi,j]-f[k,lo,j])/np.float32(hi-lo)
+
+@njit('void(float32[:,:], float32[:], float64, float64)', parallel=True, nogil=True)
+def _scale_field(u, div, lo, hi):
+    """ Multiply the field in place by div mapped linearly from [lo,hi] to [0,1] like np.interp. """
+    d, n = u.shape
+    if hi <= lo: # flat divergence (zero flow or empty mask), nothing to scale by
+        u[:] = 0
+        return
+    slope = 1./(hi-lo)
+    for j in prange(n):
+        x = div[j]
+        if x >= hi:
+            w = 1.
+        elif x <= lo:
+            w = 0.
+        else:
+            w = slope*(x-lo)
+        for i in range(d):
+            u[i,j] *= w
 
 def sigmoid(x):
     """The sigmoid function."""
@@ -786,7 +1507,7 @@ def divergence(f,sp=None):
 
 
 def get_masks(p, bd, dist, mask, inds, nclasses=4,cluster=False,
-              diam_threshold=12., eps=None, hdbscan=False, verbose=False):
+              diam_threshold=12., eps=None, hdbscan=False, sparse=True, verbose=False):
     """Omnipose mask recontruction algorithm.
     
     This function is called after dynamics are run. The final pixel coordinates are provided, 
@@ -816,15 +1537,19 @@ def get_masks(p, bd, dist, mask, inds, nclasses=4,cluster=False,
         internal espilon parameter for (H)DBSCAN
     hdbscan: bool
         use better, but much SLOWER, hdbscan clustering algorithm
+    sparse: bool
+        label the rounded coordinates directly (see sparse_label()) instead of rasterizing
+        them into a full-size skeleton image; output masks are identical
     verbose: bool
         option to print more info to log file
-    
+
     Returns
     -------------
     mask: int, ND array
         label matrix
     labels: int, list
-        all unique labels 
+        all unique labels (per-pixel labels for the clustering and sparse branches,
+        the labelled skeleton image for the dense branch)
     """
     if nclasses >= 4:
         dt = np.abs(dist[mask]) #abs needed if the threshold is negative
@@ -895,7 +1620,14 @@ def get_masks(p, bd, dist, mask, inds, nclasses=4,cluster=False,
 
         ###
         mask[cell_px] = labels+1 # outliers have label -1
-    else: #this branch can have issues near edges 
+    elif sparse: # same result as the dense branch below, but never touches the full image
+        newinds = np.rint(newinds.T).astype(int)
+        split_edges = nclasses == mask.ndim+2 #can use boundary to erase joined edge skelmasks
+        if split_edges and verbose:
+            omnipose_logger.info('Using boundary output to split edge defects')
+        labels = sparse_label(newinds, mask.shape, bd=bd if split_edges else None)
+        mask[cell_px] = labels
+    else: #this branch can have issues near edges
         newinds = np.rint(newinds.T).astype(int)
         new_px = tuple(newinds)
         skelmask = np.zeros_like(dist, dtype=bool)
@@ -928,12 +1660,113 @@ def get_masks(p, bd, dist, mask, inds, nclasses=4,cluster=False,
         omnipose_logger.info('Done finding masks.')
     return mask, labels
 
+def sparse_label(coords, shape, bd=None, border=5):
+    """
+    Label the skeleton formed by a set of integer coordinates without rasterizing it.
+
+    Equivalent to drawing the coordinates into a binary image, optionally erasing the pixels within
+    `border` pixels of the image edge where bd>-1, and running skimage.measure.label with full
+    connectivity. Here the unique coordinates are stored as sorted flat indices (our hash set),
+    neighbors are looked up by binary search over the 3**d stencil, and components are merged by
+    union-find. Cost scales with the number of foreground pixels, not the image size. Labels are
+    numbered in raster order, so the output matches the dense version exactly.
+
+    Parameters
+    -------------
+    coords: int, 2D array
+        integer coordinates [ndim x npixels], must lie inside shape
+    shape: tuple, int
+        shape of the image the coordinates live in
+    bd: float, ND array
+        boundary field; if given, coordinates in the border region where bd>-1 are dropped
+        to disconnect skeletons that merge at the image edge
+    border: int
+        width of the edge region in pixels
+
+    Returns
+    -------------
+    labels: int, 1D array
+        label of each input coordinate, 0 for dropped coordinates
+
+    """
+    d = len(shape)
+    flat = np.ravel_multi_index(tuple(coords), shape)
+    uniq, inverse = np.unique(flat, return_inverse=True)
+    ucoords = np.unravel_index(uniq, shape)
+
+    # the dense version builds its edge region by dilating the image border, which is
+    # simply every pixel less than <border> steps from the edge along some axis
+    if bd is not None:
+        edge = np.zeros(len(uniq), dtype=bool)
+        for c,s in zip(ucoords,shape):
+            edge |= (c<border) | (c>=s-border)
+        keep = ~(edge & (bd[ucoords]>-1))
+    else:
+        keep = np.ones(len(uniq), dtype=bool)
+
+    kept = uniq[keep]
+    kcoords = [c[keep] for c in ucoords]
+
+    # only half the stencil is needed, the other half gives the same pairs in reverse
+    steps = cartesian([[-1,0,1]]*d)
+    steps = steps[:len(steps)//2]
+    strides = np.cumprod((1,)+tuple(shape[:0:-1]))[::-1] # flat index offset of a unit step along each axis
+    src, dst = [], []
+    for step in steps:
+        valid = np.ones(len(kept), dtype=bool)
+        for c,s,k in zip(kcoords,shape,step):
+            valid &= (c+k>=0) & (c+k<s)
+        n = kept[valid] + np.dot(step, strides)
+        j = np.searchsorted(kept, n)
+        j[j==len(kept)] = 0
+        hit = kept[j]==n
+        src.append(np.nonzero(valid)[0][hit])
+        dst.append(j[hit])
+    src = np.concatenate(src).astype(np.int64)
+    dst = np.concatenate(dst).astype(np.int64)
+
+    klabels = _union_find(len(kept), src, dst)
+    labels = np.zeros(len(uniq), dtype=np.int64)
+    labels[keep] = klabels
+    return labels[inverse.ravel()]
+
+@njit('int64[:](int64, int64[:], int64[:])', nogil=True)
+def _union_find(n, src, dst):
+    """ Connected components of n nodes joined by the edges (src,dst). Each component is rooted at
+    its smallest node, so a single ascending pass assigns labels 1,2,... in order of first node. """
+    parent = np.arange(n)
+    for k in range(src.shape[0]):
+        a = src[k]
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        b = dst[k]
+        while parent[b] != b:
+            parent[b] = parent[parent[b]]
+            b = parent[b]
+        if a < b:
+            parent[b] = a
+        elif b < a:
+            parent[a] = b
+    labels = np.zeros(n, np.int64)
+    nlabels = 0
+    for i in range(n):
+        r = i
+        while parent[r] != r:
+            r = parent[r]
+        if r == i:
+            nlabels += 1
+            labels[i] = nlabels
+        else:
+            labels[i] = labels[r]
+    return labels
+
 
 # Generalizing to ND. Again, torch required but should be plenty fast on CPU too compared to jitted but non-explicitly-parallelized CPU code.
 # also should just rescale to desired resolution HERE instead of rescaling the masks later... <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
 # grid_sample will only work for up to 5D tensors (3D segmentation). Will have to address this shortcoming if we ever do 4D. 
 # I got rid of the map_coordinates branch, I tested execution times and pytorch implemtation seems as fast or faster
-def steps_interp(p, dP, niter, use_gpu=True, device=None, omni=True, calc_trace=False, calc_bd=False):
+def steps_interp(p, dP, niter, use_gpu=True, device=None, omni=True, calc_trace=False, calc_bd=False, t0=0):
     """Euler integration of pixel locations p subject to flow dP for niter steps in N dimensions. 
     
     Parameters
@@ -944,6 +1777,8 @@ def steps_interp(p, dP, niter, use_gpu=True, device=None, omni=True, calc_trace=
         flows [axis x Lz x Ly x Lx]
     niter: int32
         number of iterations of dynamics to run
+    t0: int
+        time step to start the step_factor() schedule at, e.g. to refine converged locations
 
     Returns
     ---------------
@@ -996,7 +1831,7 @@ def steps_interp(p, dP, niter, use_gpu=True, device=None, omni=True, calc_trace=
         # r = torch.zeros_like(p)
 
     #here is where the stepping happens 
-    for t in range(niter):
+    for t in range(t0, t0+niter):
         if calc_trace:
             trace = torch.cat((trace,pt))
             # trace[t] = pt.detach()
@@ -1051,6 +1886,70 @@ def steps_interp(p, dP, niter, use_gpu=True, device=None, omni=True, calc_trace=
     # print('Execution time in seconds: ' + str(executionTime))
     return p, tr
 
+def steps_interp_batch(p, dP, niter, use_gpu=True, device=None, omni=True):
+    """Euler integration of the pixel locations of a stack of same-size images, see steps_interp(). 
+    
+    All images are stepped together through the batch dimension of grid_sample. 
+    The point lists are padded to the longest one, and the padding is dropped at the end. 
+    
+    Parameters
+    ----------------
+    p: list of float32, 2D arrays
+        pixel locations of each image [axis x npix] 
+    dP: float32, ND array
+        flows of each image [N x axis x Lz x Ly x Lx]
+    niter: int32
+        number of iterations of dynamics to run
+
+    Returns
+    ---------------
+    p: list of float32, 2D arrays
+        final locations of each pixel after dynamics [axis x npix]
+
+    """
+    align_corners = True
+    mode = 'bilinear'
+    N, d = dP.shape[:2]
+    inds = list(range(d))[::-1] # grid_sample requires a particular ordering 
+    if device is None:
+        if use_gpu:
+            device = torch_GPU
+        else:
+            device = torch_CPU
+    shape = np.array(dP.shape[2:])[inds]-1.
+    
+    npix = [pi.shape[1] for pi in p]
+    P = max(npix)
+    pts = np.zeros((N,P,d)) # padded points sit at the origin and are independent of the rest
+    for i,pi in enumerate(p):
+        pts[i,:npix[i]] = pi[inds].T
+    pt = torch.from_numpy(pts).to(device).reshape((N,)+(1,)*(d-1)+(P,d))
+    flow = torch.from_numpy(dP[:,inds]).double().to(device)
+    
+    # same normalization and stepping as steps_interp
+    for k in range(d): 
+        pt[...,k] = 2*pt[...,k]/shape[k] - 1
+        flow[:,k] = 2*flow[:,k]/shape[k]
+    
+    if omni and OMNI_INSTALLED:
+        dPt0 = torch.nn.functional.grid_sample(flow, pt, mode=mode, align_corners=align_corners)
+
+    for t in range(niter):
+        dPt = torch.nn.functional.grid_sample(flow, pt, mode=mode, align_corners=align_corners)
+        if omni and OMNI_INSTALLED:
+            dPt = (dPt+dPt0) / 2. # average with previous flow 
+            dPt0 = dPt.clone() # update old flow 
+            dPt /= step_factor(t) # suppression factor 
+        for k in range(d): #clamp the final pixel locations
+            pt[...,k] = torch.clamp(pt[...,k] + dPt[:,k], -1., 1.)
+    
+    pt = (pt+1)*0.5
+    for k in range(d): 
+        pt[...,k] *= shape[k]
+    
+    pt = pt[...,inds].cpu().numpy().reshape(N,P,d)
+    return [pt[i,:npix[i]].T for i in range(N)]
+
 @njit('(float32[:,:,:,:],float32[:,:,:,:], int32[:,:], int32)', nogil=True)
 def steps3D(p, dP, inds, niter):
     """ Run dynamics of pixels to recover masks in 3D.
@@ -1198,7 +2097,8 @@ def follow_flows(dP, inds, niter=200, interp=True, use_gpu=True,
         p[cell_px] = p_interp
     return p, inds, tr
 
-def remove_bad_flow_masks(masks, flows, threshold=0.4, use_gpu=False, device=None, omni=True):
+def remove_bad_flow_masks(masks, flows, threshold=0.4, use_gpu=False, device=None, omni=True, 
+                          per_object=False, cache=None, n_jobs=None):
     """ remove masks which have inconsistent flows 
     
     Uses metrics.flow_error to compute flows from predicted masks 
@@ -1214,6 +2114,12 @@ def remove_bad_flow_masks(masks, flows, threshold=0.4, use_gpu=False, device=Non
         flows [axis x Ly x Lx] or [axis x Lz x Ly x Lx]
     threshold: float
         masks with flow error greater than threshold are discarded
+    per_object: bool
+        compute the mask flows object by object, see flow_error()
+    cache: dict
+        optional store of per-object flows that is reused across calls, see flow_error()
+    n_jobs: int
+        number of threads for the per-object flow computation
 
     Returns
     ---------------
@@ -1223,12 +2129,14 @@ def remove_bad_flow_masks(masks, flows, threshold=0.4, use_gpu=False, device=Non
         size [Ly x Lx] or [Lz x Ly x Lx]
     
     """
-    merrors, _ =  flow_error(masks, flows, use_gpu, device, omni) ##### metrics.flow_error
+    merrors, _ =  flow_error(masks, flows, use_gpu, device, omni, 
+                             per_object=per_object, cache=cache, n_jobs=n_jobs) ##### metrics.flow_error
     badi = 1+(merrors>threshold).nonzero()[0]
     masks[np.isin(masks, badi)] = 0
     return masks
 
-def flow_error(maski, dP_net, use_gpu=False, device=None, omni=True):
+def flow_error(maski, dP_net, use_gpu=False, device=None, omni=True, 
+               per_object=False, return_flows=False, cache=None, cache_size=4096, n_jobs=None):
     """ error in flows from predicted masks vs flows predicted by network run on image
 
     This function serves to benchmark the quality of masks, it works as follows
@@ -1238,6 +2146,13 @@ def flow_error(maski, dP_net, use_gpu=False, device=None, omni=True):
     If there is a discrepancy between the flows, it suggests that the mask is incorrect.
     Masks with flow_errors greater than 0.4 are discarded by default. Setting can be
     changed in Cellpose.eval or CellposeModel.eval.
+    
+    With per_object, the flows of each mask are solved inside its (reflection-padded) bounding box
+    instead of over the whole image, so small cells no longer iterate as long as the largest one. 
+    Objects are processed in a thread pool. Only Omnipose flows of 2D masks are handled this way; 
+    Cellpose flows and 3D masks always use the whole-image computation. The per-object flows are 
+    close to, but not identical with, the whole-image ones (see masks_to_flows_torch()), so the 
+    errors can differ slightly; the whole-image computation stays the default. 
 
     Parameters
     ------------
@@ -1246,13 +2161,24 @@ def flow_error(maski, dP_net, use_gpu=False, device=None, omni=True):
         where 0=NO masks; 1,2... are mask labels
     dP_net: ND-array (float) 
         ND flows where dP_net.shape[1:] = maski.shape
+    per_object: bool
+        compute flows per object instead of over the whole image
+    return_flows: bool
+        also assemble and return the full-size mask flows (always returned without per_object)
+    cache: dict
+        per-object flows keyed by the cropped mask, filled and reused across calls so that 
+        unchanged objects (e.g. in consecutive frames) are not recomputed
+    cache_size: int
+        maximum number of objects kept in cache, the least recently used ones are dropped first
+    n_jobs: int
+        number of threads for the per-object computation (ThreadPoolExecutor default if None)
 
     Returns
     ------------
     flow_errors: float array with length maski.max()
         mean squared error between predicted flows and flows from masks
     dP_masks: ND-array (float)
-        ND flows produced from the predicted masks
+        ND flows produced from the predicted masks (None if per_object and not return_flows)
     
     """
     if dP_net.shape[1:] != maski.shape:
@@ -1262,6 +2188,11 @@ def flow_error(maski, dP_net, use_gpu=False, device=None, omni=True):
     # ensure unique masks
     # maski = np.reshape(np.unique(maski.astype(np.float32), return_inverse=True)[1], maski.shape)
     fastremap.renumber(maski,in_place=True)
+    
+    if per_object and omni and OMNI_INSTALLED and maski.ndim==2:
+        return _flow_error_per_object(maski, dP_net, use_gpu=use_gpu, device=device, 
+                                      return_flows=return_flows, cache=cache, cache_size=cache_size, 
+                                      n_jobs=n_jobs)
 
     # flows predicted from estimated masks
     idx = -1 # flows are the last thing returned now
@@ -1273,6 +2204,58 @@ def flow_error(maski, dP_net, use_gpu=False, device=None, omni=True):
                             index=np.arange(1, maski.max()+1))
     return flow_errors, dP_masks
 
+def _flow_error_per_object(maski, dP_net, use_gpu=False, device=None, 
+                           return_flows=False, cache=None, cache_size=4096, n_jobs=None):
+    """ Per-object version of flow_error() for Omnipose flows, maski must already be renumbered. 
+    
+    The labels are reflection-padded exactly as in masks_to_flows(), then each object is cropped to 
+    its bounding box in the padded frame, with one pixel of background around it, and solved alone. 
+    The number of iterations comes from the object's own distance field. 
+    """
+    if device is None:
+        device = torch_GPU if use_gpu else torch_CPU
+    nmask = maski.max()
+    d = maski.ndim
+    shape = np.array(maski.shape)
+    dists = edt.edt(maski,parallel=8)
+    pad = int(diameters(maski,dists)/2)
+    unpad = tuple([slice(pad,-pad) if pad else slice(None,None)]*d)
+    masks_pad = np.pad(utils.get_edge_masks(maski,dists=dists),pad,mode='reflect') 
+    masks_pad[unpad] = maski 
+    slices = find_objects(masks_pad)
+    
+    def object_flow(i):
+        slc = slices[i]
+        # the background margin keeps the distance of masks that fill their bounding box finite 
+        crop = np.pad(masks_pad[slc]==(i+1),1).astype(np.uint8)
+        key = (crop.shape, crop.tobytes())
+        mu = None if cache is None else cache.get(key)
+        if mu is None:
+            mu = masks_to_flows_torch(crop, edt.edt(crop), device=device, omni=True)[0]
+        # keep the pixels of the object that are inside the original image 
+        coords = np.array(np.nonzero(crop))
+        coords_pad = coords - 1 + np.array([s.start for s in slc])[:,np.newaxis]
+        inside = np.all((coords_pad>=pad) & (coords_pad<shape[:,np.newaxis]+pad), axis=0)
+        coords, coords_pad = coords[:,inside], coords_pad[:,inside]
+        return key, mu, mu[(Ellipsis,)+tuple(coords)], tuple(coords_pad-pad)
+    
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        results = list(executor.map(object_flow, range(nmask)))
+    
+    flow_errors = np.zeros(nmask)
+    dP_masks = np.zeros((d,)+maski.shape) if return_flows else None
+    for i,(key,mu_crop,mu,coords) in enumerate(results):
+        #the /5 is to compensate for the *5 we do for training
+        flow_errors[i] = np.mean(np.sum((mu - dP_net[(Ellipsis,)+coords]/5.)**2, axis=0))
+        if return_flows:
+            dP_masks[(Ellipsis,)+coords] = mu
+        if cache is not None:
+            cache.pop(key, None) # reinsert so that the least recently used shapes go first
+            cache[key] = mu_crop
+    if cache is not None:
+        for key in list(cache)[:max(len(cache)-cache_size,0)]:
+            del cache[key]
+    return flow_errors, dP_masks
 
 
 ### Section III: training
@@ -1281,7 +2264,8 @@ def flow_error(maski, dP_net, use_gpu=False, device=None, omni=True):
 # Spacetime segmentation: augmentations need to treat time differently 
 # Need to assume a particular axis is the temporal axis; most convenient is tyx. 
 def random_rotate_and_resize(X, Y=None, scale_range=1., gamma_range=0.5, tyx = (224,224), 
-                             do_flip=True, rescale=None, inds=None, nchan=1):
+                             do_flip=True, rescale=None, inds=None, nchan=1, fg_tables=None, stats=None,
+                             flow_fields=None):
     """ augmentation by random rotation and resizing
 
         X and Y are lists or arrays of length nimg, with channels x Lt x Ly x Lx (channels optional, Lt only in 3D)
@@ -1309,6 +2293,15 @@ def random_rotate_and_resize(X, Y=None, scale_range=1., gamma_range=0.5, tyx = (
             image indices (for debugging)
         nchan: int
             number of channels the images have 
+        fg_tables: list of ND arrays
+            foreground_table() of each label, used to draw crops that contain cells without 
+            warping the labels first (optional)
+        stats: dict
+            if given, the number of 'crops', cheaply rejected crop 'draws' and label warp 'retries' 
+            are added to it, as well as the seconds spent on the flows of the crops ('flow_time')
+        flow_fields: list of ND arrays
+            flow_field() of each label, warped into the crops instead of recomputing the flows 
+            (optional, see warp_flows())
 
         Returns
         -------
@@ -1352,13 +2345,17 @@ def random_rotate_and_resize(X, Y=None, scale_range=1., gamma_range=0.5, tyx = (
         imgi[n], lbl[n], scale[n] = random_crop_warp(img, y, nt, tyx, nchan, scale[n], 
                                                      rescale is None if rescale is None else rescale[n], 
                                                      scale_range, gamma_range, do_flip, 
-                                                     inds is None if inds is None else inds[n], dist_bg)
+                                                     inds is None if inds is None else inds[n], dist_bg,
+                                                     fg_table=None if fg_tables is None else fg_tables[n], 
+                                                     stats=stats,
+                                                     flow_field=None if flow_fields is None else flow_fields[n])
         
     return imgi, lbl, np.mean(scale) #for size training, must output scalar size (need to check this again)
 
 # This function allows a more efficient implementation for recursively checking that the random crop includes cell pixels.
 # Now it is rerun on a per-image basis if a crop fails to capture .1 percent cell pixels (minimum). 
-def random_crop_warp(img, Y, nt, tyx, nchan, scale, rescale, scale_range, gamma_range, do_flip, ind, dist_bg, depth=0):
+def random_crop_warp(img, Y, nt, tyx, nchan, scale, rescale, scale_range, gamma_range, do_flip, ind, dist_bg, depth=0,
+                     fg_table=None, stats=None, flow_field=None):
     """
     This sub-fuction of `random_rotate_and_resize()` recursively performs random cropping until 
     a minimum number of cell pixels are found, then proceeds with augemntations. 
@@ -1390,6 +2387,14 @@ def random_crop_warp(img, Y, nt, tyx, nchan, scale, rescale, scale_range, gamma_
         nonegative value X for assigning -X to where distance=0 (deprecated, now adapts to field values)
     depth: int
         how many time this function has been called on an image 
+    fg_table: ND array
+        foreground_table() of the labels. Crops that cannot hold enough cell pixels according to 
+        the table are redrawn before warping anything (optional)
+    stats: dict
+        crop counters, see random_rotate_and_resize()
+    flow_field: ND array
+        flow_field() of the labels. The smooth distance and flows of the crop are warped from it 
+        instead of recomputed from the warped labels (optional)
 
     Returns
     -------
@@ -1436,23 +2441,36 @@ def random_crop_warp(img, Y, nt, tyx, nchan, scale, rescale, scale_range, gamma_
 
     # generate random augmentation parameters
     dg = gamma_range/2 
-    theta = np.random.rand() * np.pi * 2
-
-    # first two basis vectors in any dimension 
-    v1 = [0]*(dim-1)+[1]
-    v2 = [0]*(dim-2)+[1,0]
-    # M = mgen.rotation_from_angle_and_plane(theta,v1,v2) #not generalizing correctly to 3D? had -theta before  
-    M = mgen.rotation_from_angle_and_plane(-theta,v2,v1).dot(np.diag(scale)) #equivalent
-    # could define v3 and do another rotation here and compose them 
-
-    axes = range(dim)
-    s = img.shape[-dim:]
-    rt = (np.random.rand(dim,) - .5) #random translation -.5 to .5
-    dxy = [rt[a]*(np.maximum(0,s[a]-tyx[a])) for a in axes]
     
-    c_in = 0.5 * np.array(s) + dxy
-    c_out = 0.5 * np.array(tyx)
-    offset = c_in - np.dot(np.linalg.inv(M), c_out)
+    # with a foreground table, redraw the rotation and translation until the crop can contain 
+    # enough cell pixels, which is much cheaper than warping the labels and checking afterwards 
+    for draw in range(100):
+        theta = np.random.rand() * np.pi * 2
+
+        # first two basis vectors in any dimension 
+        v1 = [0]*(dim-1)+[1]
+        v2 = [0]*(dim-2)+[1,0]
+        # M = mgen.rotation_from_angle_and_plane(theta,v1,v2) #not generalizing correctly to 3D? had -theta before  
+        M = mgen.rotation_from_angle_and_plane(-theta,v2,v1).dot(np.diag(scale)) #equivalent
+        # could define v3 and do another rotation here and compose them 
+
+        axes = range(dim)
+        s = img.shape[-dim:]
+        rt = (np.random.rand(dim,) - .5) #random translation -.5 to .5
+        dxy = [rt[a]*(np.maximum(0,s[a]-tyx[a])) for a in axes]
+
+        c_in = 0.5 * np.array(s) + dxy
+        c_out = 0.5 * np.array(tyx)
+        offset = c_in - np.dot(np.linalg.inv(M), c_out)
+        
+        if fg_table is None or Y is None:
+            break
+        # each input pixel lands on at most prod(ceil(scale)+1) output pixels 
+        count = crop_foreground(fg_table, M, offset, tyx, s)
+        if count is None or count*np.prod(np.ceil(scale)+1) >= numpx/10**(dim+1):
+            break
+        if stats is not None:
+            stats['draws'] = stats.get('draws',0) + 1
     
     # M = np.vstack((M,offset))
     mode = 'reflect'
@@ -1470,8 +2488,11 @@ def random_crop_warp(img, Y, nt, tyx, nchan, scale, rescale, scale_range, gamma_
                     # print('toosmall',nt)
                     # skimage.io.imsave('/home/kcutler/DataDrive/debug/img'+str(depth)+'.png',img[0])
                     # skimage.io.imsave('/home/kcutler/DataDrive/debug/training'+str(depth)+'.png',lbl[0])
+                    if stats is not None:
+                        stats['retries'] = stats.get('retries',0) + 1
                     return random_crop_warp(img, Y, nt, tyx, nchan, scale, rescale, scale_range, 
-                                            gamma_range, do_flip, ind, dist_bg, depth=depth+1)
+                                            gamma_range, do_flip, ind, dist_bg, depth=depth+1,
+                                            fg_table=fg_table, stats=stats, flow_field=flow_field)
             else:
                 lbl[k] = do_warp(l, M, tyx, offset=offset, mode=mode)
                 # if k==1:
@@ -1480,8 +2501,15 @@ def random_crop_warp(img, Y, nt, tyx, nchan, scale, rescale, scale_range, gamma_
         # LABELS ARE NOW (masks,mask,bd,dist,weight,flows)
         if nt > 1:
    
+            tflow = time.time()
             l = lbl[0].astype(np.uint16)
-            l, dist, T, mu = masks_to_flows(l,omni=True,dim=dim)
+            if flow_field is None:
+                l, dist, T, mu = masks_to_flows(l,omni=True,dim=dim)
+            else:
+                # boundary and cutoff still come from the warped labels, but those only need the edt 
+                dist = edt.edt(l)
+                T, mu = warp_flows(flow_field, M, tyx, offset, mode=mode)
+                mu *= l>0
             cutoff = diameters(l,dist)/2
             lbl[2] = dist==1 # position 2 stores the boundary field
             smooth_dist = T
@@ -1497,17 +2525,21 @@ def random_crop_warp(img, Y, nt, tyx, nchan, scale, rescale, scale_range, gamma_
             mask = lbl[1] #binary mask 
             bg_edt = edt.edt(mask<0.5,black_border=True) #last arg gives weight to the border, which seems to always lose
             lbl[4] = (gaussian(1-np.clip(bg_edt,0,cutoff)/cutoff, 1)+0.5)
+            if stats is not None:
+                stats['flow_time'] = stats.get('flow_time',0.) + time.time() - tflow
 
 
     # Makes more sense to spend time on image augmentations
     # after the label augmentation succeeds without triggering recursion 
+    if stats is not None:
+        stats['crops'] = stats.get('crops',0) + 1
     imgi  = np.zeros((nchan,)+tyx, np.float32)
+    I = do_warp(img[:nchan], M, tyx, offset=offset, mode=mode) # all channels in one call
     for k in range(nchan): # replace k with slice that handles when nchan=0
-        I = do_warp(img[k], M, tyx, offset=offset, mode=mode)
         
         # gamma agumentation 
         gamma = np.random.uniform(low=1-dg,high=1+dg) 
-        imgi[k] = I ** gamma
+        imgi[k] = I[k] ** gamma
         
         # percentile clipping augmentation 
         dp = 10
@@ -1546,31 +2578,309 @@ def random_crop_warp(img, Y, nt, tyx, nchan, scale, rescale, scale_range, gamma_
         
     return imgi, lbl, scale
 
-def do_warp(A,M,tyx,offset=0,order=1,mode='constant'):#,mode,method):
+def foreground_table(masks, bin_size=8):
+    """ Coarse summed-area table of the foreground of a label matrix, see crop_foreground(). 
+    
+    Parameters
+    --------------
+    masks: ND array, int
+        label matrix
+    bin_size: int
+        edge length of the blocks that the foreground pixels are counted in 
+    
+    Returns
+    --------------
+    table: ND array, int64
+        table[i,j] is the number of foreground pixels in the blocks [:i,:j], 
+        shape is ceil(masks.shape/bin_size)+1
+    
+    """
+    fg = np.asarray(masks)>0
+    fg = np.pad(fg, [(0,-n%bin_size) for n in fg.shape])
+    blocks = []
+    for n in fg.shape:
+        blocks += [n//bin_size, bin_size]
+    counts = fg.reshape(blocks).sum(axis=tuple(range(1,2*fg.ndim,2)))
+    table = np.zeros(tuple(np.array(counts.shape)+1), np.int64)
+    table[(slice(1,None),)*fg.ndim] = counts
+    for a in range(fg.ndim):
+        np.cumsum(table, axis=a, out=table)
+    return table
+
+def crop_foreground(table, M, offset, tyx, shape, bin_size=8):
+    """ Upper bound on the number of foreground pixels under a crop, from a foreground_table(). 
+    
+    The crop is the region that do_warp() samples with matrix M and offset. The foreground is 
+    counted in all the blocks that touch its bounding box. Parts of the box outside of the image 
+    are reflected back in, which at most doubles the count along each axis where that happens. 
+    
+    Parameters
+    --------------
+    table: ND array, int
+        foreground_table() of the labels
+    M: NDarray, float
+        transformation matrix
+    offset: 1D array, float
+        offset of the transformation
+    tyx: tuple, int
+        shape of the crop
+    shape: tuple, int
+        shape of the labels
+    bin_size: int
+        bin_size of the table
+    
+    Returns
+    --------------
+    count: int
+        upper bound on the number of foreground pixels, or None if the crop extends further 
+        than the image size past the image boundary
+    
+    """
+    dim = len(tyx)
+    corners = np.indices((2,)*dim).reshape(dim,-1)
+    pts = np.dot(np.linalg.inv(M), corners*(np.array(tyx)[:,None]-1)) + np.array(offset)[:,None]
+    lo = np.floor(pts.min(axis=1)).astype(int)
+    hi = np.ceil(pts.max(axis=1)).astype(int)
+    shape = np.array(shape)
+    if np.any(lo<-shape) or np.any(hi>=2*shape):
+        return None
+    reflected = np.sum(np.logical_or(lo<0, hi>=shape))
+    lo = np.clip(lo,0,shape-1)//bin_size
+    hi = np.clip(hi,0,shape-1)//bin_size+1
+    # inclusion-exclusion over the corners of the block range 
+    count = 0
+    for c in corners.T:
+        count += (-1)**(dim-np.sum(c)) * table[tuple(np.where(c,hi,lo))]
+    return count * 2**reflected
+
+def flow_field(masks, dim=2, cache_dir=None):
+    """ Smooth distance and flow field of a full label matrix for warp_flows(). 
+    
+    Parameters
+    --------------
+    masks: ND array, int
+        label matrix
+    dim: int
+        dimensionality of the label matrix
+    cache_dir: str
+        directory in which the field is saved under a hash of the labels and loaded from 
+        (memory-mapped) on later calls (optional)
+    
+    Returns
+    --------------
+    field: ND array, float32
+        field[0] is the smooth distance and field[1:] are the flow components, 
+        shape is (1+dim,)+masks.shape
+    
+    """
+    masks = np.ascontiguousarray(masks)
+    if cache_dir is not None:
+        key = hashlib.sha1(masks.tobytes()+str((masks.shape,masks.dtype.str,dim)).encode()).hexdigest()
+        file_name = os.path.join(cache_dir, key+'_flows.npy')
+        if os.path.isfile(file_name):
+            return np.load(file_name, mmap_mode='r')
+        
+    _, _, T, mu = masks_to_flows(masks, omni=True, dim=dim)
+    field = np.concatenate((np.asarray(T)[np.newaxis], mu)).astype(np.float32)
+    
+    if cache_dir is not None:
+        # write and rename so that concurrent runs never see a partial file 
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_name = file_name[:-4]+'_'+str(os.getpid())+'.tmp.npy'
+        np.save(tmp_name, field)
+        os.replace(tmp_name, file_name)
+    return field
+
+def warp_flows(field, M, tyx, offset, mode='reflect'):
+    """ Warp a flow_field() into a crop with the transformation of do_warp(). 
+    
+    The smooth distance is interpolated and scaled by the mean magnification of M. The flow 
+    vectors are interpolated, mirrored where the crop reflects over the image edge, 
+    mapped through M and renormalized. Values straddling object boundaries are blends of 
+    neighboring objects; flow_warp_error() measures the difference to recomputing the flows 
+    from the warped labels. 
+    
+    Parameters
+    --------------
+    field: ND array, float
+        output of flow_field()
+    M: NDarray, float
+        tranformation matrix
+    tyx: tuple, int
+        shape of the crop
+    offset: NDarray, float
+        offset of the transformation, see do_warp()
+    mode: str
+        boundary mode, see do_warp()
+        
+    Returns
+    --------------
+    T: ND array, float32
+        smooth distance of the crop
+    mu: ND array, float32
+        unit flow field of the crop 
+    
+    """
+    dim = len(tyx)
+    w = do_warp(field, M, tyx, offset=offset, mode=mode)
+    T = w[0] * np.abs(np.linalg.det(M))**(1/dim)
+    mu = w[1:]
+    
+    if mode=='reflect':
+        # source coordinate of every crop pixel; an odd number of reflections flips the axis 
+        shape = np.array(field.shape[1:]).reshape((dim,)+(1,)*dim)
+        coords = np.tensordot(np.linalg.inv(M), np.indices(tyx,dtype=np.float32), axes=1)
+        coords += np.reshape(offset,(dim,)+(1,)*dim)
+        mu[np.floor((coords+0.5)/shape)%2==1] *= -1
+    
+    mu = utils.normalize_field(np.tensordot(M.astype(np.float32), mu, axes=1))
+    return T, mu
+
+def flow_warp_error(masks, n=10, tyx=(224,224), scale_range=0.5, mode='reflect'):
+    """ Validate warp_flows() against recomputing the flows on random crops of a label matrix. 
+    
+    Crops are drawn like random_crop_warp() draws them. Errors are evaluated on the cell pixels of the 
+    warped labels. 
+    
+    Parameters
+    --------------
+    masks: ND array, int
+        label matrix
+    n: int
+        number of random crops
+    tyx: tuple, int
+        shape of the crops
+    scale_range: float
+        range of the random scaling, see random_rotate_and_resize()
+    mode: str
+        boundary mode, see do_warp()
+        
+    Returns
+    --------------
+    errors: dict
+        mean over crops of the mean absolute smooth distance error ('dist_mae'), the same relative to the 
+        mean smooth distance ('dist_rel'), the mean angle between the flow vectors in degrees ('flow_angle'), 
+        the fraction of cell pixels whose flow is off by more than 10 degrees ('flow_off10'), and the 
+        time spent per crop by each method ('time_exact', 'time_warp')
+    
+    """
+    dim = len(tyx)
+    s = np.array(masks.shape)
+    field = flow_field(masks, dim=dim)
+    crops = []
+    for k in range(n):
+        ds = scale_range/2
+        M = mgen.rotation_from_angle_and_plane(-np.random.rand()*np.pi*2,[0]*(dim-2)+[1,0],[0]*(dim-1)+[1])
+        M = M.dot(np.diag(np.random.uniform(low=1-ds,high=1+ds,size=dim)))
+        c_in = 0.5*s + (np.random.rand(dim)-.5)*np.maximum(0,s-tyx)
+        offset = c_in - np.dot(np.linalg.inv(M), 0.5*np.array(tyx))
+        l = do_warp(masks, M, tyx, offset=offset, order=0, mode=mode).astype(np.uint16)
+        if not np.any(l):
+            continue
+        
+        tic = time.time()
+        _, _, T0, mu0 = masks_to_flows(l, omni=True, dim=dim)
+        T0 = np.asarray(T0)
+        t_exact = time.time()-tic
+        tic = time.time()
+        T1, mu1 = warp_flows(field, M, tyx, offset, mode=mode)
+        t_warp = time.time()-tic
+        
+        cell = l>0
+        angle = np.degrees(np.arccos(np.clip(np.sum(mu0*mu1,axis=0)[cell],-1,1)))
+        crops.append({'dist_mae': np.mean(np.abs(T1-T0)[cell]),
+                      'dist_rel': np.mean(np.abs(T1-T0)[cell])/np.mean(T0[cell]),
+                      'flow_angle': np.mean(angle),
+                      'flow_off10': np.mean(angle>10),
+                      'time_exact': t_exact, 
+                      'time_warp': t_warp})
+    return {key: np.mean([crop[key] for crop in crops]) for key in crops[0]} if crops else {}
+
+# scipy boundary modes with an exact counterpart in the fast paths;
+# scipy 'reflect' is half-sample symmetric, i.e. cv2 BORDER_REFLECT (not REFLECT_101)
+# and torch 'reflection' with align_corners=False. Plain scipy 'constant' does not 
+# interpolate across the edge, so only 'grid-constant' maps to zero padding. 
+_CV2_BORDER = {'reflect': cv2.BORDER_REFLECT, 
+               'mirror': cv2.BORDER_REFLECT_101, 
+               'nearest': cv2.BORDER_REPLICATE, 
+               'grid-constant': cv2.BORDER_CONSTANT}
+_TORCH_PADDING = {'reflect': 'reflection', 
+                  'nearest': 'border', 
+                  'grid-constant': 'zeros'}
+
+def do_warp(A,M,tyx,offset=0,order=1,mode='constant'):
     """ Wrapper function for affine transformations during augmentation. 
-    Uses scipy.ndimage.affine_transform().
+    Output pixel o samples the input at np.linalg.inv(M) @ o + offset, as in 
+    scipy.ndimage.affine_transform(). 2D crops are warped with cv2.warpAffine() and 
+    3D crops with torch grid_sample(), all channels in one call. Other dimensions or 
+    interpolation orders above 1 fall back to scipy. 
         
     Parameters
     --------------
     A: NDarray, int or float
-        input image to be transformed
+        input image to be transformed, with any leading (channel) axes in front of 
+        the len(tyx) spatial axes
     M: NDarray, float
         tranformation matrix
+    tyx: tuple, int
+        output shape of the spatial axes
+    offset: float or NDarray, float
+        input coordinate of the output origin after applying inv(M)
     order: int
-        interpolation order, 1 is equivalent to 'nearest',
+        interpolation order, 0 is 'nearest neighbor' and 1 is (bi/tri)linear
+    mode: str
+        boundary mode, as in scipy.ndimage (e.g. 'reflect', 'constant')
+        
+    Returns
+    --------------
+    warped array of shape A.shape[:-len(tyx)]+tyx; float32 on the fast paths, 
+    otherwise the dtype of A 
+    
     """
-    # dim = A.ndim'
-    # if dim == 2:
-    #     return cv2.warpAffine(A, M, rshape, borderMode=mode, flags=method)
-    # else:
-    #     return np.stack([cv2.warpAffine(A[k], M, rshape, borderMode=mode, flags=method) for k in range(A.shape[0])])
-    # print('debug',A.shape,M.shape,tyx)
+    tyx = tuple(tyx)
+    dim = len(tyx)
+    Minv = np.linalg.inv(M)
+    offset = np.broadcast_to(np.asarray(offset,dtype=np.float64),(dim,))
+    lead = A.shape[:A.ndim-dim]
+    stack = A.reshape((-1,)+A.shape[-dim:])
+    
+    if order<=1 and dim==2 and mode in _CV2_BORDER:
+        # cv2 works in x,y order and wants the output->input map for WARP_INVERSE_MAP;
+        # channels go last, and cv2 caps the channel count of remap at 4 
+        W = np.array([[Minv[1,1],Minv[1,0],offset[1]],
+                      [Minv[0,1],Minv[0,0],offset[0]]])
+        flags = (cv2.INTER_NEAREST if order==0 else cv2.INTER_LINEAR) | cv2.WARP_INVERSE_MAP
+        src = np.moveaxis(stack.astype(np.float32,copy=False),0,-1)
+        out = np.empty((len(stack),)+tyx,np.float32)
+        for c in range(0,len(stack),4):
+            w = cv2.warpAffine(np.ascontiguousarray(src[...,c:c+4]), W, tyx[::-1], 
+                               flags=flags, borderMode=_CV2_BORDER[mode], borderValue=0)
+            out[c:c+4] = np.moveaxis(w.reshape(tyx+(-1,)),-1,0)
+        return out.reshape(lead+tyx)
+    
+    elif order<=1 and dim==3 and mode in _TORCH_PADDING:
+        # grid_sample works in normalized (x,y,z) coordinates; with align_corners=False 
+        # pixel i sits at (2i+1)/n-1, so fold the scaling into the affine_grid matrix 
+        n_in = np.array(A.shape[-dim:],dtype=np.float64)
+        n_out = np.array(tyx,dtype=np.float64)
+        S = np.diag(2/n_in) @ Minv 
+        theta = np.zeros((dim,dim+1))
+        theta[:,:dim] = (S @ np.diag(n_out/2))[::-1,::-1]
+        theta[:,dim] = (S @ ((n_out-1)/2) + 2*offset/n_in + 1/n_in - 1)[::-1]
+        src = torch.from_numpy(stack.astype(np.float32,copy=False))[None]
+        with torch.no_grad():
+            grid = torch.nn.functional.affine_grid(torch.tensor(theta[None],dtype=torch.float32),
+                                                   (1,len(stack))+tyx, align_corners=False)
+            out = torch.nn.functional.grid_sample(src, grid, mode='nearest' if order==0 else 'bilinear',
+                                                  padding_mode=_TORCH_PADDING[mode], align_corners=False)
+        return out[0].numpy().reshape(lead+tyx)
     
-    return scipy.ndimage.affine_transform(A, np.linalg.inv(M), offset=offset, 
-                                          output_shape=tyx, order=order, mode=mode)
+    else:
+        out = [scipy.ndimage.affine_transform(a, Minv, offset=offset, output_shape=tyx, 
+                                              order=order, mode=mode) for a in stack]
+        return np.stack(out).reshape(lead+tyx)
     
 
-
 def loss(self, lbl, y):
     """ Loss function for Omnipose.
     
@@ -1640,7 +2950,7 @@ def loss(self, lbl, y):
 # as oddly distorted. This is not implemented here, so there is a discrepancy at image/volume edges. The 
 # Omnipose variant is much closer to the edt edge behavior. A more sophisticated 'edge autofill' is really needed for
 # a more robust approach (or just crop edges all the time). 
-def smooth_distance(masks, dists=None, device=None):
+def smooth_distance(masks, dists=None, device=None, solver='jacobi'):
     """
     A smooth fistance field generator implemented with pytorch. To reduce the effects of cut-off masks giving artifically 
     low distance values at image boundaries, masks are padded with reflection. 
@@ -1653,6 +2963,8 @@ def smooth_distance(masks, dists=None, device=None):
         array of (nonnegative) distance field values
     device: torch device
         what compute hardware to use to run the code (GPU VS CPU)
+    solver: str
+        eikonal solver, 'jacobi' or 'sweep' (see _extend_centers_torch)
         
     Returns
     -------------
@@ -1666,40 +2978,26 @@ def smooth_distance(masks, dists=None, device=None):
         dists = edt.edt(masks)
         
     pad = 1
-    
     masks_padded = np.pad(masks,pad)
-    coords = np.nonzero(masks_padded)
-    d = len(coords)
-    idx = (3**d)//2 # center pixel index
-
-    neigh = [[-1,0,1] for i in range(d)]
-    steps = cartesian(neigh)
-    neighbors = np.array([np.add.outer(coords[i],steps[:,i]) for i in range(d)]).swapaxes(-1,-2)
-    # print('neighbors d', neighbors.shape)
-    
-    # get indices of the hupercubes sharing m-faces on the central n-cube
-    sign = np.sum(np.abs(steps),axis=1) # signature distinguishing each kind of m-face via the number of steps 
-    uniq = fastremap.unique(sign)
-    inds = [np.where(sign==i)[0] for i in uniq] # 2D: [4], [1,3,5,7], [0,2,6,8]. 1-7 are y axis, 3-5 are x, etc. 
-    fact = np.sqrt(uniq) # weighting factor for each hypercube group 
+    d = masks.ndim
     
-    # get neighbor validator (not all neighbors are in same mask)
-    neighbor_masks = masks_padded[tuple(neighbors)] #extract list of label values, 
-    isneighbor = neighbor_masks == neighbor_masks[idx] 
-
     # set number of iterations
     n_iter = get_niter(dists)
-    # n_iter = 20
-    # print('n_iter',n_iter)
-        
-    nimg = neighbors.shape[1] // (3**d)
-    pt = torch.from_numpy(neighbors).to(device)
-    T = torch.zeros((nimg,)+masks_padded.shape, dtype=torch.double, device=device)#(nimg,)+
-    isneigh = torch.from_numpy(isneighbor).to(device)
-    for t in range(n_iter):
-        T[(Ellipsis,)+tuple(pt[:,idx])] = eikonal_update_torch(T,pt,isneigh,d,inds,fact) 
+    
+    # same solver as _extend_centers_torch, without the gradient
+    idx, offsets, valid, inds, fact = _flat_stencil(masks_padded)
+    if solver=='sweep':
+        T = eikonal_sweep(masks_padded, idx, offsets, valid, d, inds, fact, 2**d*n_iter)
+    else:
+        pix = torch.from_numpy(idx).to(device)
+        offsets = torch.from_numpy(offsets).to(device)
+        isneigh = torch.from_numpy(valid).to(device)
+        T = torch.zeros(masks_padded.size, dtype=torch.float32, device=device)
+        for t in range(n_iter):
+            T[pix] = eikonal_update_torch(T,pix,offsets,isneigh,d,inds,fact) 
+        T = T.cpu().numpy().reshape(masks_padded.shape)
         
-    return T.cpu().squeeze().numpy()[tuple([slice(pad,-pad)]*d)]
+    return T[tuple([slice(pad,-pad)]*d)]
 
 
 ### Section IV: duplicated mask recontruction
@@ -1742,8 +3040,6 @@ def get_masks_cp(p, iscell=None, rpad=20, flows=None, use_gpu=False, device=None
         size [Ly x Lx] or [Lz x Ly x Lx]
     
     """
-    pflows = []
-    edges = []
     shape0 = p.shape[1:]
     dims = len(p)
     if iscell is not None:
@@ -1756,65 +3052,33 @@ def get_masks_cp(p, iscell=None, rpad=20, flows=None, use_gpu=False, device=None
         for i in range(dims):
             p[i, ~iscell] = inds[i][~iscell]
     
-    for i in range(dims):
-        pflows.append(p[i].flatten().astype('int32'))
-        edges.append(np.arange(-.5-rpad, shape0[i]+.5+rpad, 1))
-
-    h,_ = np.lib.histogramdd(pflows, bins=edges)
+    shape = tuple(np.array(shape0)+2*rpad)
+    # histogram of final pixel locations on the padded grid, as a bincount of flat indices
+    pflows = [p[i].flatten().astype('int32')+rpad for i in range(dims)]
+    inside = np.all([(pf>=0) & (pf<s) for pf,s in zip(pflows,shape)], axis=0)
+    pflows = np.ravel_multi_index(tuple(pflows), shape, mode='clip')
+    h = np.bincount(pflows[inside], minlength=np.prod(shape)).reshape(shape)
     hmax = h.copy()
     for i in range(dims):
         hmax = maximum_filter1d(hmax, 5, axis=i)
 
     seeds = np.nonzero(np.logical_and(h-hmax>-1e-6, h>10))
-    Nmax = h[seeds]
-    isort = np.argsort(Nmax)[::-1]
-    for s in seeds:
-        s = s[isort]
-    pix = list(np.array(seeds).T)
-
-    shape = h.shape
-    if dims==3:
-        expand = np.nonzero(np.ones((3,3,3)))
-    else:
-        expand = np.nonzero(np.ones((3,3)))
-    for e in expand:
-        e = np.expand_dims(e,1)
 
+    # extend the seeds for 5 steps through pixels with more than 2 final locations; 
+    # later seeds overwrite earlier ones, so this is a running maximum of the seed labels 
+    M = np.zeros(shape, np.int32)
+    M[seeds] = np.arange(1, len(seeds[0])+1)
+    good = h > 2
     for iter in range(5):
-        for k in range(len(pix)):
-            if iter==0:
-                pix[k] = list(pix[k])
-            newpix = []
-            iin = []
-            for i,e in enumerate(expand):
-                epix = e[:,np.newaxis] + np.expand_dims(pix[k][i], 0) - 1
-                epix = epix.flatten()
-                iin.append(np.logical_and(epix>=0, epix<shape[i]))
-                newpix.append(epix)
-            iin = np.all(tuple(iin), axis=0)
-            for p in newpix:
-                p = p[iin]
-            newpix = tuple(newpix)
-            igood = h[newpix]>2
-            for i in range(dims):
-                pix[k][i] = newpix[i][igood]
-            if iter==4:
-                pix[k] = tuple(pix[k])
-    
-    M = np.zeros(h.shape, np.int32)
-    for k in range(len(pix)):
-        M[pix[k]] = 1+k
-        
-    for i in range(dims):
-        pflows[i] = pflows[i] + rpad
-    M0 = M[tuple(pflows)]
+        M = maximum_filter(M, size=3, mode='constant') * good
+    M0 = M.ravel()[pflows]
     
-    # remove big masks
-    _,counts = np.unique(M0, return_counts=True)
+    # remove big masks and relabel in order
+    counts = np.bincount(M0, minlength=len(seeds[0])+1)
     big = np.prod(shape0) * 0.4
-    for i in np.nonzero(counts > big)[0]:
-        M0[M0==i] = 0
-    _,M0 = np.unique(M0, return_inverse=True)
+    keep = (counts > 0) & (counts <= big)
+    keep[0] = True
+    M0 = np.where(keep, np.cumsum(keep)-1, 0)[M0]
     M0 = np.reshape(M0, shape0)
 
     # moved to compute masks
@@ -1830,7 +3094,7 @@ def get_masks_cp(p, iscell=None, rpad=20, flows=None, use_gpu=False, device=None
 def fill_holes_and_remove_small_masks(masks, min_size=15, hole_size=3, scale_factor=1, dim=2):
     """ fill holes in masks (2D/3D) and discard masks smaller than min_size (2D)
     
-    fill holes in each mask using scipy.ndimage.morphology.binary_fill_holes
+    fill holes in each mask using skimage.morphology.remove_small_holes
     
     Parameters
     ----------------
@@ -1839,6 +3103,8 @@ def fill_holes_and_remove_small_masks(masks, min_size=15, hole_size=3, scale_fac
         size [Ly x Lx] or [Lz x Ly x Lx]
     min_size: int (optional, default 15)
         minimum number of pixels per mask, can turn off with -1
+    hole_size: float (optional, default 3)
+        holes smaller than this percentage of the mask area are filled
 
     Returns
     ---------------
@@ -1856,28 +3122,213 @@ def fill_holes_and_remove_small_masks(masks, min_size=15, hole_size=3, scale_fac
         
     hole_size *= scale_factor
     
+    # same result as running remove_small_holes on each padded mask crop in turn, 
+    # but the holes of all masks are found at once, see fill_holes_and_remove_small_labels()
+    return fill_holes_and_remove_small_labels(masks, min_size=min_size, hole_size=hole_size, 
+                                              fill_all=not SKIMAGE_ENABLED)
+
+def fill_holes_and_remove_small_labels(masks, min_size=15, hole_size=3, fill_all=False, 
+                                       planar=False, skip_empty=False):
+    """ Fill holes and remove small labels for all masks in one labelling pass. 
+    
+    The result is identical to looping over find_objects(masks) in label order, zeroing masks 
+    smaller than min_size and otherwise writing the hole-filled mask back as the next label. 
+    Instead of labelling the complement of every mask, the image is split once into regions 
+    of constant label (background components included). Their adjacency graph is searched once 
+    from the image border: the holes of a mask are exactly the subtrees that only connect back 
+    through that mask, so hole areas come from subtree sums. Masks in unusual configurations 
+    (several disjoint pieces, partially overwritten by an earlier fill, or a bounding box so 
+    small that remove_small_holes would fill its corners) are passed to the original per-mask 
+    operation on the current state of their crop. 
+    
+    Parameters
+    ----------------
+    masks: int, ND array
+        labelled masks, 0=NO masks; 1,2,...=mask labels, modified in place
+    min_size: int
+        minimum number of pixels per mask, can turn off with -1
+    hole_size: float
+        holes smaller than this percentage of the mask area are filled 
+        (remove_small_holes on the mask padded by 1)
+    fill_all: bool
+        fill all holes regardless of size (binary_fill_holes)
+    planar: bool
+        fill holes in each plane along the first axis separately (3D Cellpose)
+    skip_empty: bool
+        do not give a new label to masks that were completely overwritten by an earlier fill
+        
+    Returns
+    ---------------
+    masks: int, ND array
+        masks with holes filled and masks smaller than min_size removed
+    
+    """
+    d = masks.ndim
     slices = find_objects(masks)
+    if not len(slices):
+        return masks
+    axes = range(1,d) if planar else range(d)
+    
+    # regions of constant value, background included, with face connectivity 
+    if planar:
+        reg = np.zeros(masks.shape, np.int64)
+        offsets = [0]
+        for z in range(masks.shape[0]):
+            reg[z] = measure.label(masks[z], background=-1, connectivity=1) + offsets[-1]
+            offsets.append(reg[z].max())
+        plane = np.maximum(np.searchsorted(offsets, np.arange(offsets[-1]+1), side='left')-1, 0)
+    else:
+        reg = measure.label(masks, background=-1, connectivity=1).astype(np.int64)
+    nreg = reg.max()
+    area = np.bincount(reg.ravel(), minlength=nreg+1)
+    value = np.zeros(nreg+1, np.int64)
+    value[reg] = masks
+    
+    # region adjacency graph; region 0 stands for the image border (in-plane border if planar)
+    border = np.unique(np.concatenate([np.take(reg,[0,-1],axis=a).ravel() for a in axes]))
+    src, dst = [np.zeros_like(border)], [border]
+    for a in axes:
+        r0 = reg[tuple([slice(None)]*a+[slice(None,-1)])]
+        r1 = reg[tuple([slice(None)]*a+[slice(1,None)])]
+        diff = r0!=r1
+        src.append(r0[diff])
+        dst.append(r1[diff])
+    src, dst = np.concatenate(src), np.concatenate(dst)
+    src, dst = np.divmod(np.unique(np.minimum(src,dst)*(nreg+1)+np.maximum(src,dst)), nreg+1)
+    src, dst = np.concatenate((src,dst)), np.concatenate((dst,src))
+    sort = np.argsort(src)
+    src, dst = src[sort], dst[sort]
+    indptr = np.searchsorted(src, np.arange(nreg+2))
+    
+    # depth-first search tree from the border 
+    disc = np.full(nreg+1, -1, np.int64)
+    low = np.zeros(nreg+1, np.int64)
+    parent = np.full(nreg+1, -1, np.int64)
+    size = np.ones(nreg+1, np.int64)
+    sub_area = area.copy()
+    _region_tree(indptr, dst, disc, low, parent, size, sub_area)
+    order = np.argsort(disc)
+    
+    # a child subtree that only links to the rest of the graph through its parent is a hole 
+    child = np.nonzero(parent>0)[0]
+    child = child[low[child] >= disc[parent[child]]]
+    child = child[np.argsort(parent[child],kind='stable')]
+    hole_ptr = np.searchsorted(parent[child], np.arange(nreg+2))
+    
+    # regions of each label
+    nodes = np.argsort(value,kind='stable')
+    node_ptr = np.searchsorted(value[nodes], np.arange(len(slices)+2))
+    owner = value.copy()
+    split = {} # pieces cut out of a region by a fill that did not follow region boundaries
+    dirty = np.zeros(len(slices)+1, bool) # labels that lost pixels that way
+    
+    # remove_small_holes used to fill holes smaller than hsz, newer versions fill up to hsz
+    inclusive = fill_all or _HOLES_INCLUSIVE
+    is_small = np.less_equal if inclusive else np.less
+    
+    def assign(regions, label):
+        # the pieces split off a region lie inside it, so they go along with it 
+        owner[regions] = label
+        for r in (regions[np.isin(regions,list(split))] if split else []):
+            assign(np.array(split[r]), label)
+    
+    def fill_crop(L, slc, hsz, label):
+        nonlocal area, owner
+        reg_crop = reg[slc]
+        msk = owner[reg_crop] == L
+        if planar:
+            filled = np.stack([binary_fill_holes(m) for m in msk])
+        elif fill_all:
+            filled = binary_fill_holes(msk)
+        else:
+            pad = 1
+            unpad = tuple([slice(pad,-pad)]*msk.ndim) 
+            filled = remove_small_holes(np.pad(msk,pad,mode='constant'),**{_HOLES_KW:hsz})[unpad]
+        regions, counts = np.unique(reg_crop[filled], return_counts=True)
+        whole = counts == area[regions]
+        for r,n in zip(regions[~whole],counts[~whole]):
+            dirty[owner[r]] = True
+            reg_crop[filled & (reg_crop==r)] = len(area)
+            split.setdefault(r,[]).append(len(area))
+            area[r] -= n
+            area = np.append(area, n)
+            owner = np.append(owner, label)
+        owner[regions[whole]] = label
+    
+    # masks that can be read off the region tree unless an earlier fill cut into them: 
+    # one region (per plane) and a bounding box whose padding ring is not itself a small hole
+    npieces = np.diff(node_ptr)
+    if planar:
+        fast = npieces == np.bincount(np.unique(value*len(offsets)+plane)//len(offsets), minlength=len(npieces))
+    else:
+        fast = npieces == 1
+    ext = np.array([[s.stop-s.start for s in slc] if slc is not None else [0]*d for slc in slices])
+    ring = np.prod(ext+2,axis=1)-np.prod(ext,axis=1)
+    label_area = np.bincount(value, weights=area, minlength=len(npieces))
+    if not fill_all:
+        fast[1:len(slices)+1] &= ~is_small(ring, label_area[1:len(slices)+1]*hole_size/100)
+    
     j = 0
     for i,slc in enumerate(slices):
-        if slc is not None:
-            msk = masks[slc] == (i+1)
-            npix = msk.sum()
-            if min_size > 0 and npix < min_size:
-                masks[slc][msk] = 0
-            else:   
-                hsz = np.count_nonzero(msk)*hole_size/100 #turn hole size into percentage
-                #eventually the boundary output should be used to properly exclude real holes vs label gaps      
-                if SKIMAGE_ENABLED: # Omnipose version (passes 2D tests)
-                    pad = 1
-                    unpad = tuple([slice(pad,-pad)]*msk.ndim) 
-                    padmsk = remove_small_holes(np.pad(msk,pad,mode='constant'),hsz)
-                    msk = padmsk[unpad]
-                else: #Cellpose version
-                    msk = binary_fill_holes(msk)
-                masks[slc][msk] = (j+1)
-                j+=1
+        if slc is None:
+            continue
+        L = i+1
+        pieces = nodes[node_ptr[L]:node_ptr[L+1]]
+        alive = pieces[owner[pieces]==L]
+        npix = area[alive].sum()
+        if min_size > 0 and npix < min_size:
+            owner[alive] = 0
+            continue
+        if npix == 0:
+            j += not skip_empty
+            continue
+        hsz = np.inf if fill_all else npix*hole_size/100 #turn hole size into percentage
+        if fast[L] and len(alive)==len(pieces) and not dirty[L]:
+            owner[alive] = j+1
+            for k in alive:
+                for c in child[hole_ptr[k]:hole_ptr[k+1]]:
+                    if is_small(sub_area[c],hsz):
+                        assign(order[disc[c]:disc[c]+size[c]], j+1)
+        else:
+            fill_crop(L, slc, hsz, j+1)
+        j += 1
+    
+    masks[...] = owner[reg]
     return masks
 
+@njit('void(int64[:], int64[:], int64[:], int64[:], int64[:], int64[:], int64[:])', nogil=True)
+def _region_tree(indptr, indices, disc, low, parent, size, sub_area):
+    """ Iterative depth-first search from region 0 recording discovery order, low-links, 
+    subtree sizes and subtree areas (in place). """
+    n = len(disc)
+    stack = np.empty(n, np.int64)
+    nxt = indptr[:-1].copy()
+    t = 0
+    disc[0] = 0
+    low[0] = 0
+    stack[0] = 0
+    sp = 1
+    while sp > 0:
+        v = stack[sp-1]
+        if nxt[v] < indptr[v+1]:
+            w = indices[nxt[v]]
+            nxt[v] += 1
+            if disc[w] == -1:
+                t += 1
+                disc[w] = t
+                low[w] = t
+                parent[w] = v
+                stack[sp] = w
+                sp += 1
+            elif w != parent[v]:
+                low[v] = min(low[v], disc[w])
+        else:
+            sp -= 1
+            p = parent[v]
+            if p >= 0:
+                low[p] = min(low[p], low[v])
+                size[p] += size[v]
+                sub_area[p] += sub_area[v]
 
     # if masks.ndim > 3 or masks.ndim < 2:
     #     raise ValueError('fill_holes_and_remove_small_masks takes 2D or 3D array, not %dD array'%masks.ndim)
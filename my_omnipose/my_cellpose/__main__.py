@@ -96,6 +96,9 @@ def main(omni_CLI=False):
     algorithm_args.add_argument('--diameter', required=False, default=30., type=float, 
                                 help='cell diameter, if 0 cellpose will estimate for each image')
     algorithm_args.add_argument('--stitch_threshold', required=False, default=0.0, type=float, help='compute masks in 2D then stitch together masks with IoU>0.9 across planes')
+    algorithm_args.add_argument('--time_series', action='store_true', help='treat image stacks as time-lapse frames and warm-start the dynamics of each frame from the previous one (omni only)')
+    algorithm_args.add_argument('--chunk_size', required=False, default=None, type=int, help='compute the masks of large 2D images in overlapping blocks of this size (omni only)')
+    algorithm_args.add_argument('--flow_per_object', action='store_true', help='compute the flow error QC object by object (faster on images with many cells, omni only)')
     algorithm_args.add_argument('--flow_threshold', default=0.4, type=float, help='flow error threshold, 0 turns off this optional QC step. Default: %(default)s')
     algorithm_args.add_argument('--mask_threshold', default=0, type=float, help='mask threshold, default is 0, decrease to find more and larger masks')
     algorithm_args.add_argument('--anisotropy', required=False, default=1.0, type=float,
@@ -150,6 +153,24 @@ def main(omni_CLI=False):
     training_args.add_argument('--dropout',action='store_true', help='Use dropoint in training')
     training_args.add_argument('--tyx',
                         default=None, type=str, help='list of yx, zyx, or tyx dimensions for training')
+    training_args.add_argument('--num_workers',
+                        default=0, type=int, help='number of worker processes preparing augmented batches, 0 makes them in the training loop. Default: %(default)s')
+    training_args.add_argument('--lazy', action='store_true', 
+                        help='read training images and labels from disk as needed instead of loading them all up front')
+    training_args.add_argument('--cache_gb',
+                        default=1.0, type=float, help='with --lazy, memory budget in GB for each of the cached images and labels. Default: %(default)s')
+    training_args.add_argument('--autocast', action='store_true', help='train in mixed precision (fp16 on GPU, bf16 on CPU)')
+    training_args.add_argument('--accumulate',
+                        default=1, type=int, help='number of batches to accumulate gradients over per optimizer step (effective batch size accumulate*batch_size). Default: %(default)s')
+    training_args.add_argument('--resume',
+                        default=None, type=str, help='checkpoint file (<run name>_checkpoint.pth in the models folder of --dir) to continue training from')
+    training_args.add_argument('--checkpoint_every',
+                        default=None, type=int, help='number of epochs between checkpoints for --resume. Default: --save_every')
+    training_args.add_argument('--log_timings', action='store_true', help='log the time spent on each training phase per epoch (synchronizes the GPU every batch)')
+    training_args.add_argument('--eval_every',
+                        default=1, type=int, help='number of epochs between test loss evaluations (with --test_dir). Default: %(default)s')
+    training_args.add_argument('--flow_cache',
+                        default=None, type=str, help='directory to cache the flows of the training labels in; crops then warp these instead of recomputing flows (Omnipose only)')
     
     # misc settings
     parser.add_argument('--verbose', action='store_true', help='flag to output extra information (e.g. diameter metrics) for debugging and fine-tuning parameters')
@@ -366,7 +387,10 @@ def main(omni_CLI=False):
                                 anisotropy=args.anisotropy,
                                 verbose=args.verbose,
                                 transparency=args.transparency, # RGB flows made in the eval step
-                                model_loaded=True)
+                                model_loaded=True,
+                                time_series=args.time_series,
+                                chunk_size=args.chunk_size,
+                                flow_per_object=args.flow_per_object)
                 masks, flows = out[:2]
                 if len(out) > 3:
                     diams = out[-1]
@@ -402,7 +426,8 @@ def main(omni_CLI=False):
                 szmean = args.diameter # respect user defined, defaults to 30
                 
             test_dir = None if len(args.test_dir)==0 else args.test_dir
-            output = io.load_train_test_data(args.dir, test_dir, img_filter, args.mask_filter, args.unet, args.look_one_level_down, args.omni)
+            output = io.load_train_test_data(args.dir, test_dir, img_filter, args.mask_filter, args.unet, args.look_one_level_down, args.omni,
+                                             lazy=args.lazy, cache_bytes=int(args.cache_gb*2**30))
             images, labels, image_names, test_images, test_labels, image_names_test = output
 
             # training with all channels
@@ -491,7 +516,15 @@ def main(omni_CLI=False):
                                            batch_size=args.batch_size, 
                                            min_train_masks=args.min_train_masks,
                                            SGD=(not args.RAdam),
-                                           tyx=args.tyx)
+                                           tyx=args.tyx,
+                                           num_workers=args.num_workers,
+                                           flow_cache=args.flow_cache,
+                                           do_autocast=args.autocast,
+                                           accumulate=args.accumulate,
+                                           resume=args.resume,
+                                           eval_every=args.eval_every,
+                                           checkpoint_every=args.checkpoint_every,
+                                           log_timings=args.log_timings)
                 model.pretrained_model = cpmodel_path
                 logger.info('model trained and saved to %s'%cpmodel_path)
 
@@ -1,4 +1,4 @@
-import os, sys, time, shutil, tempfile, datetime, pathlib, subprocess
+import os, sys, time, shutil, tempfile, datetime, pathlib, subprocess, resource, json
 import logging
 import numpy as np
 from tqdm import trange, tqdm
@@ -6,6 +6,7 @@ from urllib.parse import urlparse
 import tempfile
 import cv2
 from scipy.stats import mode
+from concurrent.futures import ThreadPoolExecutor
 from . import transforms, dynamics, utils, metrics, io
 
 try:
@@ -20,7 +21,6 @@ except:
 
 try:
     import torch
-    from torch.cuda.amp import autocast, GradScaler
     from torch import nn
     from torch.utils import mkldnn as mkldnn_utils
     from . import resnet_torch
@@ -748,22 +748,30 @@ class UnetModel():
         cell_threshold, boundary_threshold = self.threshold_validation(val_data, val_labels)
         np.save(model_path+'_cell_boundary_threshold.npy', np.array([cell_threshold, boundary_threshold]))
 
-    def threshold_validation(self, val_data, val_labels):
+    def threshold_validation(self, val_data, val_labels, n_jobs=None):
+        """ sweep the cell and boundary thresholds for the best average precision on the validation set
+        
+        The network runs once per image; the threshold pairs are then evaluated on the cached 
+        outputs, in parallel over n_jobs threads (default os.cpu_count()). 
+        """
         cell_thresholds = np.arange(-4.0, 4.25, 0.5)
         if self.nclasses==3:
             boundary_thresholds = np.arange(-2, 2.25, 1.0)
         else:
             boundary_thresholds = np.zeros(1)
+        outputs = [self._run_net(val_data[i].transpose(1,2,0), augment=False)[0] for i in range(len(val_data))]
+        
+        def threshold_ap(jk):
+            cell_threshold, boundary_threshold = cell_thresholds[jk[0]], boundary_thresholds[jk[1]]
+            masks = [utils.get_masks_unet(output, cell_threshold, boundary_threshold) for output in outputs]
+            return metrics.average_precision(val_labels, masks)[0].mean(axis=0)
+        
+        pairs = list(np.ndindex(cell_thresholds.size, boundary_thresholds.size))
         aps = np.zeros((cell_thresholds.size, boundary_thresholds.size, 3))
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            for jk, ap0 in zip(pairs, executor.map(threshold_ap, pairs)):
+                aps[jk] = ap0
         for j,cell_threshold in enumerate(cell_thresholds):
-            for k,boundary_threshold in enumerate(boundary_thresholds):
-                masks = []
-                for i in range(len(val_data)):
-                    output,style = self._run_net(val_data[i].transpose(1,2,0), augment=False)
-                    masks.append(utils.get_masks_unet(output, cell_threshold, boundary_threshold))
-                ap = metrics.average_precision(val_labels, masks)[0]
-                ap0 = ap.mean(axis=0)
-                aps[j,k] = ap0
             if self.nclasses==3:
                 kbest = aps[j].mean(axis=-1).argmax()
             else:
@@ -781,27 +789,47 @@ class UnetModel():
                                                           aps[jbest,kbest,0]))
         return cell_threshold, boundary_threshold
 
-    def _train_step(self, x, lbl):
+    def _train_step(self, x, lbl, zero_grad=True, step=True, loss_scale=1., timer=None):
+        """ forward and backward pass of one batch; with gradient accumulation, the gradients of 
+        several batches (each weighted by loss_scale) are summed between zero_grad and step (torch only). 
+        If given, the seconds spent on 'to_device', 'forward', 'loss', 'backward' and 'step' are added 
+        to timer (the labels are moved to the device within the loss). 
+        """
+        tic = time.time()
         X = self._to_device(x)
         if self.torch:
-            self.optimizer.zero_grad() 
+            tic = _lap(timer, 'to_device', tic, self.device)
+            if zero_grad:
+                self.optimizer.zero_grad() 
             self.net.train()
             
             if self.autocast:
-                with autocast(): 
+                # fp16 on the GPU (with loss scaling), bf16 on the CPU; the loss is taken in float32
+                with torch.autocast(device_type=self.device.type, 
+                                    dtype=torch.float16 if self.device.type=='cuda' else torch.bfloat16): 
                     y = self.net(X)[0] 
-                    loss = self.loss_fn(lbl,y)
-                self.scaler.scale(loss).backward()
+                tic = _lap(timer, 'forward', tic, self.device)
+                loss = self.loss_fn(lbl,y.float())
+                tic = _lap(timer, 'loss', tic, self.device)
+                self.scaler.scale(loss*loss_scale).backward()
                 train_loss = loss.item()
-                self.scaler.step(self.optimizer) 
+                tic = _lap(timer, 'backward', tic, self.device)
+                if step:
+                    self.scaler.step(self.optimizer) 
+                    self.scaler.update()
+                    _lap(timer, 'step', tic, self.device)
                 train_loss *= len(x)
-                self.scaler.update()
             else:
                 y = self.net(X)[0]
+                tic = _lap(timer, 'forward', tic, self.device)
                 loss = self.loss_fn(lbl,y)
-                loss.backward()
+                tic = _lap(timer, 'loss', tic, self.device)
+                (loss*loss_scale).backward()
                 train_loss = loss.item()
-                self.optimizer.step()
+                tic = _lap(timer, 'backward', tic, self.device)
+                if step:
+                    self.optimizer.step()
+                    _lap(timer, 'step', tic, self.device)
                 train_loss *= len(x)
         else:
             with mx.autograd.record():
@@ -827,6 +855,43 @@ class UnetModel():
             test_loss = nd.sum(loss).asnumpy()
         return test_loss
 
+    def _save_checkpoint(self, file_name, epoch, inds_all, d):
+        """ save everything _train_net needs to continue from epoch: network, optimizer (and loss scaler) 
+        state, learning rate schedule, image order, start time of the run and RNG states. The file is written 
+        under a temporary name and then renamed, so an interrupted save leaves the previous checkpoint intact. 
+        """
+        checkpoint = {'epoch': epoch,
+                      'net': self.net.state_dict(),
+                      'optimizer': self.optimizer.state_dict(),
+                      'scaler': self.scaler.state_dict() if self.autocast else None,
+                      'learning_rate': np.asarray(self.learning_rate),
+                      'inds_all': inds_all,
+                      'datetime': d,
+                      'numpy_rng': np.random.get_state(),
+                      'torch_rng': torch.get_rng_state(),
+                      'cuda_rng': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}
+        tmp_name = file_name+'.tmp'
+        torch.save(checkpoint, tmp_name)
+        os.replace(tmp_name, file_name)
+        
+    def _load_checkpoint(self, file_name, inds_all):
+        """ restore the state saved by _save_checkpoint; returns the epoch to continue from, the image order 
+        (inds_all unless the checkpoint covers all epochs) and the start time of the run """
+        checkpoint = torch.load(file_name, map_location=self.device, weights_only=False)
+        self.net.load_state_dict(checkpoint['net'])
+        self.optimizer.load_state_dict(checkpoint['optimizer'])
+        if self.autocast and checkpoint['scaler'] is not None:
+            self.scaler.load_state_dict(checkpoint['scaler'])
+        if len(checkpoint['learning_rate']) == self.n_epochs:
+            self.learning_rate = checkpoint['learning_rate']
+        if len(checkpoint['inds_all']) >= len(inds_all):
+            inds_all = checkpoint['inds_all']
+        np.random.set_state(checkpoint['numpy_rng'])
+        torch.set_rng_state(checkpoint['torch_rng'])
+        if checkpoint['cuda_rng'] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(checkpoint['cuda_rng'])
+        return checkpoint['epoch'], inds_all, checkpoint['datetime']
+
     def _set_optimizer(self, learning_rate, momentum, weight_decay, SGD=False):
         if self.torch:
             if SGD:
@@ -874,8 +939,35 @@ class UnetModel():
                    save_path=None, save_every=100, save_each=False,
                    learning_rate=0.2, n_epochs=500, momentum=0.9, weight_decay=0.00001, 
                    SGD=True, batch_size=8, nimg_per_epoch=None, rescale=True, netstr=None, 
-                   do_autocast=False, tyx=None): 
-        """ train function uses loss function self.loss_fn in models.py"""
+                   do_autocast=False, tyx=None, num_workers=0, prefetch=2, fg_tables=None,
+                   flow_fields=None, accumulate=1, resume=None, eval_every=1, checkpoint_every=None,
+                   log_timings=False): 
+        """ train function uses loss function self.loss_fn in models.py
+        
+        With num_workers>0 the augmented batches are made ahead of time by a DataLoader with 
+        num_workers worker processes, each keeping up to prefetch batches ready (see TrainBatches). 
+        Otherwise they are made in the training loop. fg_tables are the optional foreground 
+        tables of train_labels used to draw the crops (see my_omnipose.core.foreground_table), 
+        and flow_fields their optional precomputed flows (see my_omnipose.core.flow_field).
+        
+        do_autocast runs the network in mixed precision (bf16 on the CPU). With accumulate>1 the 
+        optimizer steps once every accumulate batches on their summed gradients, for an effective 
+        batch of accumulate*batch_size images at the memory cost of batch_size. 
+        
+        Every checkpoint_every epochs (default save_every) and after the last one, the full training 
+        state is written to <run name>_checkpoint.pth in save_path/models (see _save_checkpoint). 
+        resume continues a run from such a checkpoint, given as a file name or as True for the 
+        checkpoint of the run named netstr (runs without a netstr are named by their start time, 
+        so they can only be resumed from an explicit file). 
+        
+        The test loss is computed every eval_every epochs and after the last one, on test crops that 
+        are made once and reused. 
+        
+        With log_timings, the time spent on each phase (data, of which flow generation, host-to-device 
+        copies, forward, loss, backward, optimizer step, test and saving) is written for every epoch to 
+        <run name>_timings.jsonl next to the model and summarized at the end. This synchronizes the 
+        GPU between the phases of every batch, so it is off by default. 
+        """
         d = datetime.datetime.now()
         self.autocast = do_autocast
         self.n_epochs = n_epochs
@@ -914,7 +1006,7 @@ class UnetModel():
                                    for k in range(len(train_labels))])
             diam_train[diam_train<5] = 5.
             if test_data is not None:
-                diam_test = np.array([utils.diameters(test_labels[k][0],omni=self.omni)[0] 
+                diam_test = np.array([utils.diameters(test_labels[k] if self.omni else test_labels[k][0],omni=self.omni)[0] 
                                       for k in range(len(test_labels))])
                 diam_test[diam_test<5] = 5.
             scale_range = 0.5
@@ -963,53 +1055,132 @@ class UnetModel():
             inds_all = np.hstack((inds_all, rperm))
         
         if self.autocast:
-            self.scaler = GradScaler()
+            # loss scaling is only needed for fp16, so it is a pass-through on the CPU 
+            self.scaler = torch.amp.GradScaler('cuda', enabled=self.device.type=='cuda')
+        if accumulate > 1:
+            core_logger.info(f'>>>> accumulating gradients over {accumulate} batches, effective batch size {accumulate*batch_size}')
+        nbatch = int(np.ceil(nimg_per_epoch/batch_size))
+        
+        test_batches = None # test crops and labels, made on the first evaluation
+        if checkpoint_every is None:
+            checkpoint_every = save_every
+        start_epoch = 0
+        if resume:
+            if resume is True:
+                if save_path is None or netstr is None:
+                    raise ValueError('resume=True needs save_path and netstr to find the checkpoint of the run, '
+                                     'otherwise give the checkpoint file')
+                resume = os.path.join(file_path, netstr+'_checkpoint.pth')
+                if not os.path.isfile(resume):
+                    raise ValueError('no checkpoint to resume from at %s'%(resume))
+            start_epoch, inds_all, d = self._load_checkpoint(resume, inds_all)
+            core_logger.info(f'>>>> resuming from {resume} at epoch {start_epoch}')
         
-        for iepoch in range(self.n_epochs):    
+        # per-phase timings of every epoch go to <run name>_timings.jsonl next to the model 
+        timings_file = None
+        if save_path is not None:
+            run_name = netstr if netstr is not None else '{}_{}_{}'.format(self.net_type, file_label, 
+                                                                            d.strftime("%Y_%m_%d_%H_%M_%S.%f"))
+            if log_timings:
+                timings_file = os.path.join(file_path, run_name+'_timings.jsonl')
+        timings = {} # totals over the run 
+        
+        if num_workers > 0:
+            # augmentation runs in worker processes that stay ahead of the training loop 
+            batches = TrainBatches(train_data, train_labels, inds_all[:n_epochs*nimg_per_epoch], 
+                                   nimg_per_epoch, batch_size, 
+                                   rescale=diam_train / self.diam_mean if rescale else None,
+                                   fg_tables=fg_tables, flow_fields=flow_fields,
+                                   scale_range=scale_range, unet=self.unet, tyx=tyx, 
+                                   omni=self.omni, dim=self.dim, nchan=self.nchan)
+            # a resumed run picks up at the first batch of start_epoch 
+            batches = torch.utils.data.Subset(batches, range(start_epoch*batches.nbatch, len(batches)))
+            loader = iter(torch.utils.data.DataLoader(batches, batch_size=None, shuffle=False, 
+                                                      num_workers=num_workers, prefetch_factor=prefetch,
+                                                      collate_fn=_batch_collate, persistent_workers=True,
+                                                      multiprocessing_context='spawn'))
+            core_logger.info(f'>>>> augmenting batches with {num_workers} workers, started in %0.1fs'%(time.time()-tic))
+        
+        for iepoch in range(start_epoch, self.n_epochs):    
             if SGD:
                 self._set_learning_rate(self.learning_rate[iepoch])
             np.random.seed(iepoch)
             rperm = inds_all[iepoch*nimg_per_epoch:(iepoch+1)*nimg_per_epoch]
-            for ibatch in tqdm(range(0,nimg_per_epoch,batch_size),ncols=100):
-                inds = rperm[ibatch:ibatch+batch_size]
-                rsc = diam_train[inds] / self.diam_mean if rescale else np.ones(len(inds), np.float32)
-                # now passing in the full train array, need the labels for distance field
-                imgi, lbl, scale = transforms.random_rotate_and_resize(
-                                        [train_data[i] for i in inds], Y=[train_labels[i] for i in inds],
-                                        rescale=rsc, scale_range=scale_range, unet=self.unet, tyx=tyx,
-                                        inds=inds, omni=self.omni, dim=self.dim, nchan=self.nchan)
+            data_wait = 0. # time the training loop spends waiting on augmented batches
+            crop_stats = {} # crops and crop retries of the augmentation 
+            timer = {} # seconds per phase of this epoch 
+            tepoch = time.time()
+            for kbatch, ibatch in enumerate(tqdm(range(0,nimg_per_epoch,batch_size),ncols=100)):
+                tdata = time.time()
+                if num_workers > 0:
+                    imgi, lbl, scale, stats = next(loader)
+                    for key in stats:
+                        crop_stats[key] = crop_stats.get(key,0) + stats[key]
+                else:
+                    inds = rperm[ibatch:ibatch+batch_size]
+                    rsc = diam_train[inds] / self.diam_mean if rescale else np.ones(len(inds), np.float32)
+                    # now passing in the full train array, need the labels for distance field
+                    imgi, lbl, scale = transforms.random_rotate_and_resize(
+                                            [train_data[i] for i in inds], Y=[train_labels[i] for i in inds],
+                                            rescale=rsc, scale_range=scale_range, unet=self.unet, tyx=tyx,
+                                            inds=inds, omni=self.omni, dim=self.dim, nchan=self.nchan,
+                                            fg_tables=None if fg_tables is None else [fg_tables[i] for i in inds],
+                                            flow_fields=None if flow_fields is None else [flow_fields[i] for i in inds],
+                                            stats=crop_stats)
+                data_wait += time.time() - tdata
                 if self.unet and lbl.shape[1]>1 and rescale:
                     lbl[:,1] /= diam_batch[:,np.newaxis,np.newaxis]**2
-                train_loss = self._train_step(imgi, lbl)
+                # first batch of this accumulation group and the number of batches in it 
+                kfirst = kbatch - kbatch%accumulate
+                ngroup = min(accumulate, nbatch-kfirst)
+                train_loss = self._train_step(imgi, lbl, zero_grad=(kbatch==kfirst), 
+                                              step=(kbatch==kfirst+ngroup-1), loss_scale=1./ngroup, 
+                                              timer=timer if log_timings else None)
                 lavg += train_loss
                 nsum += len(imgi) 
             
+            # flow generation happens within the data phase, or in the workers 
+            timer['data'] = data_wait
+            timer['flows'] = crop_stats.pop('flow_time',0.)
+            nsamples = nsum
+            core_logger.info('Epoch %d, %0.1f samples/s, peak memory %0.2f GB'%
+                             (iepoch, nsum/(time.time()-tepoch), _peak_memory(self.device)/2**30))
             if iepoch%1==0 :
                 lavg = lavg / nsum
-                if test_data is not None:
+                if test_data is not None and (iepoch%eval_every==0 or iepoch==self.n_epochs-1):
+                    ttest = time.time()
+                    if test_batches is None:
+                        # the test crops are fixed (seed 42, no rescaling), so make them once 
+                        test_batches = []
+                        np.random.seed(42)
+                        rperm = np.arange(0, len(test_data), 1, int)
+                        for ibatch in range(0,len(test_data),batch_size):
+                            inds = rperm[ibatch:ibatch+batch_size]
+                            rsc = diam_test[inds] / self.diam_mean if rescale else np.ones(len(inds), np.float32)
+                            imgi, lbl, scale = transforms.random_rotate_and_resize(
+                                                [test_data[i] for i in inds], Y=[test_labels[i] for i in inds], 
+                                                scale_range=0., rescale=rsc, unet=self.unet, tyx=tyx, inds=inds, 
+                                                omni=self.omni, dim=self.dim) 
+                            if self.unet and lbl.shape[1]>1 and rescale:
+                                lbl[:,1] *= scale[0]**2
+                            test_batches.append((imgi, lbl))
+                            
                     lavgt, nsum = 0., 0
-                    np.random.seed(42)
-                    rperm = np.arange(0, len(test_data), 1, int)
-                    for ibatch in range(0,len(test_data),batch_size):
-                        inds = rperm[ibatch:ibatch+batch_size]
-                        rsc = diam_test[inds] / self.diam_mean if rescale else np.ones(len(inds), np.float32)
-                        imgi, lbl, scale = transforms.random_rotate_and_resize(
-                                            [test_data[i] for i in inds], Y=[test_labels[i] for i in inds], 
-                                            scale_range=0., rescale=rsc, unet=self.unet, tyx=tyx, inds=inds, 
-                                            omni=self.omni, dim=self.dim) 
-                        if self.unet and lbl.shape[1]>1 and rescale:
-                            lbl[:,1] *= scale[0]**2
-
+                    for imgi, lbl in test_batches:
                         test_loss = self._test_eval(imgi, lbl)
                         lavgt += test_loss
                         nsum += len(imgi)
+                    timer['test'] = time.time() - ttest
 
-                    core_logger.info('Epoch %d, Time %4.1fs, Loss %2.4f, Loss Test %2.4f, LR %2.4f'%
-                            (iepoch, time.time()-tic, lavg, lavgt/nsum, self.learning_rate[iepoch]))
+                    core_logger.info('Epoch %d, Time %4.1fs, Data wait %4.1fs, Loss %2.4f, Loss Test %2.4f, LR %2.4f'%
+                            (iepoch, time.time()-tic, data_wait, lavg, lavgt/nsum, self.learning_rate[iepoch]))
                 else:
-                    core_logger.info('Epoch %d, Time %4.1fs, Loss %2.4f, LR %2.4f'%
-                            (iepoch, time.time()-tic, lavg, self.learning_rate[iepoch]))
+                    core_logger.info('Epoch %d, Time %4.1fs, Data wait %4.1fs, Loss %2.4f, LR %2.4f'%
+                            (iepoch, time.time()-tic, data_wait, lavg, self.learning_rate[iepoch]))
                 
+                if crop_stats.get('crops',0):
+                    core_logger.info('Epoch %d, %d crops, %d redrawn, %d warp retries'%
+                            (iepoch, crop_stats['crops'], crop_stats.get('draws',0), crop_stats.get('retries',0)))
                 lavg, nsum = 0, 0
                             
             if save_path is not None:
@@ -1028,20 +1199,135 @@ class UnetModel():
                         else:
                             file_name = netstr
                     file_name = os.path.join(file_path, file_name)
+                    tsave = time.time()
                     ksave += 1
                     core_logger.info(f'saving network parameters to {file_name}')
                     if self.torch:
-                        self.net.module.save_model(file_name)
+                        # the network is only wrapped (in .module) when running data-parallel 
+                        getattr(self.net, 'module', self.net).save_model(file_name)
                     else:
                         self.net.save_model(file_name)
+                    timer['save'] = time.time() - tsave
+                if self.torch and (iepoch==self.n_epochs-1 or iepoch%checkpoint_every==0):
+                    tsave = time.time()
+                    self._save_checkpoint(os.path.join(file_path, run_name+'_checkpoint.pth'), 
+                                          iepoch+1, inds_all, d)
+                    timer['save'] = timer.get('save',0.) + time.time() - tsave
             else:
                 file_name = save_path
+            
+            timer['time'] = time.time() - tepoch
+            for key in timer:
+                timings[key] = timings.get(key,0.) + timer[key]
+            if timings_file is not None:
+                with open(timings_file, 'a') as f:
+                    f.write(json.dumps(dict({'epoch': iepoch, 'samples': nsamples}, 
+                                            **{key: round(timer[key],4) for key in timer}))+'\n')
+
+        if num_workers > 0:
+            del loader # shuts down the workers
+        
+        if log_timings and timings.get('time',0):
+            phases = ['data','flows','to_device','forward','loss','backward','step','test','save']
+            core_logger.info('>>>> training time %0.1fs by phase: '%timings['time'] + 
+                             ', '.join(['%s %0.1fs (%0.0f%%)'%(key, timings[key], 100*timings[key]/timings['time']) 
+                                        for key in phases if key in timings]))
+            if timings_file is not None:
+                core_logger.info(f'>>>> per-epoch timings saved to {timings_file}')
 
         # reset to mkldnn if available
         self.net.mkldnn = self.mkldnn
 
         return file_name
 
+def _lap(timer, key, tic, device=None):
+    """ add the seconds since tic to timer[key] and return the current time; GPU work is 
+    synchronized first so that it is counted in its own phase """
+    if timer is None:
+        return tic
+    if getattr(device,'type',None)=='cuda':
+        torch.cuda.synchronize(device)
+    toc = time.time()
+    timer[key] = timer.get(key,0.) + toc - tic
+    return toc
+
+def _peak_memory(device):
+    """ peak memory in bytes: allocated on a GPU since the last call, otherwise the peak 
+    resident memory of the process """
+    if getattr(device,'type',None)=='cuda':
+        peak = torch.cuda.max_memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        return peak
+    # kB on Linux, bytes on macOS 
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform=='darwin' else 1024)
+
+class TrainBatches(torch.utils.data.Dataset):
+    """ Augmented training batches of _train_net(), for a DataLoader with worker processes. 
+    
+    Item k is the k-th batch of the whole training run (all epochs back to back). Each batch 
+    seeds the NumPy RNG with its own (epoch, batch) pair, so the augmentations are the same 
+    no matter which worker makes them or how many workers there are. 
+    The workers are spawned rather than forked, as forking a process that has loaded the 
+    numba threading layer is not safe, so each worker gets its own copy of the images. 
+    
+    Parameters
+    ----------
+    data: list of ND arrays
+        training images
+    labels: list of ND arrays
+        training labels
+    inds_all: int, 1D array
+        image order of all epochs, nimg_per_epoch images per epoch
+    nimg_per_epoch: int
+        number of images per epoch
+    batch_size: int
+        number of images per batch
+    rescale: float, 1D array
+        rescaling factor of each image (None to use 1.0)
+    fg_tables: list of ND arrays
+        foreground table of each label (optional)
+    flow_fields: list of ND arrays
+        precomputed flows of each label (optional)
+    kwargs:
+        any other parameters for transforms.random_rotate_and_resize()
+    
+    """
+    def __init__(self, data, labels, inds_all, nimg_per_epoch, batch_size, rescale=None, fg_tables=None, 
+                 flow_fields=None, **kwargs):
+        self.data = data
+        self.labels = labels
+        self.inds_all = inds_all
+        self.nimg_per_epoch = nimg_per_epoch
+        self.batch_size = batch_size
+        self.nbatch = int(np.ceil(nimg_per_epoch/batch_size))
+        self.rescale = rescale
+        self.fg_tables = fg_tables
+        self.flow_fields = flow_fields
+        self.kwargs = kwargs
+    
+    def __len__(self):
+        return (len(self.inds_all)//self.nimg_per_epoch) * self.nbatch
+    
+    def __getitem__(self, k):
+        iepoch, ibatch = divmod(k, self.nbatch)
+        np.random.seed([iepoch, ibatch])
+        rperm = self.inds_all[iepoch*self.nimg_per_epoch:(iepoch+1)*self.nimg_per_epoch]
+        inds = rperm[ibatch*self.batch_size:(ibatch+1)*self.batch_size]
+        rsc = self.rescale[inds] if self.rescale is not None else np.ones(len(inds), np.float32)
+        fg_tables = None if self.fg_tables is None else [self.fg_tables[i] for i in inds]
+        flow_fields = None if self.flow_fields is None else [self.flow_fields[i] for i in inds]
+        stats = {}
+        imgi, lbl, scale = transforms.random_rotate_and_resize([self.data[i] for i in inds], 
+                                                               Y=[self.labels[i] for i in inds],
+                                                               rescale=rsc, inds=inds, fg_tables=fg_tables,
+                                                               flow_fields=flow_fields,
+                                                               stats=stats, **self.kwargs)
+        return imgi, lbl, scale, stats
+    
+def _batch_collate(batch):
+    # batches are made whole by TrainBatches, so keep the numpy arrays as they are 
+    return batch
+
 class DerivativeLoss(torch.nn.Module):
     def __init__(self):
         super().__init__()
@@ -1,10 +1,11 @@
 import time, os
-from scipy.ndimage import maximum_filter1d, find_objects
+from scipy.ndimage import maximum_filter1d, maximum_filter, find_objects
 import torch
 import numpy as np
 import tifffile
 from tqdm import trange
-from numba import njit, float32, int32, vectorize
+import numba
+from numba import njit, prange, float32, int32, vectorize
 import cv2
 import fastremap
 
@@ -179,7 +180,8 @@ def masks_to_flows_cpu(masks, device=None):
     Center of masks where diffusion starts is defined to be the 
     closest pixel to the median of all pixels that is inside the 
     mask. Result of diffusion is converted into flows by computing
-    the gradients of the diffusion density map. 
+    the gradients of the diffusion density map. The masks are 
+    processed in parallel threads (_extend_centers_masks). 
     Parameters
     -------------
     masks: int, 2D array
@@ -198,39 +200,155 @@ def masks_to_flows_cpu(masks, device=None):
     mu = np.zeros((2, Ly, Lx), np.float64)
     mu_c = np.zeros((Ly, Lx), np.float64)
     
-    nmask = masks.max()
-    slices = find_objects(masks)
-    dia = utils.diameters(masks)[0]
+    masks = np.ascontiguousarray(masks, dtype=np.int32)
+    nmask = max(int(masks.max()), 0)
+    indptr, pix, bbox = _object_pixels(masks, nmask)
+    
+    # same as utils.diameters(masks)[0], from the pixel counts we already have 
+    counts = np.diff(indptr)
+    counts[0] = masks.size - pix.size
+    counts = counts[counts>0][1:]
+    dia = np.median(counts**0.5) if counts.size else 0
+    dia = (0 if np.isnan(dia) else dia) / ((np.pi**0.5)/2)
     s2 = (.15 * dia)**2
-    for i,si in enumerate(slices):
-        if si is not None:
-            sr,sc = si
-            ly, lx = sr.stop - sr.start + 1, sc.stop - sc.start + 1
-            y,x = np.nonzero(masks[sr, sc] == (i+1))
-            y = y.astype(np.int32) + 1
-            x = x.astype(np.int32) + 1
-            ymed = np.median(y)
-            xmed = np.median(x)
-            imin = np.argmin((x-xmed)**2 + (y-ymed)**2)
-            xmed = x[imin]
-            ymed = y[imin]
-            
-            d2 = (x-xmed)**2 + (y-ymed)**2
-            mu_c[sr.start+y-1, sc.start+x-1] = np.exp(-d2/s2)
-
-            niter = 2*np.int32(np.ptp(x) + np.ptp(y))
-            T = np.zeros((ly+2)*(lx+2), np.float64)
-            T = _extend_centers(T, y, x, ymed, xmed, np.int32(lx), np.int32(niter))
-            T[(y+1)*lx + x+1] = np.log(1.+T[(y+1)*lx + x+1])
-
-            dy = T[(y+1)*lx + x] - T[(y-1)*lx + x]
-            dx = T[y*lx + x+1] - T[y*lx + x-1]
-            mu[:, sr.start+y-1, sc.start+x-1] = np.stack((dy,dx))
+    
+    # largest objects first so that the threads finish together
+    labels = np.nonzero(np.diff(indptr)[1:])[0]+1
+    order = labels[np.argsort(-np.diff(indptr)[labels], kind='stable')].astype(np.int64)
+    _extend_centers_masks(indptr, pix, bbox, order, np.int64(Lx), s2, mu, mu_c)
 
     mu /= (1e-20 + (mu**2).sum(axis=0)**0.5)
 
     return mu, mu_c
 
+@njit('Tuple((int64[:], int64[:], int32[:,:]))(int32[:,:], int64)', nogil=True)
+def _object_pixels(masks, nmask):
+    """ pixels of each mask in raster order and bounding boxes
+    Parameters
+    --------------
+    masks: int32, 2D array
+        labelled masks 0=NO masks; 1,2,...=mask labels
+    nmask: int64
+        largest label
+    Returns
+    ---------------
+    indptr: int64, array
+        pixels of mask i are pix[indptr[i]:indptr[i+1]]
+    pix: int64, array
+        flat pixel indices
+    bbox: int32, 2D array
+        [ymin, xmin, ymax, xmax] of each mask
+    """
+    Ly, Lx = masks.shape
+    indptr = np.zeros(nmask+2, np.int64)
+    bbox = np.empty((nmask+1, 4), np.int32)
+    bbox[:,0] = Ly
+    bbox[:,1] = Lx
+    bbox[:,2] = -1
+    bbox[:,3] = -1
+    for y in range(Ly):
+        for x in range(Lx):
+            m = masks[y,x]
+            if m > 0:
+                indptr[m+1] += 1
+                bbox[m,0] = min(bbox[m,0], y)
+                bbox[m,1] = min(bbox[m,1], x)
+                bbox[m,2] = max(bbox[m,2], y)
+                bbox[m,3] = max(bbox[m,3], x)
+    for m in range(nmask+1):
+        indptr[m+1] += indptr[m]
+    pix = np.empty(indptr[-1], np.int64)
+    fill = indptr[:-1].copy()
+    for y in range(Ly):
+        for x in range(Lx):
+            m = masks[y,x]
+            if m > 0:
+                pix[fill[m]] = y*Lx + x
+                fill[m] += 1
+    return indptr, pix, bbox
+
+@njit('void(int64[:], int64[:], int32[:,:], int64[:], int64, float64, float64[:,:,:], float64[:,:])', 
+      parallel=True, nogil=True, error_model='numpy')
+def _extend_centers_masks(indptr, pix, bbox, order, Lx, s2, mu, mu_c):
+    """ run _extend_centers on every mask in parallel and write the unnormalized flows 
+    Parameters
+    --------------
+    indptr, pix, bbox: 
+        output of _object_pixels
+    order: int64, array
+        labels to process, each thread takes every nthreads-th one 
+    Lx: int64
+        size of x-dimension of masks
+    s2: float64
+        squared width of the gaussian center distance mu_c
+    mu: float64, 3D array
+        flows [2 x Ly x Lx], filled in place
+    mu_c: float64, 2D array
+        center distance, filled in place
+    """
+    nthreads = min(numba.get_num_threads(), len(order))
+    for t in prange(nthreads):
+        # per-thread buffers, sized for the largest mask of this thread
+        size = 0
+        npix = 0
+        for k in range(t, len(order), nthreads):
+            i = order[k]
+            size = max(size, (bbox[i,2]-bbox[i,0]+4)*(bbox[i,3]-bbox[i,1]+4))
+            npix = max(npix, indptr[i+1]-indptr[i])
+        Tbuf = np.empty(size, np.float64)
+        new = np.empty(npix, np.float64)
+        ybuf = np.empty(npix, np.int32)
+        xbuf = np.empty(npix, np.int32)
+        for k in range(t, len(order), nthreads):
+            i = order[k]
+            n = indptr[i+1]-indptr[i]
+            y0, x0 = bbox[i,0], bbox[i,1]
+            ly = bbox[i,2]-y0+2
+            lx = bbox[i,3]-x0+2
+            y = ybuf[:n]
+            x = xbuf[:n]
+            for j in range(n):
+                p = pix[indptr[i]+j]
+                y[j] = p//Lx - y0 + 1
+                x[j] = p%Lx - x0 + 1
+            
+            # center is the mask pixel closest to the median
+            ymed = np.median(y)
+            xmed = np.median(x)
+            imin = 0
+            dmin = np.inf
+            for j in range(n):
+                dj = (x[j]-xmed)**2 + (y[j]-ymed)**2
+                if dj < dmin:
+                    dmin = dj
+                    imin = j
+            xm = x[imin]
+            ym = y[imin]
+            for j in range(n):
+                d2 = (x[j]-xm)**2 + (y[j]-ym)**2
+                mu_c[y0+y[j]-1, x0+x[j]-1] = np.exp(-d2/s2)
+            
+            niter = 2*np.int32(x.max()-x.min() + y.max()-y.min())
+            T = Tbuf[:(ly+2)*(lx+2)]
+            T[:] = 0
+            for it in range(niter):
+                T[ym*lx + xm] += 1
+                for j in range(n):
+                    yj, xj = y[j], x[j]
+                    new[j] = 1/9. * (T[yj*lx + xj] + T[(yj-1)*lx + xj]   + T[(yj+1)*lx + xj] +
+                                                     T[yj*lx + xj-1]     + T[yj*lx + xj+1] +
+                                                     T[(yj-1)*lx + xj-1] + T[(yj-1)*lx + xj+1] +
+                                                     T[(yj+1)*lx + xj-1] + T[(yj+1)*lx + xj+1])
+                for j in range(n):
+                    T[y[j]*lx + x[j]] = new[j]
+            for j in range(n):
+                c = (y[j]+1)*lx + x[j]+1
+                T[c] = np.log(1.+T[c])
+            for j in range(n):
+                yj, xj = y[j], x[j]
+                mu[0, y0+yj-1, x0+xj-1] = T[(yj+1)*lx + xj] - T[(yj-1)*lx + xj]
+                mu[1, y0+yj-1, x0+xj-1] = T[yj*lx + xj+1] - T[yj*lx + xj-1]
+
 
 def masks_to_flows(masks, use_gpu=False, device=None):
     """ convert masks to flows using diffusion from center pixel
@@ -344,7 +462,7 @@ def labels_to_flows(labels, files=None, use_gpu=False, device=None, redo_flows=F
 
 
 @njit(['(int16[:,:,:], float32[:], float32[:], float32[:,:])', 
-        '(float32[:,:,:], float32[:], float32[:], float32[:,:])'], cache=True)
+        '(float32[:,:,:], float32[:], float32[:], float32[:,:])'], cache=True, parallel=True, nogil=True)
 def map_coordinates(I, yc, xc, Y):
     """
     bilinear interpolation of image 'I' in-place with ycoordinates yc and xcoordinates xc to Y
@@ -364,7 +482,7 @@ def map_coordinates(I, yc, xc, Y):
     xc_floor = xc.astype(np.int32)
     yc = yc - yc_floor
     xc = xc - xc_floor
-    for i in range(yc_floor.shape[0]):
+    for i in prange(yc_floor.shape[0]):
         yf = min(Ly-1, max(0, yc_floor[i]))
         xf = min(Lx-1, max(0, xc_floor[i]))
         yf1= min(Ly-1, yf+1)
@@ -431,21 +549,64 @@ def steps2D_interp(p, dP, niter, use_gpu=False, device=None, omni=False, calc_tr
         
         return p, tr
     else:
-        dPt = np.zeros(p.shape, np.float32)
-        if calc_trace:
-            tr = np.zeros((p.shape[0],p.shape[1],niter))
+        # all steps of all points in one parallel call, see _steps2D_interp
+        if omni and OMNI_INSTALLED:
+            factors = np.array([step_factor(t) for t in range(niter)], np.float32)
         else:
-            tr = None
-            
-        for t in range(niter):
+            factors = np.ones(niter, np.float32)
+        tr = np.zeros((p.shape[0],p.shape[1],niter) if calc_trace else (0,0,0))
+        p = np.ascontiguousarray(p, np.float32)
+        _steps2D_interp(p, np.ascontiguousarray(dP, np.float32), factors, tr, calc_trace)
+        return p, (tr if calc_trace else None)
+
+@njit('void(float32[:,:], float32[:,:,:], float32[:], float64[:,:,:], boolean)', parallel=True, nogil=True)
+def _steps2D_interp(p, dP, factors, tr, calc_trace):
+    """
+    Euler integration of points p in place, sampling dP bilinearly as in map_coordinates
+    
+    Points are independent, so each thread runs all the steps of its own points. 
+    
+    Parameters
+    -------------
+    p : 2 x ni
+        y and x coordinates of the points, updated in place
+    dP : 2 x Ly x Lx
+        flows
+    factors : niter
+        each step is divided by factors[t]
+    tr : 2 x ni x niter
+        point locations before each step (only filled if calc_trace)
+    """
+    C,Ly,Lx = dP.shape
+    for i in prange(p.shape[1]):
+        yc = np.float32(p[0,i])
+        xc = np.float32(p[1,i])
+        for t in range(factors.shape[0]):
             if calc_trace:
-                tr[:,:,t] = p.copy()
-            map_coordinates(dP.astype(np.float32), p[0], p[1], dPt)
-            if omni and OMNI_INSTALLED:
-                dPt /= step_factor(t)
-            for k in range(len(p)):
-                p[k] = np.minimum(shape[k]-1, np.maximum(0, p[k] + dPt[k]))
-        return p, tr
+                tr[0,i,t] = yc
+                tr[1,i,t] = xc
+            yc_floor = np.int32(yc)
+            xc_floor = np.int32(xc)
+            # same mixed float32/float64 typing as map_coordinates
+            y = np.float32(yc - np.float32(yc_floor))
+            x = np.float32(xc - np.float32(xc_floor))
+            yf = min(Ly-1, max(0, yc_floor))
+            xf = min(Lx-1, max(0, xc_floor))
+            yf1= min(Ly-1, yf+1)
+            xf1= min(Lx-1, xf+1)
+            dy = np.float32(np.float32(dP[0, yf, xf] * (1 - y) * (1 - x) +
+                                       dP[0, yf, xf1] * (1 - y) * x +
+                                       dP[0, yf1, xf] * y * (1 - x) +
+                                       dP[0, yf1, xf1] * y * x ) / factors[t])
+            dx = np.float32(np.float32(dP[1, yf, xf] * (1 - y) * (1 - x) +
+                                       dP[1, yf, xf1] * (1 - y) * x +
+                                       dP[1, yf1, xf] * y * (1 - x) +
+                                       dP[1, yf1, xf1] * y * x ) / factors[t])
+            # keep the float32 arithmetic of the array version
+            yc = np.float32(min(np.float32(Ly-1), max(np.float32(0), np.float32(yc + dy))))
+            xc = np.float32(min(np.float32(Lx-1), max(np.float32(0), np.float32(xc + dx))))
+        p[0,i] = yc
+        p[1,i] = xc
 
 
 @njit('(float32[:,:,:,:],float32[:,:,:,:], int32[:,:], int32)', nogil=True)
@@ -676,8 +837,6 @@ def get_masks(p, iscell=None, rpad=20, flows=None, threshold=0.4, use_gpu=False,
     
     """
     
-    pflows = []
-    edges = []
     shape0 = p.shape[1:]
     dims = len(p)
     if iscell is not None:
@@ -690,59 +849,26 @@ def get_masks(p, iscell=None, rpad=20, flows=None, threshold=0.4, use_gpu=False,
         for i in range(dims):
             p[i, ~iscell] = inds[i][~iscell]
 
-    for i in range(dims):
-        pflows.append(p[i].flatten().astype('int32'))
-        edges.append(np.arange(-.5-rpad, shape0[i]+.5+rpad, 1))
-
-    h,_ = np.histogramdd(tuple(pflows), bins=edges)
+    shape = tuple(np.array(shape0)+2*rpad)
+    # histogram of final pixel locations on the padded grid, as a bincount of flat indices
+    pflows = [p[i].flatten().astype('int32')+rpad for i in range(dims)]
+    inside = np.all([(pf>=0) & (pf<s) for pf,s in zip(pflows,shape)], axis=0)
+    pflows = np.ravel_multi_index(tuple(pflows), shape, mode='clip')
+    h = np.bincount(pflows[inside], minlength=np.prod(shape)).reshape(shape)
     hmax = h.copy()
     for i in range(dims):
         hmax = maximum_filter1d(hmax, 5, axis=i)
 
     seeds = np.nonzero(np.logical_and(h-hmax>-1e-6, h>10))
-    Nmax = h[seeds]
-    isort = np.argsort(Nmax)[::-1]
-    for s in seeds:
-        s = s[isort]
-
-    pix = list(np.array(seeds).T)
-
-    shape = h.shape
-    if dims==3:
-        expand = np.nonzero(np.ones((3,3,3)))
-    else:
-        expand = np.nonzero(np.ones((3,3)))
-    for e in expand:
-        e = np.expand_dims(e,1)
 
+    # extend the seeds for 5 steps through pixels with more than 2 final locations; 
+    # later seeds overwrite earlier ones, so this is a running maximum of the seed labels 
+    M = np.zeros(shape, np.uint32)
+    M[seeds] = np.arange(1, len(seeds[0])+1)
+    good = h > 2
     for iter in range(5):
-        for k in range(len(pix)):
-            if iter==0:
-                pix[k] = list(pix[k])
-            newpix = []
-            iin = []
-            for i,e in enumerate(expand):
-                epix = e[:,np.newaxis] + np.expand_dims(pix[k][i], 0) - 1
-                epix = epix.flatten()
-                iin.append(np.logical_and(epix>=0, epix<shape[i]))
-                newpix.append(epix)
-            iin = np.all(tuple(iin), axis=0)
-            for p in newpix:
-                p = p[iin]
-            newpix = tuple(newpix)
-            igood = h[newpix]>2
-            for i in range(dims):
-                pix[k][i] = newpix[i][igood]
-            if iter==4:
-                pix[k] = tuple(pix[k])
-    
-    M = np.zeros(h.shape, np.uint32)
-    for k in range(len(pix)):
-        M[pix[k]] = 1+k
-        
-    for i in range(dims):
-        pflows[i] = pflows[i] + rpad
-    M0 = M[tuple(pflows)]
+        M = maximum_filter(M, size=3, mode='constant') * good
+    M0 = M.ravel()[pflows]
 
     # remove big masks
     uniq, counts = fastremap.unique(M0, return_counts=True)
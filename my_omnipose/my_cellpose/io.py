@@ -1,4 +1,5 @@
 import os, datetime, gc, warnings, glob
+from collections import OrderedDict
 from natsort import natsorted
 import numpy as np
 import cv2
@@ -87,6 +88,95 @@ def imread(filename):
             io_logger.critical('ERROR: could not read file, %s'%e)
             return None
 
+def imread_mmap(filename):
+    """ imread() that memory-maps uncompressed TIFF and .npy files instead of reading them. """
+    ext = os.path.splitext(filename)[-1]
+    if ext=='.npy':
+        return np.load(filename, mmap_mode='r')
+    if ext== '.tif' or ext=='.tiff':
+        try:
+            return tifffile.memmap(filename, mode='r')
+        except ValueError: # compressed or tiled, not mappable
+            pass
+    return imread(filename)
+
+def imread_label_flows(label_name, flow_name):
+    """ Read a label file together with its precomputed flows, as in load_train_test_data(). """
+    label = imread_mmap(label_name)
+    flows = imread_mmap(flow_name)
+    if flows.shape[0]<4:
+        return np.concatenate((label[np.newaxis,:,:], flows), axis=0) 
+    return flows
+
+class LazyArrays():
+    """ List of images (or labels) that are read from disk when indexed. 
+    
+    The file list is fixed at construction, files are read (memory-mapped where possible, see 
+    imread_mmap()) and passed through the transforms on first access, and the results are kept 
+    in a least-recently-used cache holding at most cache_bytes. This lets the training functions 
+    run on datasets that do not fit in memory; map() and subset() stand in for the list 
+    comprehensions they would otherwise use. The cache is not pickled, so worker processes 
+    start empty and read the files themselves. 
+    
+    Parameters
+    ----------
+    files: list
+        file names, or tuples of arguments to load 
+    load: callable
+        reads one entry of files (default imread_mmap())
+    transforms: list of callables
+        applied in order to each array after it is read; must be picklable for worker processes
+    cache_bytes: int
+        byte budget of the cache (default 1 GB)
+    
+    """
+    def __init__(self, files, load=imread_mmap, transforms=(), cache_bytes=2**30):
+        self.files = list(files)
+        self.load = load
+        self.transforms = list(transforms)
+        self.cache_bytes = cache_bytes
+        self._cache = OrderedDict()
+        self._nbytes = 0
+        
+    def __len__(self):
+        return len(self.files)
+    
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+    
+    def __getitem__(self, i):
+        if i in self._cache:
+            self._cache.move_to_end(i)
+            return self._cache[i]
+        f = self.files[i]
+        arr = self.load(*f) if isinstance(f, tuple) else self.load(f)
+        for t in self.transforms:
+            arr = t(arr)
+        # evict the least recently used arrays until the new one fits (it is always kept)
+        self._cache[i] = arr
+        self._nbytes += arr.nbytes
+        while self._nbytes > self.cache_bytes and len(self._cache) > 1:
+            _, old = self._cache.popitem(last=False)
+            self._nbytes -= old.nbytes
+        return arr
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cache'] = OrderedDict()
+        state['_nbytes'] = 0
+        return state
+    
+    def map(self, transform):
+        """ Same files with transform applied after the current transforms. """
+        return LazyArrays(self.files, load=self.load, transforms=self.transforms+[transform], 
+                          cache_bytes=self.cache_bytes)
+    
+    def subset(self, inds):
+        """ Entries inds of the list, in that order. """
+        return LazyArrays([self.files[i] for i in inds], load=self.load, transforms=self.transforms, 
+                          cache_bytes=self.cache_bytes)
+
 def imsave(filename, arr):
     ext = os.path.splitext(filename)[-1]
     if ext== '.tif' or ext=='.tiff':
@@ -233,40 +323,48 @@ def get_label_files(img_names, label_filter='_cp_masks', img_filter='', ext=None
         return label_paths
 
 # edited to allow omni to not read in training flows if any exist; flows computed on-the-fly and code expects this 
-def load_train_test_data(train_dir, test_dir=None, image_filter='', mask_filter='_masks', unet=False, look_one_level_down=True, omni=False):
+def load_train_test_data(train_dir, test_dir=None, image_filter='', mask_filter='_masks', unet=False, look_one_level_down=True, omni=False,
+                         lazy=False, cache_bytes=2**30):
+    """ Read the images and labels (and flows, for Cellpose) of a training and an optional test directory. 
+    With lazy, these are LazyArrays that read the files when indexed, each caching at most cache_bytes. 
+    """
     image_names = get_image_files(train_dir, mask_filter, image_filter, look_one_level_down)
-    nimg = len(image_names)
-    images = [imread(image_names[n]) for n in range(nimg)]
-
-    # training data
     label_names, flow_names = get_label_files(image_names, label_filter=mask_filter, img_filter=image_filter, flows=True)
+    images, labels = _load_images_labels(image_names, label_names, 
+                                         flow_names if not unet and not omni else None,
+                                         lazy, cache_bytes)
+
+    # testing data
+    test_images, test_labels, image_names_test = None, None, None
+    if test_dir is not None:
+        image_names_test = get_image_files(test_dir, mask_filter, image_filter, look_one_level_down)
+        label_names_test, flow_names_test = get_label_files(image_names_test, label_filter=mask_filter, img_filter=image_filter, flows=True)
+        test_images, test_labels = _load_images_labels(image_names_test, label_names_test, 
+                                                       flow_names_test if not unet else None, 
+                                                       lazy, cache_bytes)
+    return images, labels, image_names, test_images, test_labels, image_names_test
+
+def _load_images_labels(image_names, label_names, flow_names, lazy, cache_bytes):
+    """ images and labels (joined with their flows if flow_names is given) for load_train_test_data() """
+    if lazy:
+        images = LazyArrays(image_names, cache_bytes=cache_bytes)
+        if flow_names is not None:
+            labels = LazyArrays(list(zip(label_names, flow_names)), load=imread_label_flows, cache_bytes=cache_bytes)
+        else:
+            labels = LazyArrays(label_names, cache_bytes=cache_bytes)
+        return images, labels
+    
     nimg = len(image_names)
+    images = [imread(image_names[n]) for n in range(nimg)]
     labels = [imread(label_names[n]) for n in range(nimg)]
-    if flow_names is not None and not unet and not omni:
+    if flow_names is not None:
         for n in range(nimg):
             flows = imread(flow_names[n])
             if flows.shape[0]<4:
                 labels[n] = np.concatenate((labels[n][np.newaxis,:,:], flows), axis=0) 
             else:
                 labels[n] = flows
-
-    # testing data
-    test_images, test_labels, image_names_test = None, None, None
-    if test_dir is not None:
-        image_names_test = get_image_files(test_dir, mask_filter, image_filter, look_one_level_down)
-        label_names_test, flow_names_test = get_label_files(image_names_test, label_filter=mask_filter, img_filter=image_filter, flows=True)
-        
-        nimg = len(image_names_test)
-        test_images = [imread(image_names_test[n]) for n in range(nimg)]
-        test_labels = [imread(label_names_test[n]) for n in range(nimg)]
-        if flow_names_test is not None and not unet:
-            for n in range(nimg):
-                flows = imread(flow_names_test[n])
-                if flows.shape[0]<4:
-                    test_labels[n] = np.concatenate((test_labels[n][np.newaxis,:,:], flows), axis=0) 
-                else:
-                    test_labels[n] = flows
-    return images, labels, image_names, test_images, test_labels, image_names_test
+    return images, labels
 
 
 
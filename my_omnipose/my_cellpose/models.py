@@ -13,7 +13,7 @@ from scipy.ndimage import gaussian_filter, zoom
 import logging
 models_logger = logging.getLogger(__name__)
 
-from . import transforms, dynamics, utils, plot
+from . import transforms, dynamics, utils, plot, io
 from .core import UnetModel, assign_device, check_mkl, MXNET_ENABLED, parse_model_string
 from .io import OMNI_INSTALLED
 
@@ -148,7 +148,8 @@ class Cellpose():
              interp=True, cluster=False, flow_threshold=0.4, mask_threshold=0.0, 
              cellprob_threshold=None, dist_threshold=None, diam_threshold=12., min_size=15,
              stitch_threshold=0.0, rescale=None, progress=None, omni=False, verbose=False,
-             transparency=False, model_loaded=False):
+             transparency=False, model_loaded=False, time_series=False, chunk_size=None, 
+             flow_per_object=False):
         """ run cellpose and get masks
 
         Parameters
@@ -250,6 +251,15 @@ class Cellpose():
         model_loaded: bool (optional, default False)
             internal variable for determining if model has been loaded, used in __main__.py
 
+        time_series: bool (optional, default False)
+            treat the images of a stack as consecutive frames of a time-lapse, see CellposeModel.eval
+
+        chunk_size: int (optional, default None)
+            compute the masks of large 2D images in blocks of this size, see CellposeModel.eval
+
+        flow_per_object: bool (optional, default False)
+            compute the flow error object by object, see CellposeModel.eval
+
         Returns
         -------
         masks: list of 2D arrays, or single 3D array (if do_3D=True)
@@ -331,7 +341,10 @@ class Cellpose():
                                             omni=omni,
                                             verbose=verbose,
                                             transparency=transparency,
-                                            model_loaded=model_loaded)
+                                            model_loaded=model_loaded,
+                                            time_series=time_series,
+                                            chunk_size=chunk_size,
+                                            flow_per_object=flow_per_object)
         models_logger.info('>>>> TOTAL TIME %0.2f sec'%(time.time()-tic0))
     
         return masks, flows, styles, diams
@@ -491,7 +504,8 @@ class CellposeModel(UnetModel):
              flow_threshold=0.4, mask_threshold=0.0, diam_threshold=12.,
              cellprob_threshold=None, dist_threshold=None, flow_factor=5.0,
              compute_masks=True, min_size=15, stitch_threshold=0.0, progress=None, omni=False, 
-             calc_trace=False, verbose=False, transparency=False, loop_run=False, model_loaded=False):
+             calc_trace=False, verbose=False, transparency=False, loop_run=False, model_loaded=False,
+             time_series=False, chunk_size=None, flow_per_object=False):
         """
             segment list of images x, or 4D array - Z x nchan x Y x X
 
@@ -599,6 +613,22 @@ class CellposeModel(UnetModel):
             model_loaded: bool (optional, default False)
                 internal variable for determining if model has been loaded, used in __main__.py
 
+            time_series: bool (optional, default False)
+                treat the images of a stack as consecutive frames of a time-lapse (Omnipose 2D only): 
+                the dynamics of each frame start from the final pixel locations of the previous frame
+                where the flow did not change, see my_omnipose.core.compute_masks_series
+
+            chunk_size: int (optional, default None)
+                reconstruct the masks of 2D images larger than this in overlapping blocks of this size 
+                (Omnipose only), so that the memory of the dynamics is set by the block size, see 
+                my_omnipose.core.compute_masks_chunked. The final pixel locations (flows[k][4]) are 
+                not assembled in this mode
+
+            flow_per_object: bool (optional, default False)
+                solve the reference flows of the flow_threshold QC per object instead of over the 
+                whole image (Omnipose 2D only), faster on images with many cells but not identical, 
+                see my_omnipose.core.flow_error
+
             Returns
             -------
             masks: list of 2D arrays, or single 3D array (if do_3D=True)
@@ -665,7 +695,10 @@ class CellposeModel(UnetModel):
                                                  verbose=verbose,
                                                  transparency=transparency,
                                                  loop_run=(i>0),
-                                                 model_loaded=model_loaded)
+                                                 model_loaded=model_loaded,
+                                                 time_series=time_series,
+                                                 chunk_size=chunk_size,
+                                                 flow_per_object=flow_per_object)
                 masks.append(maski)
                 flows.append(flowi)
                 styles.append(stylei)
@@ -685,7 +718,7 @@ class CellposeModel(UnetModel):
                     net.collect_params().grad_req = 'null'
 
             x = transforms.convert_image(x, channels, channel_axis=channel_axis, z_axis=z_axis,
-                                         do_3D=(do_3D or stitch_threshold>0), normalize=False, 
+                                         do_3D=(do_3D or stitch_threshold>0 or time_series), normalize=False, 
                                          invert=False, nchan=self.nchan, dim=self.dim, omni=omni)
             if x.ndim < self.dim+2: # we need nimg x dims x channels, so 2D has 4, 3D has 5, etc. 
                 x = x[np.newaxis]
@@ -716,7 +749,10 @@ class CellposeModel(UnetModel):
                                                           stitch_threshold=stitch_threshold,
                                                           omni=omni,
                                                           calc_trace=calc_trace,
-                                                          verbose=verbose)
+                                                          verbose=verbose,
+                                                          time_series=time_series,
+                                                          chunk_size=chunk_size,
+                                                          flow_per_object=flow_per_object)
             flows = [plot.dx_to_circ(dP,transparency=transparency), dP, cellprob, p, bd, tr]
             return masks, flows, styles
 
@@ -725,7 +761,8 @@ class CellposeModel(UnetModel):
                 augment=False, tile=True, tile_overlap=0.1,
                 mask_threshold=0.0, diam_threshold=12., flow_threshold=0.4, flow_factor=5.0, min_size=15,
                 interp=True, cluster=False, anisotropy=1.0, do_3D=False, stitch_threshold=0.0,
-                omni=False, calc_trace=False, verbose=False):
+                omni=False, calc_trace=False, verbose=False, time_series=False, chunk_size=None, 
+                flow_per_object=False):
         
         tic = time.time()
         shape = x.shape
@@ -840,45 +877,94 @@ class CellposeModel(UnetModel):
                 masks, p, tr = [], [], []
                 resize = shape[-(self.dim+1):-1] if not resample else None 
                 # print('compute masks 2',resize,shape,resample)
-                for i in iterator:
-                    if not (omni and OMNI_INSTALLED):
+                if omni and OMNI_INSTALLED and self.dim==2 and chunk_size is not None and max(dP.shape[2:]) > chunk_size:
+                    # run omnipose compute_masks block by block, without a full-size copy of the pixel locations
+                    if time_series:
+                        models_logger.warning('time_series is not used with chunk_size, running frames independently')
+                    for i in iterator:
+                        outputs = my_omnipose.core.compute_masks_chunked(dP[:,i], cellprob[i], 
+                                                                      bd=None if bd is None else bd[i], 
+                                                                      chunk_size=chunk_size,
+                                                                      return_p=False,
+                                                                      niter=niter, 
+                                                                      rescale=rescale, 
+                                                                      resize=resize,
+                                                                      min_size=min_size, 
+                                                                      mask_threshold=mask_threshold,   
+                                                                      diam_threshold=diam_threshold,
+                                                                      flow_threshold=flow_threshold, 
+                                                                      flow_per_object=flow_per_object,
+                                                                      flow_factor=flow_factor,             
+                                                                      interp=interp, 
+                                                                      cluster=cluster, 
+                                                                      verbose=verbose,
+                                                                      use_gpu=False, 
+                                                                      device=torch.device('cpu'), 
+                                                                      nclasses=self.nclasses, 
+                                                                      dim=self.dim)
+                        masks.append(outputs[0])
+                        p.append(np.zeros(0))
+                        tr.append(outputs[2])
+                elif omni and OMNI_INSTALLED and time_series and nimg > 1:
+                    # run omnipose compute_masks frame by frame, reusing the dynamics of the previous frame
+                    masks, p, tr = my_omnipose.core.compute_masks_series(np.moveaxis(dP,1,0), cellprob, bd, 
+                                                                      niter=niter, 
+                                                                      rescale=rescale, 
+                                                                      resize=resize,
+                                                                      tqdm_out=tqdm_out,
+                                                                      min_size=min_size, 
+                                                                      mask_threshold=mask_threshold,   
+                                                                      diam_threshold=diam_threshold,
+                                                                      flow_threshold=flow_threshold, 
+                                                                      flow_per_object=flow_per_object,
+                                                                      flow_factor=flow_factor,             
+                                                                      interp=interp, 
+                                                                      cluster=cluster, 
+                                                                      calc_trace=calc_trace, 
+                                                                      verbose=verbose,
+                                                                      use_gpu=False, 
+                                                                      device=torch.device('cpu'), 
+                                                                      nclasses=self.nclasses, 
+                                                                      dim=self.dim)
+                elif omni and OMNI_INSTALLED:
+                    # run omnipose compute_masks on the whole stack, integrating all frames together
+                    
+                    # important: resampling means that pixels need to go farther to cluser together;
+                    # niter should be determined by dist, first of all; it currently is already scaled for resampling, good! 
+                    # dP needs to be scaled for magnitude to get pixels to move the same relative distance
+                    # eps probably should be left the same if the above are changed 
+                    masks, p, tr = my_omnipose.core.compute_masks_batch(np.moveaxis(dP,1,0), cellprob, bd, 
+                                                                     niter=niter, 
+                                                                     rescale=rescale, 
+                                                                     resize=resize,
+                                                                     tqdm_out=tqdm_out if nimg>1 else None,
+                                                                     batch_size=8, # bounds the memory on long stacks
+                                                                     min_size=min_size, 
+                                                                     mask_threshold=mask_threshold,   
+                                                                     diam_threshold=diam_threshold,
+                                                                     flow_threshold=flow_threshold, 
+                                                                     flow_per_object=flow_per_object,
+                                                                     flow_factor=flow_factor,             
+                                                                     interp=interp, 
+                                                                     cluster=cluster, 
+                                                                     calc_trace=calc_trace, 
+                                                                     verbose=verbose,
+                                                                     use_gpu=False, 
+                                                                     device=torch.device('cpu'), 
+                                                                     nclasses=self.nclasses, 
+                                                                     dim=self.dim)
+                else:
+                    if time_series:
+                        models_logger.warning('time_series is only used with omni, running frames independently')
+                    for i in iterator:
                         # run cellpose compute_masks
                         outputs = dynamics.compute_masks(dP[:,i], cellprob[i], niter=niter, mask_threshold=mask_threshold,
                                                          flow_threshold=flow_threshold, interp=interp, resize=resize, verbose=verbose,
                                                          use_gpu=False, device=torch.device('cpu'), nclasses=self.nclasses,
                                                          calc_trace=calc_trace)
-                    else:
-                        # run omnipose compute_masks
-                        
-                        # important: resampling means that pixels need to go farther to cluser together;
-                        # niter should be determined by dist, first of all; it currently is already scaled for resampling, good! 
-                        # dP needs to be scaled for magnitude to get pixels to move the same relative distance
-                        # eps probably should be left the same if the above are changed 
-                        # if resample:
-                        #     print('rescale is',rescale,resize)
-                            # dP[:,i] /= rescale this does nothign here since I normalize the flow anyway, have to pass in 
-                        
-                        bdi = bd[i] if bd is not None else None
-                        outputs = my_omnipose.core.compute_masks(dP[:,i], cellprob[i], bdi, 
-                                                              niter=niter, 
-                                                              rescale=rescale, 
-                                                              resize=resize,
-                                                              min_size=min_size, 
-                                                              mask_threshold=mask_threshold,   
-                                                              diam_threshold=diam_threshold,
-                                                              flow_threshold=flow_threshold, 
-                                                              flow_factor=flow_factor,             
-                                                              interp=interp, 
-                                                              cluster=cluster, 
-                                                              calc_trace=calc_trace, 
-                                                              verbose=verbose,
-                                                              use_gpu=False, 
-                                                              device=torch.device('cpu'), 
-                                                              nclasses=self.nclasses, 
-                                                              dim=self.dim) 
-                    masks.append(outputs[0])
-                    p.append(outputs[1])
-                    tr.append(outputs[2])
+                        masks.append(outputs[0])
+                        p.append(outputs[1])
+                        tr.append(outputs[2])
                 
                 masks = np.array(masks)
                 p = np.array(p)
@@ -920,7 +1006,9 @@ class CellposeModel(UnetModel):
               save_path=None, save_every=100, save_each=False,
               learning_rate=0.2, n_epochs=500, momentum=0.9, SGD=True,
               weight_decay=0.00001, batch_size=8, nimg_per_epoch=None,
-              rescale=True, min_train_masks=5, netstr=None, tyx=None):
+              rescale=True, min_train_masks=5, netstr=None, tyx=None, num_workers=0, flow_cache=None,
+              do_autocast=False, accumulate=1, resume=False, eval_every=1, checkpoint_every=None,
+              log_timings=False):
 
         """ train network with images train_data 
         
@@ -928,11 +1016,11 @@ class CellposeModel(UnetModel):
             ------------------
 
             train_data: list of arrays (2D or 3D)
-                images for training
+                images for training, or io.LazyArrays to read them from disk as needed
 
             train_labels: list of arrays (2D or 3D)
                 labels for train_data, where 0=no masks; 1,2,...=mask labels
-                can include flows as additional images
+                can include flows as additional images; or io.LazyArrays to read them from disk as needed
 
             train_files: list of strings
                 file names for images in train_data (to save flows for future runs)
@@ -989,6 +1077,37 @@ class CellposeModel(UnetModel):
             netstr: str (default, None)
                 name of network, otherwise saved with name as params + training start time
 
+            num_workers: int (default, 0)
+                number of worker processes preparing augmented batches ahead of the training loop,
+                0 makes them in the training loop
+
+            flow_cache: str (default, None)
+                directory in which the smooth distance and flows of each training label are cached (Omnipose only). 
+                If given, these are computed once and warped into each crop instead of being recomputed per crop, 
+                see my_omnipose.core.flow_warp_error for the difference this makes
+
+            do_autocast: bool (default, False)
+                train in mixed precision (fp16 on the GPU, bf16 on the CPU)
+
+            accumulate: int (default, 1)
+                number of batches whose gradients are summed per optimizer step, 
+                giving an effective batch size of accumulate*batch_size
+
+            resume: bool or str (default, False)
+                continue training from a checkpoint, either the given checkpoint file or, 
+                if True, the checkpoint of the run named netstr in save_path/models
+
+            eval_every: int (default, 1)
+                compute the loss on test_data every eval_every epochs (and after the last epoch)
+
+            checkpoint_every: int (default, None)
+                write the training state for resume every checkpoint_every epochs (and after 
+                the last epoch), every save_every epochs if None
+
+            log_timings: bool (default, False)
+                log the time spent on each training phase per epoch to <run name>_timings.jsonl 
+                in save_path/models; this synchronizes the GPU several times per batch
+
         """
         if rescale:
             models_logger.info(f'Training with rescale = {rescale:.2f}')
@@ -1005,15 +1124,24 @@ class CellposeModel(UnetModel):
         if self.omni and OMNI_INSTALLED:
             models_logger.info('No precomuting flows with Omnipose. Computed during training.')
             
-            train_labels = [my_omnipose.utils.format_labels(label) for label in train_labels]
+            if isinstance(train_labels, io.LazyArrays):
+                train_labels = train_labels.map(my_omnipose.utils.format_labels)
+            else:
+                train_labels = [my_omnipose.utils.format_labels(label) for label in train_labels]
             nmasks = np.array([label.max() for label in train_labels])
 
         else:
+            if isinstance(train_labels, io.LazyArrays):
+                models_logger.warning('Cellpose flows are computed up front, reading all train labels into memory')
+                train_labels = list(train_labels)
             train_labels = labels_to_flows(train_labels, files=train_files, use_gpu=self.gpu, device=self.device, dim=self.dim)
             nmasks = np.array([label[0].max() for label in train_labels])
 
-        if run_test:
-            test_labels = labels_to_flows(test_labels, files=test_files, use_gpu=self.gpu, device=self.device)
+        if run_test and self.omni and OMNI_INSTALLED:
+            # like the train labels, test flows are made with the crops 
+            test_labels = [my_omnipose.utils.format_labels(label) for label in test_labels]
+        elif run_test:
+            test_labels = labels_to_flows(list(test_labels), files=test_files, use_gpu=self.gpu, device=self.device)
         else:
             test_labels = None
 
@@ -1021,8 +1149,17 @@ class CellposeModel(UnetModel):
         if nremove > 0:
             models_logger.warning(f'{nremove} train images with number of masks less than min_train_masks ({min_train_masks}), removing from train set')
             ikeep = np.nonzero(nmasks >= min_train_masks)[0]
-            train_data = [train_data[i] for i in ikeep]
-            train_labels = [train_labels[i] for i in ikeep]
+            train_data = train_data.subset(ikeep) if isinstance(train_data, io.LazyArrays) else [train_data[i] for i in ikeep]
+            train_labels = train_labels.subset(ikeep) if isinstance(train_labels, io.LazyArrays) else [train_labels[i] for i in ikeep]
+
+        # coarse foreground counts for drawing training crops that contain cells
+        fg_tables = [my_omnipose.core.foreground_table(label) for label in train_labels] if self.omni and OMNI_INSTALLED else None
+        
+        flow_fields = None
+        if flow_cache is not None and self.omni and OMNI_INSTALLED:
+            tic = time.time()
+            flow_fields = [my_omnipose.core.flow_field(label, dim=self.dim, cache_dir=flow_cache) for label in train_labels]
+            models_logger.info(f'Flows of {len(flow_fields)} train images loaded or computed in %0.1fs (cache {flow_cache})'%(time.time()-tic))
 
         if channels is None:
             models_logger.warning('channels is set to None, input must therefore have nchan channels (default is 2)')
@@ -1032,7 +1169,11 @@ class CellposeModel(UnetModel):
                                      learning_rate=learning_rate, n_epochs=n_epochs, 
                                      momentum=momentum, weight_decay=weight_decay, 
                                      SGD=SGD, batch_size=batch_size, nimg_per_epoch=nimg_per_epoch, 
-                                     rescale=rescale, netstr=netstr,tyx=tyx)
+                                     rescale=rescale, netstr=netstr,tyx=tyx, num_workers=num_workers,
+                                     fg_tables=fg_tables, flow_fields=flow_fields,
+                                     do_autocast=do_autocast, accumulate=accumulate, resume=resume,
+                                     eval_every=eval_every, checkpoint_every=checkpoint_every,
+                                     log_timings=log_timings)
         self.pretrained_model = model_path
         return model_path
 
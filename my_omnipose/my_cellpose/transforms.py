@@ -7,6 +7,7 @@ transforms_logger = logging.getLogger(__name__)
 
 from . import dynamics, utils
 import itertools # ND tiling
+import functools
 
 # import omnipose, edt, fastremap
 # OMNI_INSTALLED = True
@@ -652,6 +653,7 @@ def reshape_and_normalize_data(train_data, test_data=None, channels=None, channe
 
     """
 
+    from .io import LazyArrays
     # if training data is less than 2D
     run_test = False
     for test, data in enumerate([train_data, test_data]):
@@ -659,30 +661,45 @@ def reshape_and_normalize_data(train_data, test_data=None, channels=None, channe
             return train_data, test_data, run_test
         nimg = len(data)
         # print('reshape_and_normalize_data',nimg,channels,data[0].shape)
+        reshape_one = functools.partial(_reshape_and_normalize, channels=channels, channel_axis=channel_axis, 
+                                        normalize=normalize, omni=omni)
+        if isinstance(data, LazyArrays):
+            # done when each image is read 
+            data = data.map(reshape_one)
+            if test:
+                test_data = data
+            else:
+                train_data = data
+            continue
         for i in range(nimg):
-            if channels is not None:
-                data[i] = move_min_dim(data[i], force=True) ## consider changign this to just use the channel_axis, not min dim 
-            # print('3454354',data[i].shape)
-            if channels is not None:
-                data[i] = reshape(data[i], channels=channels, chan_first=True, channel_axis=channel_axis) # the cuplrit with 3D
-                # print('fgddgfgdfg',data[i].shape)
-
-            # if data[i].ndim < 3:
-            #     data[i] = data[i][np.newaxis,:,:]
-            # we actually want this padding for single-channel volumes too
-            #if channels is None: # data with multiple channels will have channels defined and have an axis already; could also pass in nchan to avoid this assumption 
-            #    data[i] = data[i][np.newaxis]
-            
-            # instead of this, we could just make the other parts of the code not rely on a channel axis and slice smarter 
-            
-            if normalize:
-                data[i] = normalize_img(data[i], axis=0, omni=omni)
+            data[i] = reshape_one(data[i])
 
         nchan = [data[i].shape[0] for i in range(nimg)]
     run_test = True
     # print('reshape_and_normalize_data_2',nimg,channels,data[0].shape,train_data[0].shape) why won't this print 
     return train_data, test_data, run_test
 
+def _reshape_and_normalize(data, channels=None, channel_axis=0, normalize=True, omni=False):
+    """ reshape_and_normalize_data() of a single image """
+    if channels is not None:
+        data = move_min_dim(data, force=True) ## consider changign this to just use the channel_axis, not min dim 
+    # print('3454354',data.shape)
+    if channels is not None:
+        data = reshape(data, channels=channels, chan_first=True, channel_axis=channel_axis) # the cuplrit with 3D
+        # print('fgddgfgdfg',data.shape)
+
+    # if data.ndim < 3:
+    #     data = data[np.newaxis,:,:]
+    # we actually want this padding for single-channel volumes too
+    #if channels is None: # data with multiple channels will have channels defined and have an axis already; could also pass in nchan to avoid this assumption 
+    #    data = data[np.newaxis]
+    
+    # instead of this, we could just make the other parts of the code not rely on a channel axis and slice smarter 
+    
+    if normalize:
+        data = normalize_img(data, axis=0, omni=omni)
+    return data
+
 def resize_image(img0, Ly=None, Lx=None, rsz=None, interpolation=cv2.INTER_LINEAR, no_channels=False):
     """ resize image for computing flows / unresize for computing dynamics
 
@@ -781,7 +798,8 @@ def pad_image_ND(img0, div=16, extra=1, dim=2):
 
 def random_rotate_and_resize(X, Y=None, scale_range=1., gamma_range=0.5, tyx=None, 
                              do_flip=True, rescale=None, unet=False,
-                             inds=None, omni=False, dim=2, nchan=1, kernel_size=2):
+                             inds=None, omni=False, dim=2, nchan=1, kernel_size=2, fg_tables=None, stats=None,
+                             flow_fields=None):
     """ augmentation by random rotation and resizing
 
         X and Y are lists or arrays of length nimg, with dims channels x Ly x Lx (channels optional)
@@ -815,6 +833,17 @@ def random_rotate_and_resize(X, Y=None, scale_range=1., gamma_range=0.5, tyx=Non
 
         unet: bool (optional, default False)
 
+        fg_tables: list of ND-arrays (optional, default None)
+            foreground tables of the labels for drawing crops with cells (omni only), 
+            see my_omnipose.core.foreground_table
+
+        stats: dict (optional, default None)
+            crop counters (omni only), see my_omnipose.core.random_rotate_and_resize
+
+        flow_fields: list of ND-arrays (optional, default None)
+            precomputed smooth distance and flows of the labels, warped into the crops instead of 
+            recomputing the flows (omni only), see my_omnipose.core.flow_field
+
         Returns
         -------
         imgi: ND-array, float
@@ -841,7 +870,8 @@ def random_rotate_and_resize(X, Y=None, scale_range=1., gamma_range=0.5, tyx=Non
         if tyx is None:
             tyx = (L,)*dim if dim==2 else (8*n,)+(8*n,)*(dim-1) #must be divisible by 2**3 = 8
         return my_omnipose.core.random_rotate_and_resize(X, Y=Y, scale_range=scale_range, gamma_range=gamma_range,
-                                                      tyx=tyx, do_flip=do_flip, rescale=rescale, inds=inds, nchan=nchan)
+                                                      tyx=tyx, do_flip=do_flip, rescale=rescale, inds=inds, nchan=nchan,
+                                                      fg_tables=fg_tables, stats=stats, flow_fields=flow_fields)
     else:
         # backwards compatibility; completely 'stock', no gamma augmentation or any other extra frills. 
         # [Y[i][1:] for i in inds] is necessary because the original transform function does not use masks (entry 0). 
@@ -1,4 +1,5 @@
 import os, warnings, time, tempfile, datetime, pathlib, shutil, subprocess
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from urllib.request import urlopen
 from urllib.parse import urlparse
@@ -355,33 +356,83 @@ def get_masks_unet(output, cell_threshold=0, boundary_threshold=0):
     masks = np.reshape(masks, shape0)
     return masks
 
-def stitch3D(masks, stitch_threshold=0.25):
-    """ stitch 2D masks into 3D volume with stitch_threshold on IOU """
-    mmax = masks[0].max()
-    empty = 0
+def stitch3D(masks, stitch_threshold=0.25, n_jobs=None):
+    """ stitch 2D masks into 3D volume with stitch_threshold on IOU 
+    
+    The overlaps of each pair of neighbouring planes are counted in parallel as sparse 
+    (label, label, count) lists on the original labels. The chain of matches is then resolved 
+    plane by plane from these lists alone (summing the overlaps and areas of labels that were 
+    stitched together), which is equivalent to the IoU matrix of each plane with the stitched one, 
+    and the label lookup of every plane is applied in a final parallel pass. 
+    
+    """
+    nplanes = len(masks)
+    
+    def plane_area(i):
+        return np.bincount(np.ravel(masks[i]).astype(np.intp, copy=False))
     
-    for i in range(len(masks)-1):
-        iou = metrics._intersection_over_union(masks[i+1], masks[i])[1:,1:]
-        if not iou.size and empty == 0:
-            masks[i+1] = masks[i+1]
-            mmax = masks[i+1].max()
-        elif not iou.size and not empty == 0:
-            icount = masks[i+1].max()
-            istitch = np.arange(mmax+1, mmax + icount+1, 1, int)
-            mmax += icount
-            istitch = np.append(np.array(0), istitch)
-            masks[i+1] = istitch[masks[i+1]]
+    def plane_overlap(i):
+        x, y = np.ravel(masks[i+1]), np.ravel(masks[i])
+        both = (x>0) & (y>0)
+        ny = int(y.max())+1 if y.size else 1
+        pairs, counts = np.unique(x[both].astype(np.int64)*ny + y[both], return_counts=True)
+        return pairs // ny, pairs % ny, counts
+    
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        areas = list(executor.map(plane_area, range(nplanes)))
+        overlaps = list(executor.map(plane_overlap, range(nplanes-1)))
+    
+    mmax = len(areas[0])-1 if nplanes else 0
+    empty = 0
+    prev = np.arange(mmax+1) # stitched label of each original label of the previous plane 
+    luts = [None]*nplanes
+    for i in range(nplanes-1):
+        icount = len(areas[i+1])-1
+        present = np.nonzero(areas[i][1:])[0]+1
+        if icount==0 or not present.size: # no IoU pairs 
+            if empty == 0:
+                istitch = np.arange(icount+1)
+                mmax = icount
+            else:
+                istitch = np.arange(mmax+1, mmax + icount+1, 1, int)
+                mmax += icount
+                istitch = np.append(np.array(0), istitch)
+                luts[i+1] = istitch
         else:
-            iou[iou < stitch_threshold] = 0.0
-            iou[iou < iou.max(axis=0)] = 0.0
-            istitch = iou.argmax(axis=1) + 1
-            ino = np.nonzero(iou.max(axis=1)==0.0)[0]
-            istitch[ino] = np.arange(mmax+1, mmax+len(ino)+1, 1, int)
+            # group the overlaps and areas by stitched label of the previous plane 
+            labels, inv = np.unique(prev[present], return_inverse=True)
+            area_prev = np.bincount(inv, weights=areas[i][present])
+            x, y, counts = overlaps[i]
+            keys, inv = np.unique(x*len(labels) + np.searchsorted(labels, prev[y]), return_inverse=True)
+            overlap = np.bincount(inv, weights=counts)
+            x, col = keys // len(labels), keys % len(labels)
+            iou = overlap / (areas[i+1][x] + area_prev[col] - overlap)
+            
+            # keep pairs above threshold that are the best match of their previous-plane label
+            keep = iou >= stitch_threshold
+            colmax = np.zeros(len(labels))
+            np.maximum.at(colmax, col[keep], iou[keep])
+            keep &= iou >= colmax[col]
+            x, col, iou = x[keep], col[keep], iou[keep]
+            
+            # best remaining match of each label (smallest stitched label on ties), new labels for the rest 
+            order = np.lexsort((col, -iou, x))
+            first = np.ones(len(order), bool)
+            first[1:] = x[order][1:] != x[order][:-1]
+            istitch = np.zeros(icount+1, int)
+            istitch[x[order][first]] = labels[col[order][first]]
+            ino = np.nonzero(istitch[1:]==0)[0]
+            istitch[ino+1] = np.arange(mmax+1, mmax+len(ino)+1, 1, int)
             mmax += len(ino)
-            istitch = np.append(np.array(0), istitch)
-            masks[i+1] = istitch[masks[i+1]]
+            luts[i+1] = istitch
             empty = 1
-            
+        prev = istitch
+    
+    def relabel(i):
+        masks[i] = luts[i][masks[i]]
+    
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        list(executor.map(relabel, [i for i in range(nplanes) if luts[i] is not None]))
     return masks
 
 # merged diameter functions
@@ -457,7 +508,13 @@ def fill_holes_and_remove_small_masks(masks, min_size=15, hole_size=3, scale_fac
         
     if masks.ndim > 3 or masks.ndim < 2:
         raise ValueError('masks_to_outlines takes 2D or 3D array, not %dD array'%masks.ndim)
-    
+
+    if OMNI_INSTALLED:
+        # same result as the loop below, with the holes of all masks found in one pass
+        return my_omnipose.core.fill_holes_and_remove_small_labels(masks, min_size=min_size, hole_size=hole_size,
+                                                                   fill_all=masks.ndim==3 or not SKIMAGE_ENABLED,
+                                                                   planar=masks.ndim==3, skip_empty=True)
+
     slices = find_objects(masks)
     j = 0
     for i,slc in enumerate(slices):
@@ -0,0 +1,182 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from my_omnipose import core
+
+
+def _shapes(edge=True):
+    """ Rectangles, lines and a disk, optionally with a rectangle cut by the image border. """
+    masks = np.zeros((96,120), np.int32)
+    masks[10:30,10:40] = 1
+    masks[40,10:60] = 2
+    masks[50:90,70] = 3
+    yy, xx = np.mgrid[:96,:120]
+    masks[((yy-70)**2+(xx-30)**2)<144] = 4
+    masks[60:80,90:100] = 5
+    if edge:
+        masks[0:15,80:110] = 6
+    return masks
+
+
+@pytest.mark.parametrize('edge', [False, True])
+def test_flow_error_per_object(edge):
+    masks = _shapes(edge)
+    dP = core.masks_to_flows(masks, omni=True)[-1]
+    errors, _ = core.flow_error(masks.copy(), 5*dP, per_object=False)
+    errors_obj, flows = core.flow_error(masks.copy(), 5*dP, per_object=True, return_flows=True)
+    assert errors_obj.shape == errors.shape
+    # thin objects run for fewer iterations on their own, well below the 0.4 removal threshold
+    assert np.allclose(errors_obj, errors, atol=0.1)
+    assert np.all(flows[:,masks==0] == 0)
+    kept = core.remove_bad_flow_masks(masks.copy(), 5*dP, per_object=True)
+    assert np.array_equal(kept>0, masks>0) # labels get renumbered
+
+
+def test_flow_error_cache_size():
+    masks = _shapes()
+    dP = core.masks_to_flows(masks, omni=True)[-1]
+    cache = {}
+    errors, _ = core.flow_error(masks.copy(), 5*dP, per_object=True)
+    errors_cached, _ = core.flow_error(masks.copy(), 5*dP, per_object=True, cache=cache, cache_size=3)
+    assert len(cache) == 3
+    assert np.array_equal(errors, errors_cached)
+
+
+def test_div_rescale_zero_flow():
+    masks = _shapes()
+    dP = core.div_rescale(np.zeros((2,)+masks.shape, np.float32), masks)
+    assert dP.shape == (2,)+masks.shape
+    assert np.all(dP == 0)
+    dP = core.div_rescale(np.ones((2,)+masks.shape, np.float32), np.zeros_like(masks))
+    assert np.all(dP == 0)
+
+
+def test_compute_masks_batch():
+    masks = _shapes(edge=False)
+    flows = core.masks_to_flows(masks, omni=True)
+    dP = 5*flows[-1]
+    dist = np.where(masks>0, np.asarray(flows[2]), -5).astype(np.float32)
+    stack_dP = np.stack([dP, np.zeros_like(dP), dP[:,::-1]*np.array([-1,1])[:,None,None]])
+    stack_dist = np.stack([dist, np.full_like(dist,-5), dist[::-1]])
+    kw = dict(niter=200/1.5, rescale=1.5, flow_threshold=0., omni=True, interp=True)
+    bd = np.zeros_like(stack_dist)
+    masks_batch, _, _ = core.compute_masks_batch(stack_dP, stack_dist, bd, batch_size=2, **kw)
+    for i in range(3):
+        expected = core.compute_masks(stack_dP[i], stack_dist[i], bd[i], **kw)[0]
+        assert np.array_equal(masks_batch[i], expected)
+    assert masks_batch[0].max() == masks.max()
+
+
+def test_compute_masks_series():
+    masks = _shapes(edge=False)
+    flows = core.masks_to_flows(masks, omni=True)
+    dP = 5*flows[-1]
+    dist = np.where(masks>0, np.asarray(flows[2]), -5).astype(np.float32)
+    bd = np.zeros((3,)+masks.shape, np.float32)
+    kw = dict(niter=200/1.5, rescale=1.5, flow_threshold=0., omni=True, interp=True)
+    masks_series, _, _ = core.compute_masks_series(np.stack([dP]*3), np.stack([dist]*3), bd, **kw)
+    expected = core.compute_masks(dP, dist, bd[0], **kw)[0]
+    assert np.array_equal(masks_series[0], expected)
+    for m in masks_series[1:]:
+        assert m.max() == masks.max()
+
+
+def test_compute_masks_series_moving():
+    # one object moves and another one appears, the rest stays put and is warm-started
+    frames = [_shapes(edge=False) for _ in range(3)]
+    for i in (1,2):
+        frames[i][60:80,90:100] = 0
+        frames[i][60+2*i:80+2*i,90+3*i:100+3*i] = 5
+    frames[2][5:25,50:60] = 6
+    dP, dist = [], []
+    for masks in frames:
+        flows = core.masks_to_flows(masks, omni=True)
+        dP.append(5*flows[-1])
+        dist.append(np.where(masks>0, np.asarray(flows[2]), -5).astype(np.float32))
+    bd = np.zeros((3,)+frames[0].shape, np.float32)
+    kw = dict(niter=200/1.5, rescale=1.5, flow_threshold=0., omni=True, interp=True)
+    masks_series, p_series, _ = core.compute_masks_series(np.stack(dP), np.stack(dist), bd, **kw)
+    for i, masks in enumerate(frames):
+        expected, p = core.compute_masks(dP[i], dist[i], bd[i], **kw)[:2]
+        assert _same_labels(masks_series[i], expected)
+        assert _same_labels(masks_series[i], masks)
+        # warm-started pixels stay at the fixed point instead of taking a full step off it
+        assert np.sqrt(np.sum((p_series[i]-p)**2, axis=0))[masks>0].max() < 0.5
+
+
+def test_eikonal_sweep_converged():
+    masks = np.pad(_shapes(), 1)
+    jacobi = core._extend_centers_torch(masks, np.array([]), n_iter=500, device=core.torch_CPU)[1]
+    sweep = core._extend_centers_torch(masks, np.array([]), n_iter=500, device=core.torch_CPU, solver='sweep')[1]
+    assert np.allclose(np.asarray(sweep), np.asarray(jacobi), atol=1e-4)
+
+
+def test_eikonal_sweep_border_objects():
+    # the reflection-padded frame of masks_to_flows(), where the edge object is twice as deep
+    masks = _shapes()
+    dists = core.edt.edt(masks)
+    pad = int(core.diameters(masks, dists)/2)
+    unpad = (slice(pad,-pad),)*2
+    masks_pad = np.pad(core.utils.get_edge_masks(masks, dists=dists), pad, mode='reflect')
+    masks_pad[unpad] = masks
+    masks_pad = np.pad(masks_pad, 1)
+    n_iter = core.get_niter(dists)
+    sweep = core._extend_centers_torch(masks_pad, np.array([]), n_iter=n_iter, 
+                                       device=core.torch_CPU, solver='sweep')[1]
+    jacobi = core._extend_centers_torch(masks_pad, np.array([]), n_iter=2000, device=core.torch_CPU)[1]
+    assert np.allclose(np.asarray(sweep), np.asarray(jacobi), atol=1e-4)
+    # stopped by the tolerance, not by the sweep limit
+    idx, offsets, valid, inds, fact = core._flat_stencil(masks_pad)
+    unbounded = core.eikonal_sweep(masks_pad, idx, offsets, valid, 2, inds, fact, 100*n_iter)
+    assert np.array_equal(np.asarray(sweep).reshape(masks_pad.shape), unbounded)
+
+
+def test_masks_to_flows_per_object():
+    masks = _shapes()
+    _, _, T, mu = core.masks_to_flows(masks, omni=True)
+    _, _, T_obj, mu_obj = core.masks_to_flows(masks, omni=True, per_object=True)
+    assert np.allclose(np.asarray(T_obj), np.asarray(T), atol=0.3)
+    # flows only disagree where the gradient of the distance vanishes
+    flipped = np.abs(mu_obj-mu).max(axis=0) > 0.1
+    assert np.mean(flipped[masks>0]) < 0.01
+
+
+def test_flow_error_default_whole_image():
+    masks = _shapes()
+    dP = core.masks_to_flows(masks, omni=True)[-1]
+    errors, flows = core.flow_error(masks.copy(), 5*dP)
+    assert flows is not None and np.allclose(flows, dP)
+    assert np.allclose(errors, 0)
+
+
+def test_fill_holes_no_future_warning():
+    masks = _shapes()
+    masks[15,20] = 0 # a one-pixel hole
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', FutureWarning)
+        filled = core.fill_holes_and_remove_small_masks(masks.copy(), min_size=5, hole_size=3)
+    assert filled[15,20] == filled[16,20] > 0
+
+
+def _same_labels(a, b):
+    """ Whether two label images are the same up to a renumbering. """
+    pairs = np.unique(np.stack([a.ravel(), b.ravel()]), axis=1)
+    return (len(np.unique(pairs[0])) == pairs.shape[1]) and (len(np.unique(pairs[1])) == pairs.shape[1])
+
+
+def test_compute_masks_chunked():
+    masks = np.concatenate([np.concatenate([_shapes(edge=False)*(k+1) for k in range(3)], axis=1)]*2, axis=0)
+    masks = core.ncolor.format_labels(masks)
+    flows = core.masks_to_flows(masks, omni=True)
+    dP = 5*flows[-1]
+    dist = np.where(masks>0, np.asarray(flows[2]), -5).astype(np.float32)
+    bd = np.zeros_like(dist)
+    kw = dict(niter=200, flow_threshold=0., omni=True, interp=True)
+    expected = core.compute_masks(dP, dist, bd, **kw)[0]
+    chunked, p, _ = core.compute_masks_chunked(dP, dist, bd, chunk_size=100, n_jobs=2, return_p=False, **kw)
+    assert p is None
+    assert _same_labels(chunked, expected)
+    with pytest.raises(ValueError):
+        core.compute_masks_chunked(np.zeros((3,4,8,8)), np.zeros((4,8,8)), chunk_size=4)